@@ -0,0 +1,51 @@
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Tuple
+
+# Relative slowdown or memory growth reported as regression
+DEFAULT_THRESHOLD = 0.1
+METRICS = ('seconds', 'peak_rss_bytes', 'traced_peak_bytes')
+
+
+def _results_by_key(path: str) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    with open(path, 'r') as fp:
+        return {(it['case'], it['packages']): it for it in json.load(fp)['results']}
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> List[str]:
+    # Lines describing regressions, cases missing from either file are skipped
+    baseline, current = _results_by_key(baseline_path), _results_by_key(current_path)
+    regressions: List[str] = []
+    for key in sorted(baseline.keys() & current.keys()):
+        for metric in METRICS:
+            before, after = baseline[key][metric], current[key][metric]
+            change = (after - before) / before if before != 0 else 0.0
+            line = f'{key[0]:>30} {key[1]:>7} {metric:>18}: {before:>14.4g} -> {after:>14.4g} {change:+7.1%}'
+            print(line)
+            if change > threshold:
+                regressions.append(line)
+
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative growth reported as regression, 0.1 is 10%%')
+    arguments = parser.parse_args()
+
+    regressions = compare(arguments.baseline, arguments.current, arguments.threshold)
+    if len(regressions) != 0:
+        print(f'\n{len(regressions)} regressions:', file=sys.stderr)
+        for it in regressions:
+            print(it, file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import argparse
+import hashlib
+import random
+from typing import List
+
+# Rough shares seen in Debian main, enough to get realistic stanza sizes and field mix
+SECTIONS = ['libs', 'devel', 'utils', 'python', 'doc', 'net', 'admin', 'x11', 'perl', 'science', 'games', 'web']
+ARCH_ALL_SHARE = 0.25
+EPOCH_SHARE = 0.05
+# Packages carrying more than one version, e.g. in proposed-updates or snapshots
+MULTIPLE_VERSIONS_SHARE = 0.05
+WORDS = ['data', 'library', 'tool', 'python', 'module', 'development', 'files', 'server', 'client', 'runtime',
+         'documentation', 'plugin', 'support', 'shared', 'headers', 'bindings', 'extension', 'common']
+
+
+def _version(rng: random.Random) -> str:
+    version = f'{rng.randint(0, 30)}.{rng.randint(0, 99)}.{rng.randint(0, 20)}'
+    if rng.random() < 0.1:
+        version += f'~rc{rng.randint(1, 5)}'
+    if rng.random() < EPOCH_SHARE:
+        version = f'{rng.randint(1, 3)}:{version}'
+
+    return f'{version}-{rng.randint(1, 9)}' + ('+b1' if rng.random() < 0.1 else '')
+
+
+def _relations(rng: random.Random, names: List[str], count: int) -> str:
+    relations = []
+    for _ in range(count):
+        relation = rng.choice(names)
+        if rng.random() < 0.4:
+            relation += f' (>= {rng.randint(0, 9)}.{rng.randint(0, 9)})'
+        if rng.random() < 0.1:
+            relation += f' | {rng.choice(names)}'
+        relations.append(relation)
+
+    return ', '.join(relations)
+
+
+def _stanza(rng: random.Random, name: str, version: str, names: List[str]) -> str:
+    architecture = 'all' if rng.random() < ARCH_ALL_SHARE else 'amd64'
+    section = rng.choice(SECTIONS)
+    filename = f'pool/main/{name[0]}/{name}/{name}_{version.split(":")[-1]}_{architecture}.deb'
+    size = int(rng.lognormvariate(11, 1.5)) + 1000
+    summary = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 8)))
+
+    lines = [f'Package: {name}']
+    if rng.random() < 0.3:
+        lines.append(f'Source: {name.split("-")[0]}')
+    lines += [
+        f'Version: {version}',
+        f'Installed-Size: {size // 300}',
+        f'Maintainer: Debian {section.title()} Team <pkg-{section}@lists.debian.org>',
+        f'Architecture: {architecture}',
+    ]
+    if rng.random() < 0.2:
+        lines.append(f'Multi-Arch: {rng.choice(["same", "foreign", "allowed"])}')
+    if rng.random() < 0.1:
+        lines.append(f'Provides: {_relations(rng, names, rng.randint(1, 3))}')
+    if rng.random() < 0.05:
+        lines.append(f'Pre-Depends: {_relations(rng, names, 1)}')
+    if rng.random() < 0.9:
+        lines.append(f'Depends: {_relations(rng, names, rng.randint(1, 12))}')
+    if rng.random() < 0.3:
+        lines.append(f'Recommends: {_relations(rng, names, rng.randint(1, 4))}')
+    if rng.random() < 0.2:
+        lines.append(f'Suggests: {_relations(rng, names, rng.randint(1, 4))}')
+    if rng.random() < 0.1:
+        lines.append(f'Breaks: {_relations(rng, names, rng.randint(1, 3))}')
+    lines += [
+        f'Description: {summary}',
+        f'Homepage: https://{name}.example.org',
+        f'Description-md5: {hashlib.md5(summary.encode()).hexdigest()}',
+    ]
+    if rng.random() < 0.4:
+        lines.append(f'Tag: {", ".join(f"role::{rng.choice(WORDS)}" for _ in range(rng.randint(2, 10)))}')
+    seed = f'{name}{version}{architecture}'.encode()
+    lines += [
+        f'Section: {section}',
+        f'Priority: {"optional" if rng.random() < 0.95 else "important"}',
+        f'Filename: {filename}',
+        f'Size: {size}',
+        f'MD5sum: {hashlib.md5(seed).hexdigest()}',
+        f'SHA256: {hashlib.sha256(seed).hexdigest()}',
+    ]
+
+    return '\n'.join(lines) + '\n'
+
+
+def generate_packages(count: int, seed: int = 0) -> str:
+    # Packages index with count stanzas. Same count and seed always give the same content
+    rng = random.Random(seed)
+    prefixes = ['lib', 'python3-', '', 'golang-', 'r-cran-']
+    names = [f'{rng.choice(prefixes)}{rng.choice(WORDS)}{it}' for it in range(count)]
+
+    stanzas: List[str] = []
+    position = 0
+    while len(stanzas) < count:
+        name = names[position % len(names)]
+        position += 1
+        versions = 2 if rng.random() < MULTIPLE_VERSIONS_SHARE else 1
+        for _ in range(min(versions, count - len(stanzas))):
+            stanzas.append(_stanza(rng, name, _version(rng), names))
+
+    return '\n'.join(stanzas)
+
+
+def mutate_packages(content: str, share: float = 0.05, seed: int = 1) -> str:
+    # Next sync of the same index: share of stanzas get a new version, as many are removed and added
+    rng = random.Random(seed)
+    stanzas = content.split('\n\n')
+    names = [it.split('\n', 1)[0].partition(': ')[2] for it in stanzas]
+    changed: List[str] = []
+    for stanza, name in zip(stanzas, names):
+        roll = rng.random()
+        if roll < share:
+            changed.append(_stanza(rng, name, _version(rng), names).rstrip('\n'))
+        elif roll < share * 2:
+            continue
+        else:
+            changed.append(stanza.rstrip('\n'))
+    for position in range(int(len(stanzas) * share)):
+        changed.append(_stanza(rng, f'new-{position}', _version(rng), names).rstrip('\n'))
+
+    return '\n\n'.join(changed) + '\n'
+
+
+def generate_release(file_count: int, seed: int = 0) -> str:
+    # Release listing file_count index files under every hash
+    rng = random.Random(seed)
+    components = ['main', 'contrib', 'non-free', 'non-free-firmware']
+    architectures = ['all', 'amd64', 'arm64', 'armel', 'armhf', 'i386', 'mips64el', 'mipsel', 'ppc64el', 's390x']
+    kinds = ['Packages', 'Packages.gz', 'Packages.xz', 'Contents', 'Contents.gz', 'Release', 'Translation-en.bz2']
+    paths = []
+    while len(paths) < file_count:
+        component, architecture = rng.choice(components), rng.choice(architectures)
+        paths.append(f'{component}/binary-{architecture}/{rng.choice(kinds)}.{len(paths)}')
+    sizes = [rng.randint(100, 50_000_000) for _ in paths]
+
+    lines = [
+        'Origin: Debian',
+        'Label: Debian',
+        'Suite: stable',
+        'Version: 12.5',
+        'Codename: bookworm',
+        'Changelogs: https://metadata.ftp-master.debian.org/changelogs/@CHANGEPATH@_changelog',
+        'Date: Sat, 10 Feb 2024 11:07:25 UTC',
+        'Acquire-By-Hash: yes',
+        'No-Support-for-Architecture-all: Packages',
+        f'Architectures: {" ".join(architectures)}',
+        f'Components: {" ".join(components)}',
+        'Description: Debian 12.5 Released 10 February 2024',
+    ]
+    for hash_name, digest in (('MD5Sum', hashlib.md5), ('SHA256', hashlib.sha256)):
+        lines.append(f'{hash_name}:')
+        for path, size in zip(paths, sizes):
+            lines.append(f' {digest(path.encode()).hexdigest()} {size:>16} {path}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate synthetic Packages or Release file')
+    parser.add_argument('kind', choices=['packages', 'release'])
+    parser.add_argument('count', type=int, help='Number of stanzas or Release entries')
+    parser.add_argument('output')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    generate = generate_packages if arguments.kind == 'packages' else generate_release
+    with open(arguments.output, 'w') as fp:
+        fp.write(generate(arguments.count, arguments.seed))
+
+
+if __name__ == '__main__':
+    main()
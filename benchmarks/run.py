@@ -0,0 +1,251 @@
+# Measures parsers on synthetic indexes of several sizes. Inputs are generated and every case is measured in its own
+# process, so peak memory of one never shows up in another:
+#   python benchmarks/run.py --sizes 1000,10000 --output before.json
+#   python benchmarks/compare.py before.json after.json
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+BENCHMARKS_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_ROOT), 'src'))
+
+from closure import dependency_closure  # noqa: E402
+from generate import generate_packages, generate_release, mutate_packages  # noqa: E402
+from packages import Package, iter_packages, package_difference_diff, parse_package, parse_package_file  # noqa: E402
+from parallel import parse_package_file_parallel  # noqa: E402
+from release import Release, parse_release  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 50000, 200000]
+DEFAULT_REPEATS = 3
+# Release entries per package, bookworm has ~600 per hash for ~64k amd64 packages
+RELEASE_ENTRIES_PER_PACKAGE = 0.01
+
+
+def _read(path: str) -> str:
+    with open(path, 'r') as fp:
+        return fp.read()
+
+
+def _packages_path(paths: Dict[str, str]) -> str:
+    return paths['packages']
+
+
+def _packages_content(paths: Dict[str, str]) -> str:
+    return _read(paths['packages'])
+
+
+def _parsed_pair(paths: Dict[str, str]) -> Tuple[List[Any], List[Any]]:
+    return (parse_package_file(paths['packages'], record_type='compact'),
+            parse_package_file(paths['mutated'], record_type='compact'))
+
+
+def _iter_compact(path: str) -> int:
+    with open(path, 'rb') as fp:
+        return sum(1 for _ in iter_packages(fp, record_type='compact'))
+
+
+def _difference(pair: Tuple[List[Any], List[Any]]) -> int:
+    old, new = pair
+    package_difference_diff(old, new)
+    package_difference_diff(new, old)
+    return len(old) + len(new)
+
+
+def _closure_graph(paths: Dict[str, str]) -> List[Package]:
+    # Chain as long as the index, every package depends on the next one, an alternative and a virtual package.
+    # Generated indexes are not used, their Provides hold alternatives dpkg would reject
+    count = len(parse_package_file(paths['packages'], record_type='compact'))
+    return [Package(package=f'p{it}', version='1.0', architecture='amd64', filename=f'pool/p{it}.deb', size=1,
+                    hashes={}, depends=[f'p{it + 1} (>= 1.0) | p{it + 2}', f'v{it % 100}'], provides=[f'v{it % 100}'])
+            for it in range(count)]
+
+
+def _release_lookups(release: Release) -> int:
+    # Path lookup of every listed file and a query per component and architecture, as index fetches do
+    for it in release.files:
+        release.get_file(it)
+    for component in release.components:
+        for architecture in release.architectures:
+            release.find_files(component, architecture, 'Packages')
+
+    return len(release.files)
+
+
+# Case -> (function preparing input outside of measurement, measured function returning number of stanzas)
+CASES: Dict[str, Tuple[Callable[[Dict[str, str]], Any], Callable[[Any], int]]] = {
+    'parse_package_pydantic': (_packages_content, lambda content: len(parse_package(content))),
+    'parse_package_compact': (_packages_content, lambda content: len(parse_package(content, record_type='compact'))),
+    'iter_packages_compact': (_packages_path, _iter_compact),
+    'parse_package_file_compact': (_packages_path, lambda path: len(parse_package_file(path, record_type='compact'))),
+    'parse_package_file_fields': (_packages_path, lambda path: len(parse_package_file(
+        path, record_type='compact', fields=['package', 'version', 'architecture', 'filename', 'size', 'hashes']))),
+    'parse_package_file_parallel': (_packages_path, lambda path: len(parse_package_file_parallel(
+        path, record_type='compact'))),
+    'parse_release': (lambda paths: _read(paths['release']),
+                      lambda content: len(parse_release(content).files_by_hash['SHA256'])),
+    'release_lookup': (lambda paths: parse_release(_read(paths['release'])), _release_lookups),
+    'package_difference_diff': (_parsed_pair, _difference),
+    'dependency_closure': (_closure_graph, lambda packages: len(dependency_closure(packages, ['p0']))),
+}
+INPUT_BY_CASE = {'parse_release': 'release', 'release_lookup': 'release'}
+# Writing 5 resets peak RSS of the process to its current RSS, Linux only
+CLEAR_REFS_PATH = '/proc/self/clear_refs'
+STATUS_PATH = '/proc/self/status'
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open(CLEAR_REFS_PATH, 'w') as fp:
+            fp.write('5')
+    except OSError:
+        return False
+
+    return True
+
+
+def _peak_rss(resettable: bool) -> int:
+    # ru_maxrss survives fork and exec, it includes peak of the parent process when it was larger
+    if resettable:
+        with open(STATUS_PATH, 'r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(case: str, paths: Dict[str, str], repeats: int) -> Dict[str, Any]:
+    # Runs in a process started by a parent that never holds inputs, and peak RSS is reset after input is
+    # prepared where the kernel allows it, so peak RSS belongs to this case only
+    prepare, function = CASES[case]
+    prepared = prepare(paths)
+    input_path = paths[INPUT_BY_CASE.get(case, 'packages')]
+    resettable = _reset_peak_rss()
+    baseline_rss = _peak_rss(resettable)
+
+    timings: List[float] = []
+    count = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        count = function(prepared)
+        timings.append(time.perf_counter() - start)
+    peak_rss = _peak_rss(resettable)
+
+    # Separate run, tracing slows everything down
+    tracemalloc.start()
+    function(prepared)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = min(timings)
+    size = os.path.getsize(input_path)
+    return {
+        'case': case,
+        'stanzas': count,
+        'input_bytes': size,
+        'seconds': seconds,
+        'stanzas_per_second': count / seconds,
+        'mb_per_second': size / seconds / 1024 / 1024,
+        # Peak of the whole process, including interpreter, imports and prepared input
+        'peak_rss_bytes': peak_rss,
+        'peak_rss_reset': resettable,
+        'baseline_rss_bytes': baseline_rss,
+        'traced_peak_bytes': traced_peak,
+    }
+
+
+def write_inputs(directory: str, size: int) -> Dict[str, str]:
+    paths = {name: os.path.join(directory, f'{name}-{size}') for name in ('packages', 'mutated', 'release')}
+    if not os.path.exists(paths['release']):
+        content = generate_packages(size)
+        with open(paths['packages'], 'w') as fp:
+            fp.write(content)
+        with open(paths['mutated'], 'w') as fp:
+            fp.write(mutate_packages(content))
+        with open(paths['release'], 'w') as fp:
+            fp.write(generate_release(max(10, int(size * RELEASE_ENTRIES_PER_PACKAGE))))
+
+    return paths
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(sizes: List[int], cases: List[str], repeats: int, data_directory: str) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    for size in sizes:
+        # Generated content is large, the process holding it would pass its peak RSS on to every case
+        output = subprocess.run([sys.executable, __file__, '--generate', str(size), '--data', data_directory],
+                                capture_output=True, text=True, check=True)
+        paths = json.loads(output.stdout)
+        for case in cases:
+            output = subprocess.run([sys.executable, __file__, '--measure', case, '--repeats', str(repeats),
+                                     '--paths', json.dumps(paths)], capture_output=True, text=True, check=True)
+            result = json.loads(output.stdout)
+            result['packages'] = size
+            results.append(result)
+            print(f'{case:>30} {size:>7}: {result["seconds"]:8.3f} s {result["stanzas_per_second"]:>10.0f} stanzas/s '
+                  f'{result["mb_per_second"]:7.1f} MB/s {result["peak_rss_bytes"] / 1024 / 1024:8.1f} MB peak RSS',
+                  file=sys.stderr)
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark Packages and Release parsing')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma separated numbers of packages')
+    parser.add_argument('--case', dest='cases', action='append', choices=sorted(CASES),
+                        help='Case to run, may be repeated. Default: every case')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--data', help='Directory for generated inputs, kept between runs. Default: temporary')
+    parser.add_argument('--output', help='JSON results file. Default: stdout')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--paths', help=argparse.SUPPRESS)
+    parser.add_argument('--generate', type=int, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.generate is not None:
+        print(json.dumps(write_inputs(arguments.data, arguments.generate)))
+        return
+    if arguments.measure is not None:
+        print(json.dumps(measure(arguments.measure, json.loads(arguments.paths), arguments.repeats)))
+        return
+
+    sizes = [int(it) for it in arguments.sizes.split(',')]
+    cases = arguments.cases or list(CASES)
+    if arguments.data is not None:
+        os.makedirs(arguments.data, exist_ok=True)
+        results = run(sizes, cases, arguments.repeats, arguments.data)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(sizes, cases, arguments.repeats, directory)
+
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
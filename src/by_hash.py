@@ -0,0 +1,176 @@
+import hashlib
+import os
+import posixpath
+from typing import Iterable, List, Optional, Tuple, Union
+
+from downloader import DownloadResult, DownloadTask, Downloader
+from mirrors import MirrorSet
+from release import FileHashInfo, Release, parse_release
+from tools import safe_join, write_atomically
+from verify import hash_file
+
+BY_HASH_NAME = 'SHA256'
+# Content-addressed copy of every index, shared by all suites of the mirror
+DEFAULT_STORE_DIRECTORY = '.by-hash'
+# Published Releases of every suite, by-hash files they reference are retained
+RELEASES_DIRECTORY = 'releases'
+# Clients may hold a Release for a while after it was replaced, its indexes stay available under by-hash paths
+DEFAULT_RETAINED_RELEASES = 3
+
+
+def by_hash_path(filepath: str, hashsum: str, hash_name: str = BY_HASH_NAME) -> str:
+    # 'main/binary-amd64/Packages.xz' -> 'main/binary-amd64/by-hash/SHA256/<hashsum>'
+    return posixpath.join(posixpath.dirname(filepath), 'by-hash', hash_name, hashsum)
+
+
+def store_path(store_root: str, hashsum: str, hash_name: str = BY_HASH_NAME) -> str:
+    return safe_join(store_root, posixpath.join(hash_name, hashsum))
+
+
+def _link(source: str, destination: str) -> None:
+    # Atomically points destination at the same inode as source
+    # rename() of two links to the same inode is a no-op, temporary link would be left behind
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temporary = f'{destination}.{os.getpid()}.link'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.link(source, temporary)
+    os.replace(temporary, destination)
+
+
+def _store_root(mirror_root: str, store_root: Optional[str]) -> str:
+    return store_root or os.path.join(mirror_root, DEFAULT_STORE_DIRECTORY)
+
+
+def publish_by_hash(store_root: str, dists_root: str, info: FileHashInfo) -> None:
+    # By-hash files never change, so they are published as soon as they are fetched. Clients holding the
+    # current Release keep using its named files until publish_named switches them
+    by_hash_destination = safe_join(dists_root, by_hash_path(info.filepath, info.hashsum))
+    if not os.path.exists(by_hash_destination):
+        _link(store_path(store_root, info.hashsum), by_hash_destination)
+
+
+def publish_named(mirror_root: str, dists_path: str, files: Iterable[FileHashInfo], store_root: Optional[str] = None,
+                  publish_root: Optional[str] = None) -> None:
+    # Points named index paths at fetched indexes. Called right before Release listing them is written, so
+    # named files and Release change together and clients holding either old or new Release find what it lists
+    store_root = _store_root(mirror_root, store_root)
+    dists_root = publish_root or safe_join(mirror_root, dists_path)
+    for info in files:
+        _link(store_path(store_root, info.hashsum), safe_join(dists_root, info.filepath))
+
+
+def _release_history(store_root: str, dists_path: str) -> str:
+    return safe_join(store_root, posixpath.join(RELEASES_DIRECTORY, dists_path))
+
+
+def _write_history(path: str, content: bytes) -> None:
+    if os.path.isfile(path):
+        return
+    write_atomically(path, content)
+
+
+def retain_by_hash(mirror_root: str, dists_path: str, release_content: bytes,
+                   keep: int = DEFAULT_RETAINED_RELEASES, store_root: Optional[str] = None,
+                   publish_root: Optional[str] = None) -> List[str]:
+    # Records published Release and removes by-hash files no one of the last keep Releases of dists_path lists.
+    # Returns removed paths. Store files are left to prune_store, other suites may be fetching into the store
+    assert keep >= 1, 'Published Release has to be retained'
+    store_root = _store_root(mirror_root, store_root)
+    dists_root = publish_root or safe_join(mirror_root, dists_path)
+    history = _release_history(store_root, dists_path)
+    os.makedirs(history, exist_ok=True)
+    _write_history(os.path.join(history, hashlib.sha256(release_content).hexdigest()), release_content)
+
+    releases: List[Tuple[Release, str]] = []
+    for it in os.scandir(history):
+        # Temporary files of interrupted writes have a suffix
+        if it.is_file() and '.' not in it.name:
+            with open(it.path, 'r') as fp:
+                releases.append((parse_release(fp.read()), it.path))
+    # Newest first
+    releases.sort(key=lambda it: it[0].date, reverse=True)
+    for _, path in releases[keep:]:
+        os.remove(path)
+    referenced = {info.hashsum for release, _ in releases[:keep]
+                  for info in release.files_by_hash.get(BY_HASH_NAME, [])}
+
+    removed: List[str] = []
+    for path, directories, files in os.walk(dists_root):
+        if os.path.basename(path) != BY_HASH_NAME or os.path.basename(os.path.dirname(path)) != 'by-hash':
+            continue
+        for it in files:
+            if it not in referenced:
+                os.remove(os.path.join(path, it))
+                removed.append(os.path.join(path, it))
+
+    return removed
+
+
+def prune_store(mirror_root: str, dry_run: bool = False, store_root: Optional[str] = None) -> List[str]:
+    # Removes store files no suite or snapshot links anymore, a single link is the store itself. Syncs fetch
+    # indexes into the store before linking them, so callers hold MirrorLock of the mirror exclusively. With
+    # dry_run only returns them
+    hash_root = os.path.join(_store_root(mirror_root, store_root), BY_HASH_NAME)
+    removed: List[str] = []
+    if not os.path.isdir(hash_root):
+        return removed
+    for it in os.scandir(hash_root):
+        # Partial downloads and temporary files have a suffix
+        if '.' in it.name or not it.is_file(follow_symlinks=False):
+            continue
+        if it.stat(follow_symlinks=False).st_nlink == 1:
+            if not dry_run:
+                os.remove(it.path)
+            removed.append(it.path)
+
+    return removed
+
+
+def _stored(path: str, info: FileHashInfo) -> bool:
+    # Store file of matching size may still be truncated and refilled, or damaged on disk
+    return os.path.isfile(path) and os.path.getsize(path) == info.filesize \
+        and hash_file(path, [BY_HASH_NAME])[BY_HASH_NAME] == info.hashsum
+
+
+def fetch_indexes(downloader: Union[Downloader, MirrorSet], dists_path: str, files: List[FileHashInfo],
+                  mirror_root: str, acquire_by_hash: bool, store_root: Optional[str] = None,
+                  publish_root: Optional[str] = None) -> List[DownloadResult]:
+    # files are SHA256 entries of Release. Indexes already in the store are not downloaded again, even if
+    # another suite fetched them. Indexes are published under by-hash paths of publish_root, dists_path of the
+    # mirror by default. Named paths keep previous indexes until publish_named
+    store_root = _store_root(mirror_root, store_root)
+    dists_root = publish_root or safe_join(mirror_root, dists_path)
+
+    results: List[Optional[DownloadResult]] = [None] * len(files)
+    pending: List[int] = []
+    for position, info in enumerate(files):
+        destination = store_path(store_root, info.hashsum)
+        if _stored(destination, info):
+            task = DownloadTask(path=posixpath.join(dists_path, info.filepath), destination=destination,
+                                size=info.filesize, hashes={BY_HASH_NAME: info.hashsum})
+            results[position] = DownloadResult(task=task, success=True, attempts=0)
+        else:
+            pending.append(position)
+
+    def make_task(info: FileHashInfo, by_hash: bool) -> DownloadTask:
+        path = by_hash_path(info.filepath, info.hashsum) if by_hash else info.filepath
+        return DownloadTask(path=posixpath.join(dists_path, path), destination=store_path(store_root, info.hashsum),
+                            size=info.filesize, hashes={BY_HASH_NAME: info.hashsum})
+
+    for position, result in zip(pending, downloader.download_all([make_task(files[it], acquire_by_hash)
+                                                                 for it in pending])):
+        results[position] = result
+    if acquire_by_hash:
+        # Mirrors may lag behind with by-hash directories, named files are tried then
+        failed = [it for it in pending if not results[it].success]
+        for position, result in zip(failed, downloader.download_all([make_task(files[it], False) for it in failed])):
+            results[position] = result
+
+    for info, result in zip(files, results):
+        if result.success:
+            publish_by_hash(store_root, dists_root, info)
+
+    return results
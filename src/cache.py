@@ -0,0 +1,159 @@
+import marshal
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from metrics import get_metrics
+from packages import AnyPackage, CompactPackage
+from tools import write_atomically
+
+CACHE_SUFFIX = '.packages'
+CACHE_MAGIC = b'PKGCACHE'
+# Bumped when record encoding changes
+CACHE_FORMAT_VERSION = 2
+# Fields the sync planner and dependency closure read. Descriptions and the rest make up most of an index and
+# are not cached, other slots of loaded packages are None
+CACHED_FIELDS = ('package', 'version', 'architecture', 'filename', 'size', 'hashes', 'depends', 'pre_depends',
+                 'recommends', 'provides')
+# Records are CompactPackage slots in this order, files written with other slots are never read
+RECORD_SLOTS: Tuple[str, ...] = tuple(it for it in CompactPackage.__slots__ if it.lstrip('_') in CACHED_FIELDS)
+UNCACHED_SLOTS = tuple(it for it in CompactPackage.__slots__ if it not in RECORD_SLOTS)
+SLOTS_CHECKSUM = zlib.crc32(','.join(RECORD_SLOTS).encode())
+# Magic, format version, slots checksum, record count
+HEADER = struct.Struct('<8sIIQ')
+OFFSET = struct.Struct('<Q')
+DEFAULT_MAX_CACHE_BYTES = 1024 ** 3
+
+
+def _record(package: AnyPackage) -> bytes:
+    # Lazy list fields of CompactPackage are stored as raw header values, so they stay unsplit
+    if isinstance(package, CompactPackage):
+        return marshal.dumps(tuple(getattr(package, it) for it in RECORD_SLOTS))
+    return marshal.dumps(tuple(getattr(package, it.lstrip('_')) for it in RECORD_SLOTS))
+
+
+def _package(record: Tuple) -> CompactPackage:
+    package = CompactPackage.__new__(CompactPackage)
+    for slot in UNCACHED_SLOTS:
+        setattr(package, slot, None)
+    for slot, value in zip(RECORD_SLOTS, record):
+        setattr(package, slot, value)
+    package.unknown_headers = []
+
+    return package
+
+
+def write_records(path: str, packages: Iterable[AnyPackage]) -> None:
+    # Header, offset table of count + 1 entries and marshalled records, replaced atomically
+    records = [_record(it) for it in packages]
+    offsets = [0]
+    for it in records:
+        offsets.append(offsets[-1] + len(it))
+
+    write_atomically(path, [HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, SLOTS_CHECKSUM, len(records)),
+                            struct.pack(f'<{len(offsets)}Q', *offsets), *records])
+
+
+class RecordFile(Sequence[CompactPackage]):
+    # Memory-mapped record file. Records are decoded on access straight from the mapping
+    def __init__(self, path: str):
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._records = memoryview(self._mmap)
+        try:
+            magic, version, checksum, count = HEADER.unpack_from(self._records)
+            assert magic == CACHE_MAGIC and version == CACHE_FORMAT_VERSION and checksum == SLOTS_CHECKSUM, \
+                f'Incompatible cache file: {path}'
+            table_end = HEADER.size + OFFSET.size * (count + 1)
+            assert len(self._records) >= table_end, f'Truncated cache file: {path}'
+            # Offsets are written little-endian whatever the platform is
+            self._offsets = struct.unpack_from(f'<{count + 1}Q', self._records, HEADER.size)
+            self._records = self._records[table_end:]
+            assert len(self._records) == self._offsets[count], f'Truncated cache file: {path}'
+        except BaseException:
+            self.close()
+            raise
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[it] for it in range(*position.indices(self._count))]
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError(position)
+
+        return _package(marshal.loads(self._records[self._offsets[position]:self._offsets[position + 1]]))
+
+    def __iter__(self) -> Iterator[CompactPackage]:
+        records, offsets = self._records, self._offsets
+        for position in range(self._count):
+            yield _package(marshal.loads(records[offsets[position]:offsets[position + 1]]))
+
+    def close(self) -> None:
+        self._records.release()
+        self._mmap.close()
+
+    def __enter__(self) -> 'RecordFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class IndexCache:
+    # Parsed indexes keyed by SHA256 of index file as listed in Release. Least recently used files are removed
+    # once the directory grows over max_bytes, use is tracked by mtime since atime is often disabled
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, sha256: str) -> str:
+        assert all(it in '0123456789abcdef' for it in sha256.lower()), f'Invalid SHA256: {sha256}'
+        return os.path.join(self.directory, sha256.lower() + CACHE_SUFFIX)
+
+    def load(self, sha256: str) -> Optional[RecordFile]:
+        # Packages are decoded from the mapping on access, every access returns new objects. The mapping is
+        # closed once records are not referenced anymore
+        path = self.path(sha256)
+        try:
+            records = RecordFile(path)
+            os.utime(path)
+        except (OSError, AssertionError, ValueError, EOFError, struct.error):
+            get_metrics().increment('index_cache_total', outcome='miss')
+            return None
+        get_metrics().increment('index_cache_total', outcome='hit')
+
+        return records
+
+    def store(self, sha256: str, packages: Iterable[AnyPackage]) -> None:
+        write_records(self.path(sha256), packages)
+        self.evict()
+
+    def evict(self) -> List[str]:
+        # Removes least recently used files until the cache fits max_bytes. Returns removed paths
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(CACHE_SUFFIX) and entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            removed: List[str] = []
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+                removed.append(path)
+
+        return removed
@@ -0,0 +1,228 @@
+import operator
+import re
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from packages import AnyPackage
+from version import version_key
+
+# 'name:arch (>= version) [arch list] <profiles>', only name is required
+RELATION = re.compile(r'^\s*([^\s:(\[<]+)(?::([^\s(\[<]+))?\s*(?:\(\s*(<<|<=|=|>=|>>|<|>)\s*([^\s)]+)\s*\))?'
+                      r'\s*(?:\[[^\]]*\])?\s*(?:<[^>]*>\s*)*$')
+# Fields followed by default. Recommends are installed by default too, but are optional for the mirror
+DEPENDENCY_FIELDS = ('pre_depends', 'depends')
+# Arch qualifier allowing dependency of any architecture, 'native' stands for architecture of the dependent package
+ANY_ARCHITECTURE = 'any'
+NATIVE_ARCHITECTURE = 'native'
+# '<' and '>' are obsolete spellings of '<=' and '>=' which dpkg still accepts
+VERSION_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    '<<': operator.lt,
+    '<': operator.le,
+    '<=': operator.le,
+    '=': operator.eq,
+    '>=': operator.ge,
+    '>': operator.ge,
+    '>>': operator.gt,
+}
+
+
+class Relation(NamedTuple):
+    name: str
+    architecture: Optional[str] = None
+    operator: Optional[str] = None
+    version: Optional[str] = None
+
+
+def parse_relation(text: str) -> Relation:
+    match = RELATION.match(text)
+    assert match is not None, f'Invalid relation: {text}'
+
+    return Relation._make(match.groups())
+
+
+def version_satisfies(version: str, operator: Optional[str], required: Optional[str]) -> bool:
+    if operator is None:
+        return True
+    return VERSION_OPERATORS[operator](version_key(version), version_key(required))
+
+
+class DependencyGraph:
+    # Packages indexed by name and by names they provide. Relations of a package are parsed only when
+    # closure reaches it
+    def __init__(self, packages: Iterable[AnyPackage], fields: Sequence[str] = DEPENDENCY_FIELDS):
+        self.packages: List[AnyPackage] = list(packages)
+        self.fields = tuple(fields)
+        self.by_name: Dict[str, List[int]] = {}
+        # Virtual name -> (package index, provided version or None)
+        self.providers_by_name: Dict[str, List[Tuple[int, Optional[str]]]] = {}
+        # Relation text -> relation, architecture -> relation -> candidates and architecture -> alternative text
+        # -> candidates. Many packages share relations, e.g. 'libc6 (>= 2.34)'. Plain dicts of the graph rather
+        # than global LRU caches, those allocate a link per entry that keeps garbage collector busy and outlives
+        # the graph
+        self._relations: Dict[str, Relation] = {}
+        self._candidates: Dict[Optional[str], Dict[Relation, Tuple[int, ...]]] = {}
+        self._alternatives: Dict[Optional[str], Dict[str, Tuple[int, ...]]] = {}
+
+        by_name, providers_by_name, relations = self.by_name, self.providers_by_name, self._relations
+        for position, it in enumerate(self.packages):
+            positions = by_name.get(it.package)
+            if positions is None:
+                by_name[it.package] = [position]
+            else:
+                positions.append(position)
+            for provided in it.provides or ():
+                relation = relations.get(provided) or self.relation(provided)
+                providers = providers_by_name.get(relation.name)
+                if providers is None:
+                    providers_by_name[relation.name] = [(position, relation.version)]
+                else:
+                    providers.append((position, relation.version))
+
+    def relation(self, text: str) -> Relation:
+        relation = self._relations.get(text)
+        if relation is None:
+            relation = self._relations[text] = parse_relation(text)
+
+        return relation
+
+    def candidates(self, relation: Relation, architecture: Optional[str] = None) -> Tuple[int, ...]:
+        # architecture is the one of the dependent package, unqualified relations resolve to packages of it or
+        # arch all ones, like apt does. None resolves to every architecture
+        if relation.architecture is not None:
+            if relation.architecture == ANY_ARCHITECTURE:
+                architecture = None
+            elif relation.architecture != NATIVE_ARCHITECTURE:
+                architecture = relation.architecture
+        cache = self._candidates.get(architecture)
+        if cache is None:
+            cache = self._candidates[architecture] = {}
+        candidates = cache.get(relation)
+        if candidates is None:
+            candidates = cache[relation] = self._find_candidates(relation.name, relation.operator, relation.version,
+                                                                 architecture)
+
+        return candidates
+
+    def _find_candidates(self, name: str, operator: Optional[str], version: Optional[str],
+                         architecture: Optional[str]) -> Tuple[int, ...]:
+        # Real packages satisfying relation, or its providers when there are none
+        compare = VERSION_OPERATORS[operator] if operator is not None else None
+        required = version_key(version) if compare is not None else None
+
+        packages = self.packages
+        real: List[int] = []
+        for position in self.by_name.get(name, ()):
+            package = packages[position]
+            if architecture is not None and package.architecture != architecture and package.architecture != 'all':
+                continue
+            if compare is not None and not compare(version_key(package.version), required):
+                continue
+            real.append(position)
+        if len(real) != 0:
+            return tuple(real)
+
+        providers: List[int] = []
+        for position, provided_version in self.providers_by_name.get(name, ()):
+            if architecture is not None and packages[position].architecture not in (architecture, 'all'):
+                continue
+            # Unversioned Provides never satisfy a versioned relation
+            if compare is not None and (provided_version is None or
+                                        not compare(version_key(provided_version), required)):
+                continue
+            providers.append(position)
+
+        return tuple(providers)
+
+    def alternative_candidates(self, text: str, architecture: Optional[str] = None,
+                               all_alternatives: bool = False) -> Tuple[int, ...]:
+        # Candidates of the first satisfiable alternative, which is what apt would pick
+        cache = self._alternatives.get(architecture)
+        if cache is None:
+            cache = self._alternatives[architecture] = {}
+        candidates: Tuple[int, ...] = ()
+        # Alternatives are resolved one by one, later ones are rarely needed
+        for alternative in text.split('|'):
+            found = cache.get(alternative)
+            if found is None:
+                found = cache[alternative] = self._resolve(alternative, architecture)
+            if all_alternatives:
+                candidates += found
+            else:
+                candidates = found
+                if len(candidates) != 0:
+                    break
+
+        return candidates
+
+    def _resolve(self, text: str, architecture: Optional[str]) -> Tuple[int, ...]:
+        # candidates() of relation text. Most relation texts of a suite are resolved once, so they are neither
+        # kept as Relation nor hashed
+        match = RELATION.match(text)
+        assert match is not None, f'Invalid relation: {text}'
+        name, qualifier, operator, version = match.groups()
+        if qualifier is not None:
+            if qualifier == ANY_ARCHITECTURE:
+                architecture = None
+            elif qualifier != NATIVE_ARCHITECTURE:
+                architecture = qualifier
+
+        return self._find_candidates(name, operator, version, architecture)
+
+
+def dependency_closure(packages: Iterable[AnyPackage], seeds: Iterable[str],
+                       fields: Sequence[str] = DEPENDENCY_FIELDS, all_alternatives: bool = False) -> List[AnyPackage]:
+    # Seed packages and everything they depend on transitively. Seeds are package names or relations,
+    # e.g. 'nginx', 'nginx:amd64' or 'python3 (>= 3.11)'. Order of packages is preserved
+    graph = DependencyGraph(packages, fields)
+    # Architecture a package is installed for -> packages. It differs from own architecture of a package only
+    # for arch all ones. State is kept per architecture rather than in (position, architecture) tuples, which
+    # would be allocated for every edge and keep garbage collector busy on large graphs
+    visited: Dict[Optional[str], Set[int]] = {}
+    # Candidates of a relation are the same for every package of an architecture, so each relation string is
+    # expanded once per architecture
+    expanded: Dict[Optional[str], Set[str]] = {}
+    # Candidates to visit by architecture of the package that pulled them in
+    pending: Dict[Optional[str], List[int]] = {None: []}
+    for seed in seeds:
+        pending[None].extend(graph.candidates(graph.relation(seed)))
+
+    # Hot loop of large closures, attributes are looked up once
+    packages, fields, alternative_candidates = graph.packages, graph.fields, graph.alternative_candidates
+    while len(pending) != 0:
+        required_by, positions = pending.popitem()
+        while len(positions) != 0:
+            position = positions.pop()
+            package = packages[position]
+            # Relations of arch all packages resolve for architecture of the package that pulled them in
+            architecture = package.architecture
+            if architecture == 'all':
+                architecture = required_by
+            architecture_visited = visited.get(architecture)
+            if architecture_visited is None:
+                architecture_visited = visited[architecture] = set()
+                expanded[architecture] = set()
+            if position in architecture_visited:
+                continue
+            architecture_visited.add(position)
+            architecture_expanded = expanded[architecture]
+            # Candidates of the same architecture are visited in this loop, others once it is done
+            architecture_pending = positions if architecture == required_by else pending.setdefault(architecture, [])
+            for field in fields:
+                for text in getattr(package, field) or ():
+                    if text not in architecture_expanded:
+                        architecture_expanded.add(text)
+                        architecture_pending.extend(alternative_candidates(text, architecture, all_alternatives))
+    positions = set().union(*visited.values())
+
+    return [it for position, it in enumerate(graph.packages) if position in positions]
+
+
+def read_seeds(path: str) -> List[str]:
+    # One package or relation per line, '#' starts a comment
+    seeds: List[str] = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if len(line) != 0:
+                seeds.append(line)
+
+    return seeds
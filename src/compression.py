@@ -0,0 +1,94 @@
+import bz2
+import gzip
+import lzma
+import time
+from typing import IO, Callable, Dict, Iterator, List, Optional
+
+from metrics import get_metrics
+from packages import AnyPackage, iter_packages_from_lines
+from release import FileHashInfo, Release
+from tools import DEFAULT_CHUNK_SIZE, iter_lines
+
+# Each opener wraps compressed binary stream and decompresses it lazily on read()
+DECOMPRESSORS: Dict[str, Callable[[IO[bytes]], IO[bytes]]] = {
+    '.xz': lambda fp: lzma.open(fp, 'rb'),
+    '.lzma': lambda fp: lzma.open(fp, 'rb', format=lzma.FORMAT_ALONE),
+    '.gz': lambda fp: gzip.open(fp, 'rb'),
+    '.bz2': lambda fp: bz2.open(fp, 'rb'),
+}
+PREFERRED_HASH = 'SHA256'
+
+
+def compression_extension(filepath: str) -> str:
+    for extension in DECOMPRESSORS:
+        if filepath.endswith(extension):
+            return extension
+
+    return ''
+
+
+def strip_compression_extension(filepath: str) -> str:
+    extension = compression_extension(filepath)
+    if len(extension) == 0:
+        return filepath
+
+    return filepath[:-len(extension)]
+
+
+def open_decompressed(fp: IO[bytes], filepath: str) -> IO[bytes]:
+    extension = compression_extension(filepath)
+    if len(extension) == 0:
+        return fp
+
+    return DECOMPRESSORS[extension](fp)
+
+
+def index_variants(release: Release, index_path: str, hash_name: Optional[str] = None) -> List[FileHashInfo]:
+    # index_path is path without compression extension, e.g. 'main/binary-amd64/Packages'. Without hash_name
+    # PREFERRED_HASH is used if Release has it, any other hash otherwise
+    if hash_name is None:
+        hash_name = PREFERRED_HASH if PREFERRED_HASH in release.files_by_hash else next(iter(release.files_by_hash))
+
+    variants: List[FileHashInfo] = []
+    for filepath in (index_path, *(index_path + extension for extension in DECOMPRESSORS)):
+        file = release.get_file(filepath)
+        info = file.hash_info(hash_name) if file is not None else None
+        if info is not None:
+            variants.append(info)
+
+    return variants
+
+
+def select_index_variant(release: Release, index_path: str, hash_name: Optional[str] = None) -> FileHashInfo:
+    variants = index_variants(release, index_path, hash_name)
+    assert len(variants) != 0, f'No variants of {index_path} listed in release'
+
+    return min(variants, key=lambda it: it.filesize)
+
+
+class _MeasuredReader:
+    # Accounts time spent in read() of decompressing stream, used only with metrics enabled
+    def __init__(self, fp: IO[bytes], compression: str):
+        self.fp = fp
+        self.compression = compression
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self.fp.read(size)
+        metrics = get_metrics()
+        metrics.increment('decompression_seconds_total', time.perf_counter() - start, compression=self.compression)
+        metrics.increment('decompressed_bytes_total', len(data), compression=self.compression)
+        return data
+
+
+def iter_index_lines(fp: IO[bytes], filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    decompressed = open_decompressed(fp, filepath)
+    if get_metrics().enabled:
+        decompressed = _MeasuredReader(decompressed, compression_extension(filepath) or 'none')
+
+    return iter_lines(decompressed, chunk_size)
+
+
+def iter_index_packages(fp: IO[bytes], filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        record_type: str = 'pydantic') -> Iterator[AnyPackage]:
+    return iter_packages_from_lines(iter_index_lines(fp, filepath, chunk_size), record_type)
@@ -0,0 +1,175 @@
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from downloader import DownloadTask
+from packages import AnyPackage
+from tools import safe_join
+from verify import hash_file
+
+# ioctl request cloning file extents on Linux (btrfs, xfs and others)
+FICLONE = 0x40049409
+
+
+class LinkReport(BaseModel):
+    linked: List[str] = []
+    saved_bytes: int = 0
+    # Groups none of whose files exist yet
+    unavailable: int = 0
+
+
+class DedupIndex:
+    # Files by content. Every unique SHA256 has to be downloaded, verified and stored once, other file names
+    # with the same content are linked to it. Files without SHA256 are keyed by their name
+    def __init__(self):
+        self.filenames_by_key: Dict[str, List[str]] = {}
+        self.sizes: Dict[str, int] = {}
+        # Filename -> SHA256 its file on disk was verified to have, by a download or a previous sync. Only such
+        # files are used as link sources
+        self.verified: Dict[str, str] = {}
+
+    def add(self, filename: str, size: int, sha256: Optional[str]) -> bool:
+        # Returns whether content has been seen for the first time
+        key = _content_key(filename, sha256)
+        filenames = self.filenames_by_key.get(key)
+        if filenames is None:
+            self.filenames_by_key[key] = [filename]
+            self.sizes[key] = size
+            return True
+        if filename not in filenames:
+            filenames.append(filename)
+
+        return False
+
+    def add_packages(self, packages: Iterable[AnyPackage]) -> None:
+        for it in packages:
+            self.add(it.filename, it.size, it.hashes.get('SHA256'))
+
+    def add_files(self, files: Iterable[Tuple[str, int, Optional[str]]]) -> None:
+        # (filename, size, SHA256 or None) rows, e.g. every package recorded in state
+        for filename, size, sha256 in files:
+            self.add(filename, size, sha256)
+
+    def duplicates(self) -> Dict[str, List[str]]:
+        return {key: filenames for key, filenames in self.filenames_by_key.items() if len(filenames) > 1}
+
+    def verified_source(self, mirror_root: str, key: str, exclude: Optional[str] = None) -> Optional[str]:
+        # Path of a file of key's content that was verified and still has its size on disk
+        for filename in self.filenames_by_key.get(key, []):
+            if filename == exclude or self.verified.get(filename) != key:
+                continue
+            path = safe_join(mirror_root, filename)
+            if os.path.isfile(path) and os.path.getsize(path) == self.sizes[key]:
+                return path
+
+        return None
+
+
+def _content_key(filename: str, sha256: Optional[str]) -> str:
+    return sha256 if sha256 is not None else f'filename:{filename}'
+
+
+def unique_packages(packages: Iterable[AnyPackage], index: Optional[DedupIndex] = None) -> List[AnyPackage]:
+    # First package of every content, e.g. arch all package listed by every architecture is kept once
+    index = index if index is not None else DedupIndex()
+    return [it for it in packages if index.add(it.filename, it.size, it.hashes.get('SHA256'))]
+
+
+def unique_tasks(tasks: Iterable[DownloadTask], index: Optional[DedupIndex] = None,
+                 mirror_root: Optional[str] = None) -> List[DownloadTask]:
+    # First task of every content. index may already hold every package of the mirror, then tasks whose content
+    # is stored under another name are dropped as well when mirror_root is given, that copy is linked instead of
+    # downloading it again. Copies verified by nobody are hashed first
+    index = index if index is not None else DedupIndex()
+    seen: Set[str] = set()
+    unique: List[DownloadTask] = []
+    for it in tasks:
+        sha256 = it.hashes.get('SHA256')
+        index.add(it.path, it.size or 0, sha256)
+        key = _content_key(it.path, sha256)
+        if key in seen or (mirror_root is not None and _source(index, mirror_root, key, it.path) is not None):
+            continue
+        seen.add(key)
+        unique.append(it)
+
+    return unique
+
+
+def clone_file(source: str, destination: str) -> str:
+    # Makes destination share data with source: reflink, hardlink or copy as the last resort.
+    # Destination is replaced atomically. Returns method that worked
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temporary = f'{destination}.{os.getpid()}.dedup'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+
+    method = 'hardlink'
+    try:
+        os.link(source, temporary)
+    except OSError:
+        method = _reflink_or_copy(source, temporary)
+    os.replace(temporary, destination)
+
+    return method
+
+
+def _reflink_or_copy(source: str, destination: str) -> str:
+    try:
+        import fcntl
+        with open(source, 'rb') as source_fp, open(destination, 'wb') as destination_fp:
+            fcntl.ioctl(destination_fp.fileno(), FICLONE, source_fp.fileno())
+        return 'reflink'
+    except (ImportError, OSError):
+        shutil.copyfile(source, destination)
+        return 'copy'
+
+
+def _same_file(paths: List[str]) -> bool:
+    try:
+        return all(os.path.samefile(paths[0], it) for it in paths[1:])
+    except FileNotFoundError:
+        return False
+
+
+def _source(index: DedupIndex, mirror_root: str, key: str, exclude: Optional[str] = None) -> Optional[str]:
+    # Verified copy of the group other than exclude. Size alone could pick a stale file of a failed download, so
+    # files verified by nobody are hashed before they are linked over other names
+    source = index.verified_source(mirror_root, key, exclude)
+    if source is not None or key.startswith('filename:'):
+        return source
+    for filename in index.filenames_by_key.get(key, []):
+        if filename == exclude:
+            continue
+        path = safe_join(mirror_root, filename)
+        if os.path.isfile(path) and os.path.getsize(path) == index.sizes[key] \
+                and hash_file(path, ['SHA256'])['SHA256'] == key:
+            index.verified[filename] = key
+            return path
+
+    return None
+
+
+def link_duplicates(index: DedupIndex, mirror_root: str) -> LinkReport:
+    # Every file name of a content group is pointed at one verified copy
+    report = LinkReport()
+    for key, filenames in index.duplicates().items():
+        if _same_file([safe_join(mirror_root, it) for it in filenames]):
+            continue
+        source = _source(index, mirror_root, key)
+        if source is None:
+            report.unavailable += 1
+            continue
+        for filename in filenames:
+            destination = safe_join(mirror_root, filename)
+            if os.path.exists(destination) and os.path.samefile(source, destination):
+                continue
+            method = clone_file(source, destination)
+            index.verified[filename] = key
+            report.linked.append(filename)
+            # A copy fixes the file but saves nothing
+            if method != 'copy':
+                report.saved_bytes += index.sizes[key]
+
+    return report
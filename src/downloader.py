@@ -1 +1,450 @@
+import http.client
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
 
+from pydantic import BaseModel
+
+from metrics import get_metrics
+from packages import AnyPackage
+from shaping import AdaptiveConcurrency, Shaper
+from tools import safe_join
+from verify import MultiHasher, hash_file
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Statuses worth another attempt, everything else except 200 fails the task immediately
+RETRYABLE_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+# Upstream asks to slow down, adaptive concurrency backs off on these
+CONGESTION_STATUSES = frozenset((429, 503))
+PARTIAL_SUFFIX = '.partial'
+# Journal next to partial file, describes what partial file is a prefix of
+JOURNAL_SUFFIX = '.partial.journal'
+# 'bytes 100-199/200'
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class DownloadError(Exception):
+    def __init__(self, message: str, retryable: bool = True, status: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status = status
+        # Seconds from Retry-After header
+        self.retry_after = retry_after
+
+
+class DownloadTask(BaseModel):
+    # Path relative to upstream root, e.g. 'pool/main/0/0ad/0ad_0.0.26-3_amd64.deb'
+    path: str
+    destination: str
+    size: Optional[int] = None
+    # Expected digests by Debian hash name, checked while the file streams in
+    hashes: Dict[str, str] = {}
+
+
+class DownloadResult(BaseModel):
+    task: DownloadTask
+    success: bool
+    # 0 when destination was already complete
+    attempts: int
+    downloaded_bytes: int = 0
+    # Bytes of interrupted download that were kept
+    resumed_bytes: int = 0
+    # Verified digests of downloaded file
+    hashes: Dict[str, str] = {}
+    error: Optional[str] = None
+
+
+class HttpValidator(BaseModel):
+    # Response headers of the last fetch of a URL, sent back as If-None-Match and If-Modified-Since
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def headers(self) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class PartialJournal(BaseModel):
+    path: str
+    size: Optional[int] = None
+    hashes: Dict[str, str] = {}
+    # ETag or Last-Modified of upstream file, sent as If-Range so a changed file is sent whole
+    validator: Optional[str] = None
+
+    def matches(self, task: DownloadTask) -> bool:
+        return self.path == task.path and self.size == task.size and self.hashes == task.hashes
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    # Only delay in seconds is supported, HTTP dates are ignored
+    if value is None or not value.strip().isdigit():
+        return None
+    return float(value)
+
+
+def _read_journal(path: str) -> Optional[PartialJournal]:
+    try:
+        with open(path, 'r') as fp:
+            return PartialJournal.model_validate_json(fp.read())
+    # Journal may be cut short by a crash
+    except (OSError, ValueError):
+        return None
+
+
+def _write_journal(path: str, journal: PartialJournal) -> None:
+    with open(path, 'w') as fp:
+        fp.write(journal.model_dump_json())
+
+
+def _discard_partial(task: DownloadTask) -> None:
+    for suffix in (PARTIAL_SUFFIX, JOURNAL_SUFFIX):
+        if os.path.exists(task.destination + suffix):
+            os.remove(task.destination + suffix)
+
+
+def _hash_prefix(path: str, hasher: MultiHasher) -> int:
+    # hashlib state can not be saved to journal, so kept prefix is hashed again. Reading it locally is
+    # much cheaper than downloading it
+    size = 0
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+
+    return size
+
+
+def is_complete(task: DownloadTask) -> Optional[Dict[str, str]]:
+    # Digests of destination when it matches size and hashes of task, None otherwise. Files with nothing to
+    # check them against are never considered complete
+    if (task.size is None and len(task.hashes) == 0) or not os.path.isfile(task.destination):
+        return None
+    if task.size is not None and os.path.getsize(task.destination) != task.size:
+        return None
+    # Size is all there is to check, file is not read
+    if len(task.hashes) == 0:
+        return {}
+    digests = hash_file(task.destination, task.hashes)
+    if any(task.hashes[name].lower() != digest for name, digest in digests.items()):
+        return None
+
+    return digests
+
+
+ConnectionKey = Tuple[str, str]
+
+
+class ConnectionPool:
+    # Idle keep-alive connections by (scheme, netloc). Every worker takes a connection for one request and
+    # gives it back after the response has been read, so at most `parallelism` connections exist per host
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._idle: Dict[ConnectionKey, List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: ConnectionKey, reuse: bool = True) -> Tuple[http.client.HTTPConnection, bool]:
+        # Returns connection and whether it was taken from idle ones
+        if reuse:
+            with self._lock:
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        assert scheme == 'http', f'Unsupported scheme: {scheme}'
+
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def release(self, key: ConnectionKey, connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def close(self) -> None:
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+
+class Downloader:
+    # With adaptive concurrency parallelism is the upper bound, downloads start with one connection
+    def __init__(self, base_url: str, parallelism: int = 8, retries: int = 3, backoff: float = 0.5,
+                 timeout: float = 30.0, shaper: Optional[Shaper] = None, adaptive: bool = False):
+        assert parallelism > 0, f'Parallelism should be positive: {parallelism}'
+        self.base_url = base_url.rstrip('/')
+        # Key of per-host rate limits and metrics label
+        self.host = urlsplit(self.base_url).netloc
+        self.parallelism = parallelism
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(timeout)
+        self.shaper = shaper
+        self.concurrency = AdaptiveConcurrency(parallelism) if adaptive else None
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def __enter__(self) -> 'Downloader':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def url(self, path: str) -> str:
+        return f'{self.base_url}/{quote(path.lstrip("/"), safe="/~+:")}'
+
+    def _request(self, path: str, headers: Optional[Dict[str, str]] = None) \
+            -> Tuple[ConnectionKey, http.client.HTTPConnection, http.client.HTTPResponse]:
+        url = urlsplit(self.url(path))
+        key = (url.scheme, url.netloc)
+
+        reuse = True
+        while True:
+            connection, reused = self.pool.acquire(key, reuse)
+            try:
+                start = time.perf_counter()
+                connection.request('GET', url.path, headers=headers or {})
+                response = connection.getresponse()
+                # Time to response headers
+                metrics = get_metrics()
+                metrics.observe('http_request_seconds', time.perf_counter() - start, host=url.netloc)
+                metrics.increment('http_responses_total', host=url.netloc, status=response.status)
+                return key, connection, response
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                # Server may have closed idle keep-alive connection, that is not worth an attempt
+                if not reused:
+                    raise
+                reuse = False
+
+    @contextmanager
+    def stream(self, path: str, headers: Optional[Dict[str, str]] = None,
+               statuses: Tuple[int, ...] = (200,)) -> Iterator[http.client.HTTPResponse]:
+        key, connection, response = self._request(path, headers)
+        try:
+            if response.status not in statuses:
+                response.read()
+                raise DownloadError(f'{path}: HTTP {response.status} {response.reason}',
+                                    response.status in RETRYABLE_STATUSES, response.status,
+                                    _retry_after(response.getheader('Retry-After')))
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        # Connection can be reused only when response has been read to the end
+        if response.isclosed() or response.read(1) == b'':
+            self.pool.release(key, connection)
+        else:
+            connection.close()
+
+    def fetch_bytes(self, path: str) -> bytes:
+        # For small files like Release. Retries are the same as for downloads
+        content, _ = self.fetch_conditional(path)
+        assert content is not None
+
+        return content
+
+    def fetch_conditional(self, path: str, validator: Optional[HttpValidator] = None) \
+            -> Tuple[Optional[bytes], HttpValidator]:
+        # Content is None when upstream answered 304, file has not changed since validator was taken.
+        # Returns validator of the response to send next time
+        validator = validator or HttpValidator()
+        headers = validator.headers()
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                with self.stream(path, headers, (200, 304)) as response:
+                    content = response.read() if response.status == 200 else None
+                    # 304 may repeat validators or leave them out
+                    received = HttpValidator(etag=response.getheader('ETag') or validator.etag,
+                                             last_modified=response.getheader('Last-Modified') or
+                                             validator.last_modified)
+                if len(headers) != 0:
+                    get_metrics().increment('conditional_requests_total', host=self.host,
+                                            outcome='modified' if content is not None else 'not_modified')
+                if content is not None:
+                    get_metrics().increment('downloaded_bytes_total', len(content), host=self.host)
+                    if self.shaper is not None:
+                        self.shaper.throttle(self.host, len(content))
+                return content, received
+            except DownloadError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+                retry_after = e.retry_after
+            except (OSError, http.client.HTTPException):
+                if attempt == self.retries:
+                    raise
+            time.sleep(max(self.backoff * 2 ** attempt, retry_after or 0))
+
+    def _resume_offset(self, task: DownloadTask, hasher: MultiHasher) -> Tuple[int, Optional[str]]:
+        # Size of partial file kept from interrupted download and its validator. Without validator or hashes
+        # a changed upstream file could not be told apart, so such downloads start over
+        journal = _read_journal(task.destination + JOURNAL_SUFFIX)
+        partial_path = task.destination + PARTIAL_SUFFIX
+        if journal is None or not journal.matches(task) or not os.path.isfile(partial_path) \
+                or (journal.validator is None and len(task.hashes) == 0):
+            return 0, None
+        if task.size is not None and os.path.getsize(partial_path) > task.size:
+            return 0, None
+
+        return _hash_prefix(partial_path, hasher), journal.validator
+
+    def _download_once(self, task: DownloadTask) -> Tuple[int, int, Dict[str, str]]:
+        # Returns downloaded bytes, resumed bytes and digests
+        os.makedirs(os.path.dirname(task.destination) or '.', exist_ok=True)
+        partial_path = task.destination + PARTIAL_SUFFIX
+        hasher = MultiHasher(task.hashes)
+        offset, validator = self._resume_offset(task, hasher)
+        downloaded_bytes = 0
+        # Where transfer time goes besides network, a few clock reads per chunk cost nothing next to the chunk
+        write_seconds = hash_seconds = 0.0
+
+        headers: Dict[str, str] = {}
+        if offset != 0:
+            headers['Range'] = f'bytes={offset}-'
+            if validator is not None:
+                headers['If-Range'] = validator
+        # Whole file may have been written before the crash, only renaming was left
+        if offset == 0 or offset != task.size:
+            try:
+                with self.stream(task.path, headers, (200, 206)) as response:
+                    if response.status == 206:
+                        content_range = CONTENT_RANGE.match(response.getheader('Content-Range', ''))
+                        if content_range is None or int(content_range.group(1)) != offset:
+                            _discard_partial(task)
+                            raise DownloadError(f'{task.path}: unexpected range {content_range}')
+                    else:
+                        # Server ignored range or file has changed since
+                        offset = 0
+                        hasher = MultiHasher(task.hashes)
+                        _write_journal(task.destination + JOURNAL_SUFFIX, PartialJournal(
+                            path=task.path, size=task.size, hashes=task.hashes,
+                            validator=response.getheader('ETag') or response.getheader('Last-Modified')))
+
+                    with open(partial_path, 'ab' if offset != 0 else 'wb') as fp:
+                        while True:
+                            chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            start = time.perf_counter()
+                            fp.write(chunk)
+                            written = time.perf_counter()
+                            hasher.update(chunk)
+                            hash_seconds += time.perf_counter() - written
+                            write_seconds += written - start
+                            downloaded_bytes += len(chunk)
+                            if self.shaper is not None:
+                                self.shaper.throttle(self.host, len(chunk))
+            except DownloadError as e:
+                if e.status != 416:
+                    raise
+                # Kept prefix is longer than upstream file, next attempt starts over
+                _discard_partial(task)
+                raise DownloadError(str(e)) from e
+            finally:
+                metrics = get_metrics()
+                metrics.increment('downloaded_bytes_total', downloaded_bytes, host=self.host)
+                metrics.increment('write_seconds_total', write_seconds)
+                metrics.increment('hash_seconds_total', hash_seconds, source='download')
+                metrics.increment('hashed_bytes_total', downloaded_bytes, source='download')
+
+        size = offset + downloaded_bytes
+        if task.size is not None and size != task.size:
+            if size > task.size:
+                _discard_partial(task)
+            raise DownloadError(f'{task.path}: expected {task.size} bytes, got {size}')
+        mismatches = hasher.mismatches(task.hashes)
+        if len(mismatches) != 0:
+            _discard_partial(task)
+            raise DownloadError(f'{task.path}: {", ".join(mismatches)} mismatch')
+        os.replace(partial_path, task.destination)
+        _discard_partial(task)
+
+        return downloaded_bytes, offset, hasher.hexdigests()
+
+    def download(self, task: DownloadTask) -> DownloadResult:
+        metrics = get_metrics()
+        if self.concurrency is None:
+            result = self._download(task)
+        else:
+            self.concurrency.acquire()
+            downloaded_bytes = 0
+            try:
+                result = self._download(task)
+                downloaded_bytes = result.downloaded_bytes
+            finally:
+                self.concurrency.release(downloaded_bytes)
+                metrics.set_gauge('download_concurrency', self.concurrency.limit, host=self.host)
+        metrics.increment('downloads_total', outcome='complete' if result.attempts == 0
+                          else 'success' if result.success else 'failed')
+        metrics.increment('download_attempts_total', result.attempts)
+        metrics.increment('resumed_bytes_total', result.resumed_bytes, host=self.host)
+
+        return result
+
+    def _download(self, task: DownloadTask) -> DownloadResult:
+        # Complete and verified files are never transferred again
+        hashes = is_complete(task)
+        if hashes is not None:
+            return DownloadResult(task=task, success=True, attempts=0, hashes=hashes)
+
+        error: Optional[str] = None
+        for attempt in range(1, self.retries + 2):
+            retry_after = None
+            try:
+                downloaded_bytes, resumed_bytes, hashes = self._download_once(task)
+                return DownloadResult(task=task, success=True, attempts=attempt, downloaded_bytes=downloaded_bytes,
+                                      resumed_bytes=resumed_bytes, hashes=hashes)
+            except DownloadError as e:
+                error = str(e)
+                if not e.retryable:
+                    return DownloadResult(task=task, success=False, attempts=attempt, error=error)
+                retry_after = e.retry_after
+                if e.status in CONGESTION_STATUSES and self.concurrency is not None:
+                    self.concurrency.congestion()
+            except (OSError, http.client.HTTPException) as e:
+                error = f'{task.path}: {e!r}'
+                if self.concurrency is not None:
+                    self.concurrency.congestion()
+            if attempt <= self.retries:
+                time.sleep(max(self.backoff * 2 ** (attempt - 1), retry_after or 0))
+
+        return DownloadResult(task=task, success=False, attempts=self.retries + 1, error=error)
+
+    def download_all(self, tasks: Iterable[DownloadTask]) -> List[DownloadResult]:
+        # Results are in the same order as tasks
+        tasks = list(tasks)
+        metrics = get_metrics()
+        # Tasks waiting for a worker
+        queued = [len(tasks)]
+        lock = threading.Lock()
+
+        def download(task: DownloadTask) -> DownloadResult:
+            if metrics.enabled:
+                with lock:
+                    queued[0] -= 1
+                    metrics.set_gauge('download_queue_depth', queued[0], host=self.host)
+            return self.download(task)
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            return list(executor.map(download, tasks))
+
+
+def package_tasks(packages: Iterable[AnyPackage], mirror_root: str) -> List[DownloadTask]:
+    return [DownloadTask(path=it.filename, destination=safe_join(mirror_root, it.filename), size=it.size,
+                         hashes=it.hashes) for it in packages]
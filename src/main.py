@@ -1,5 +1,434 @@
-def main():
-    print('hi')
+import argparse
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Sequence
+
+from by_hash import DEFAULT_RETAINED_RELEASES, by_hash_path, fetch_indexes, publish_named, retain_by_hash
+from cache import DEFAULT_MAX_CACHE_BYTES, IndexCache
+from closure import DEPENDENCY_FIELDS, dependency_closure, read_seeds
+from compression import index_variants, iter_index_packages, select_index_variant
+from dedup import DedupIndex, link_duplicates, unique_tasks
+from downloader import DownloadTask, Downloader, HttpValidator, package_tasks
+from metrics import Metrics, get_metrics, profile_hook, set_metrics
+from mirrors import MirrorSet
+from packages import AnyPackage, latest_versions
+from pool_gc import MirrorLock, collect_garbage
+from publish import SnapshotPublisher
+from release import FileHashInfo, Release, parse_release
+from shaping import RateSchedule, Shaper, parse_host_rate_limits
+from state import MirrorState
+from sync import plan_downloads, plan_sync
+from tools import safe_join, write_atomically
+from verify import VerifyEntry, hash_file, verify_files
+
+# Files signing Release, fetched and published along with it
+SIGNATURE_FILES = ('InRelease', 'Release.gpg')
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Mirror a Debian suite')
+    parser.add_argument('mirror', help='Upstream mirror URL, e.g. http://deb.debian.org/debian')
+    parser.add_argument('destination', help='Local mirror root')
+    parser.add_argument('--mirror', dest='mirrors', action='append', default=[],
+                        help='Equivalent upstream mirror, may be repeated. Files are spread over mirrors serving the '
+                             'newest Release in proportion to their throughput, failed files are tried on others')
+    parser.add_argument('--suite', required=True)
+    parser.add_argument('--component', dest='components', action='append',
+                        help='Component to mirror, may be repeated. Default: every component in Release')
+    parser.add_argument('--architecture', dest='architectures', action='append', required=True,
+                        help='Architecture to mirror, may be repeated')
+    parser.add_argument('--parallelism', type=int, default=8, help='Parallel downloads in total and per mirror')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Grow parallel connections up to --parallelism while throughput grows, back off on '
+                             'errors and 429/503 responses')
+    parser.add_argument('--rate-limit', dest='rate_limits', action='append', default=[],
+                        help='Total bandwidth limit in bytes per second with K/M/G suffixes, optionally for a time '
+                             'of day, e.g. 08:00-18:00=10M. May be repeated, first matching window applies')
+    parser.add_argument('--host-rate-limit', dest='host_rate_limits', action='append', default=[],
+                        help='Bandwidth limit of one upstream host, e.g. deb.debian.org,08:00-18:00=2M')
+    parser.add_argument('--verify-pool', action='store_true',
+                        help='Check SHA256 of pool files already present instead of only their sizes. With --state '
+                             'pool files are only checked with it, otherwise recorded ones are trusted')
+    parser.add_argument('--keep-versions', type=int,
+                        help='Only mirror given number of newest versions of every package. Default: all versions')
+    parser.add_argument('--seeds', help='File listing packages to mirror, one per line. Only their dependency '
+                                        'closure is mirrored when given')
+    parser.add_argument('--with-recommends', action='store_true', help='Follow Recommends of seed closure')
+    parser.add_argument('--metrics', help='Write metrics of the run to given file: Prometheus textfile if it ends '
+                                          'with .prom, JSON otherwise')
+    parser.add_argument('--profile', help='Directory for cProfile output of every sync phase')
+    parser.add_argument('--snapshots', type=int, help='Publish dists/<suite> as a symlink to snapshot directories, '
+                                                      'flipped once a sync is complete, and keep given number of '
+                                                      'them. Default: update dists/<suite> in place')
+    parser.add_argument('--index-cache', help='Directory caching parsed indexes by SHA256, so unchanged indexes are '
+                                              'not decompressed and parsed again. Not used with --state, which keeps '
+                                              'parsed packages itself')
+    parser.add_argument('--index-cache-size', type=int, default=DEFAULT_MAX_CACHE_BYTES // 1024 ** 2,
+                        help='Size limit of index cache in MiB, least recently used indexes are removed over it')
+    parser.add_argument('--by-hash-releases', type=int, default=DEFAULT_RETAINED_RELEASES,
+                        help='Keep by-hash indexes listed by given number of newest Releases of the suite')
+    parser.add_argument('--gc', action='store_true',
+                        help='Remove pool files no suite or retained snapshot references after a complete sync')
+    parser.add_argument('--state', help='SQLite state file. Unchanged indexes are not re-parsed and the pool '
+                                        'is not re-scanned when given. Pool files are only deduplicated across '
+                                        'suites with it, without it only within the synced suite')
+
+    return parser.parse_args(argv)
+
+
+def index_cache(arguments: argparse.Namespace) -> Optional[IndexCache]:
+    if arguments.index_cache is None:
+        return None
+    return IndexCache(arguments.index_cache, arguments.index_cache_size * 1024 ** 2)
+
+
+def read_index(task: DownloadTask, keep_versions: Optional[int] = None,
+               cache: Optional[IndexCache] = None) -> Sequence[AnyPackage]:
+    if not os.path.exists(task.destination):
+        return []
+    # Fetched indexes were verified against SHA256 of task. Tasks without one are hashed, e.g. named paths still
+    # holding the previous index
+    sha256 = None
+    if cache is not None:
+        sha256 = task.hashes.get('SHA256') or hash_file(task.destination, ['SHA256'])['SHA256']
+    packages = cache.load(sha256) if cache is not None else None
+    if packages is None:
+        with open(task.destination, 'rb') as fp:
+            packages = list(iter_index_packages(fp, task.path, record_type='compact'))
+        if cache is not None:
+            cache.store(sha256, packages)
+    if keep_versions is not None:
+        packages = latest_versions(packages, keep_versions)
+
+    return packages
+
+
+def read_indexes(index_tasks: List[DownloadTask], arguments: argparse.Namespace,
+                 cache: Optional[IndexCache] = None) -> List[Sequence[AnyPackage]]:
+    # Packages of every index, restricted to dependency closure of seeds if there are any
+    packages_by_index = [read_index(it, arguments.keep_versions, cache) for it in index_tasks]
+    if arguments.seeds is None:
+        return packages_by_index
+    # Cached indexes decode new objects on every access, closure is matched against the same ones
+    packages_by_index = [list(it) for it in packages_by_index]
+
+    fields = DEPENDENCY_FIELDS + (('recommends',) if arguments.with_recommends else ())
+    closure = dependency_closure((it for packages in packages_by_index for it in packages),
+                                 read_seeds(arguments.seeds), fields)
+    selected = {id(it) for it in closure}
+
+    return [[it for it in packages if id(it) in selected] for packages in packages_by_index]
+
+
+def plan_with_state(state: MirrorState, dists_path: str, index_tasks: List[DownloadTask],
+                    index_sha256s: List[Optional[str]], arguments: argparse.Namespace) -> List[DownloadTask]:
+    mirror_root = arguments.destination
+    index_filepaths = [os.path.relpath(it.path, dists_path) for it in index_tasks]
+    config = selection_config(arguments)
+    # Index cache is not used, its records only hold fields the planner needs while state keeps whole packages
+    if arguments.seeds is not None:
+        # Closure depends on every index and on seeds, so all indexes are recorded again
+        for filepath, sha256, packages in zip(index_filepaths, index_sha256s, read_indexes(index_tasks, arguments)):
+            state.record_index(dists_path, filepath, sha256, packages, config)
+    else:
+        for task, filepath, sha256 in zip(index_tasks, index_filepaths, index_sha256s):
+            # Packages of unchanged index selected with the same options are already in state
+            if sha256 is None or state.index_sha256(dists_path, filepath, config) != sha256:
+                state.record_index(dists_path, filepath, sha256, read_index(task, arguments.keep_versions), config)
+    state.retain_indexes(dists_path, index_filepaths)
+    if arguments.verify_pool:
+        # Files changed or removed on disk since they were recorded are forgotten, so they are planned again.
+        # Every recorded file of the suite is stat-ed, otherwise state is trusted and pool is not touched
+        state.forget_pool_files(state.stale_filenames(mirror_root, state.recorded_files(dists_path)))
+
+    tasks: List[DownloadTask] = []
+    already_present: List[str] = []
+    for filename, (size, hashes) in state.missing_files(dists_path).items():
+        destination = safe_join(mirror_root, filename)
+        # Files unknown to state are checked by size, e.g. after switching an existing mirror to state file
+        if os.path.isfile(destination) and os.path.getsize(destination) == size:
+            already_present.append(filename)
+        else:
+            tasks.append(DownloadTask(path=filename, destination=destination, size=size, hashes=hashes))
+    state.record_pool_files_from_disk(mirror_root, already_present)
+    if arguments.verify_pool:
+        # Every present file is hashed, damage keeping size and mtime is only found this way
+        recorded = {filename: it for filename, it in state.recorded_files(dists_path).items() if len(it[1]) != 0}
+        results = verify_files(mirror_root, [VerifyEntry(path=filename, size=size, hashes=hashes)
+                                             for filename, (size, hashes) in recorded.items()])
+        verified = {it.path: recorded[it.path][1]['SHA256'] for it in results if it.status == 'ok'}
+        mismatched = [it.path for it in results if it.status != 'ok']
+        state.record_pool_files_from_disk(mirror_root, verified, verified)
+        state.forget_pool_files(mismatched)
+        tasks.extend(DownloadTask(path=it, destination=safe_join(mirror_root, it), size=recorded[it][0],
+                                  hashes=recorded[it][1]) for it in mismatched)
+
+    return tasks
+
+
+def plan_without_state(index_tasks: List[DownloadTask], previous_packages: List[AnyPackage],
+                       arguments: argparse.Namespace, dedup_index: DedupIndex) -> List[DownloadTask]:
+    packages = [it for index_packages in read_indexes(index_tasks, arguments, index_cache(arguments))
+                for it in index_packages]
+    dedup_index.add_packages(packages)
+    plan = plan_sync(previous_packages, packages)
+    to_download = plan_downloads(plan, arguments.destination, arguments.verify_pool)
+    print(f'{len(packages)} packages in {len(index_tasks)} indexes: {len(plan.added)} added, '
+          f'{len(plan.removed)} removed')
+
+    return package_tasks(to_download, arguments.destination)
+
+
+def _fingerprint(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def _selection(arguments: argparse.Namespace) -> dict:
+    return {
+        'keep_versions': arguments.keep_versions,
+        'seeds': sorted(read_seeds(arguments.seeds)) if arguments.seeds is not None else None,
+        'with_recommends': arguments.with_recommends,
+    }
+
+
+def selection_config(arguments: argparse.Namespace) -> str:
+    # Fingerprint of options selecting packages of an index. Packages recorded in state are reused only for the
+    # same one, e.g. older versions have to be planned again once --keep-versions is dropped
+    return _fingerprint(_selection(arguments))
+
+
+def sync_config(arguments: argparse.Namespace) -> str:
+    # Fingerprint of options selecting what is mirrored. A complete sync is skipped only for the same one, e.g. an
+    # architecture added since has to be fetched even though Release did not change
+    return _fingerprint({
+        'components': sorted(arguments.components) if arguments.components is not None else None,
+        'architectures': sorted(arguments.architectures),
+        **_selection(arguments),
+    })
+
+
+def release_unchanged(previous: Optional[Release], release: Release) -> bool:
+    return previous is not None and previous.date == release.date and previous.files_by_hash == release.files_by_hash
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def fetch_signatures(downloader: MirrorSet, dists_path: str, mirror_root: str,
+                     validators: Dict[str, HttpValidator]) -> Dict[str, Optional[bytes]]:
+    # InRelease and Release.gpg by name, None for ones upstream does not have. Published ones are revalidated
+    # with validators, which are only given when published Release is the one of the last complete sync
+    signatures: Dict[str, Optional[bytes]] = {}
+    for name in SIGNATURE_FILES:
+        path = f'{dists_path}/{name}'
+        previous = _read_file(safe_join(mirror_root, path)) if len(validators) != 0 else None
+        signatures[name] = downloader.fetch_signature(path, validators, previous)
+
+    return signatures
+
+
+def write_release_files(root: str, release_content: bytes, signatures: Dict[str, Optional[bytes]]) -> None:
+    # Unchanged files are left as they are. Signatures upstream does not publish anymore are removed, they would
+    # not match Release
+    for name, content in [*signatures.items(), ('Release', release_content)]:
+        path = os.path.join(root, name)
+        if content is None:
+            if os.path.lexists(path):
+                os.remove(path)
+        elif _read_file(path) != content:
+            # Replaced atomically, clients never read half-written Release
+            write_atomically(path, content)
+
+
+def main(argv: List[str]) -> int:
+    arguments = parse_arguments(argv)
+    if arguments.metrics is not None or arguments.profile is not None:
+        set_metrics(Metrics([profile_hook(arguments.profile)] if arguments.profile is not None else []))
+    state = MirrorState(arguments.state) if arguments.state is not None else None
+    # Syncs of other suites may run along, garbage collection waits for them
+    lock = MirrorLock(arguments.destination)
+    lock.shared()
+    try:
+        return mirror(arguments, state, lock)
+    finally:
+        lock.close()
+        if state is not None:
+            state.close()
+        if arguments.metrics is not None:
+            get_metrics().write(arguments.metrics)
+        set_metrics(None)
+
+
+def mirror(arguments: argparse.Namespace, state: Optional[MirrorState], lock: MirrorLock) -> int:
+    dists_path = f'dists/{arguments.suite}'
+    config = sync_config(arguments)
+
+    metrics = get_metrics()
+    shaper = None
+    if len(arguments.rate_limits) != 0 or len(arguments.host_rate_limits) != 0:
+        shaper = Shaper(RateSchedule.parse(arguments.rate_limits), parse_host_rate_limits(arguments.host_rate_limits))
+    downloaders = [Downloader(it, parallelism=arguments.parallelism, retries=arguments.retries, shaper=shaper,
+                              adaptive=arguments.adaptive) for it in [arguments.mirror, *arguments.mirrors]]
+    release_path = f'{dists_path}/Release'
+    published_release_path = safe_join(arguments.destination, release_path)
+    with MirrorSet(downloaders, arguments.parallelism) as downloader:
+        # Release of the last complete sync is revalidated with If-None-Match and If-Modified-Since, a 304
+        # stands for published Release then
+        completed_release = state.completed_release(dists_path, config) if state is not None else None
+        previous_content: Optional[bytes] = None
+        validators: Dict[str, HttpValidator] = {}
+        if completed_release is not None and os.path.isfile(published_release_path):
+            previous_content = _read_file(published_release_path)
+            validators = state.http_validators(it.url(f'{dists_path}/{name}') for it in downloaders
+                                               for name in ('Release', *SIGNATURE_FILES))
+        with metrics.phase('release'):
+            release_content = downloader.probe(release_path, validators, previous_content)
+            release = parse_release(release_content.decode())
+            signatures = fetch_signatures(downloader, dists_path, arguments.destination, validators)
+        for it in downloader.skipped():
+            print(f'Skipping mirror {it}', file=sys.stderr)
+        if release_unchanged(completed_release, release):
+            print('Release not modified since last complete sync' if downloader.not_modified()
+                  else 'Release has the same date and files as last complete sync')
+            write_release_files(safe_join(arguments.destination, dists_path), release_content, signatures)
+            state.record_http_validators(downloader.release_validators(release_path))
+            return 0
+
+        publisher = SnapshotPublisher(arguments.destination, dists_path, arguments.snapshots) \
+            if arguments.snapshots is not None else None
+        try:
+            return sync(arguments, state, downloader, release, release_content, signatures, publisher, config,
+                        lock)
+        finally:
+            if publisher is not None:
+                publisher.discard()
+
+
+def sync(arguments: argparse.Namespace, state: Optional[MirrorState], downloader: MirrorSet, release: Release,
+         release_content: bytes, signatures: Dict[str, Optional[bytes]], publisher: Optional[SnapshotPublisher],
+         config: str, lock: MirrorLock) -> int:
+    dists_path = f'dists/{arguments.suite}'
+    release_path = f'{dists_path}/Release'
+    metrics = get_metrics()
+    live_root = safe_join(arguments.destination, dists_path)
+    # Indexes and Release go to the staged snapshot, served dists/<suite> keeps the previous sync until publishing
+    publish_root = publisher.stage() if publisher is not None else live_root
+
+    index_files: List[FileHashInfo] = []
+    index_tasks: List[DownloadTask] = []
+    live_tasks: List[DownloadTask] = []
+    for component in arguments.components or release.components:
+        for architecture in arguments.architectures:
+            index_path = f'{component}/binary-{architecture}/Packages'
+            # Not every component is built for every architecture
+            if len(index_variants(release, index_path, 'SHA256')) == 0:
+                print(f'Skipping {dists_path}/{index_path}: not listed in Release', file=sys.stderr)
+                continue
+            variant = select_index_variant(release, index_path, 'SHA256')
+            # Named path still holds the previous index until Release is written, fetched one is read by hash
+            task = DownloadTask(path=f'{dists_path}/{variant.filepath}', size=variant.filesize,
+                                destination=safe_join(publish_root, by_hash_path(variant.filepath, variant.hashsum)),
+                                hashes={'SHA256': variant.hashsum})
+            index_files.append(variant)
+            index_tasks.append(task)
+            # Named path holds the previous index, SHA256 of the new one does not describe it
+            live_tasks.append(task.model_copy(update={'destination': safe_join(live_root, variant.filepath),
+                                                      'hashes': {}}))
+    index_sha256s: List[Optional[str]] = [it.hashsum for it in index_files]
+    # Indexes from previous sync, if any, are read before being overwritten
+    previous_packages: List[AnyPackage] = []
+    if state is None:
+        with metrics.phase('previous_indexes'):
+            for index_packages in read_indexes(live_tasks, arguments, index_cache(arguments)):
+                previous_packages.extend(index_packages)
+    with metrics.phase('indexes'):
+        index_results = fetch_indexes(downloader, dists_path, index_files, arguments.destination,
+                                      release.acquire_by_hash, publish_root=publish_root)
+    failed_indexes = [it for it in index_results if not it.success]
+    if len(failed_indexes) != 0:
+        for it in failed_indexes:
+            print(f'Failed to fetch index: {it.error}', file=sys.stderr)
+        return 1
+
+    with metrics.phase('plan'):
+        # Files of identical content under different names are downloaded once and linked afterwards. Content
+        # already stored under another name is not downloaded at all. Index holds packages of every suite with
+        # state, of this suite only without it
+        dedup_index = DedupIndex()
+        if state is not None:
+            state.record_release(dists_path, release)
+            tasks = plan_with_state(state, dists_path, index_tasks, index_sha256s, arguments)
+            dedup_index.add_files(state.package_files())
+            dedup_index.verified.update(state.verified_sha256s(
+                it for filenames in dedup_index.duplicates().values() for it in filenames))
+        else:
+            tasks = plan_without_state(index_tasks, previous_packages, arguments, dedup_index)
+        tasks = unique_tasks(tasks, dedup_index, arguments.destination)
+    print(f'{len(tasks)} files to download')
+
+    with metrics.phase('download'):
+        results = downloader.download_all(tasks)
+    failed = [it for it in results if not it.success]
+    for it in failed:
+        print(f'Failed to fetch: {it.error}', file=sys.stderr)
+    print(f'Downloaded {sum(it.downloaded_bytes for it in results)} bytes, '
+          f'{sum(it.resumed_bytes for it in results)} resumed, {len(failed)} failed')
+    with metrics.phase('link'):
+        # Downloads are verified inline, so they are valid link sources
+        dedup_index.verified.update({it.task.path: it.hashes['SHA256'] for it in results
+                                     if it.success and 'SHA256' in it.hashes})
+        linked = link_duplicates(dedup_index, arguments.destination)
+    if len(linked.linked) != 0:
+        print(f'Linked {len(linked.linked)} duplicate files, {linked.saved_bytes} bytes saved')
+
+    with metrics.phase('publish'):
+        if state is not None:
+            # Downloads are verified inline, so their SHA256 is recorded as verified
+            state.record_pool_files_from_disk(arguments.destination,
+                                              [it.task.path for it in results if it.success],
+                                              {it.task.path: it.hashes.get('SHA256')
+                                               for it in results if it.success})
+            state.record_pool_files_from_disk(arguments.destination, linked.linked,
+                                              {it: dedup_index.verified.get(it) for it in linked.linked})
+
+        # Release listing files that failed would send clients to missing ones, previous Release stays served.
+        # Staged snapshot is discarded by the caller
+        if len(failed) != 0:
+            print(f'Not publishing {release_path}, {len(failed)} files failed', file=sys.stderr)
+            return 1
+        # Named indexes are switched right before Release and its signatures, which are published last so clients
+        # never see them before their indexes
+        publish_named(arguments.destination, dists_path, index_files, publish_root=publish_root)
+        write_release_files(publish_root, release_content, signatures)
+        linked_files = publisher.link_unchanged(release) if publisher is not None else 0
+        retain_by_hash(arguments.destination, dists_path, release_content, arguments.by_hash_releases,
+                       publish_root=publish_root)
+        if publisher is not None:
+            snapshot = publisher.publish()
+            removed = publisher.collect()
+            print(f'Published snapshot {os.path.basename(snapshot)}, {linked_files} files linked from previous '
+                  f'one, {len(removed)} old snapshots removed')
+        # Only a sync that fetched every file may be skipped next time
+        if state is not None:
+            state.record_completed_release(dists_path, release, config)
+            state.record_http_validators(downloader.release_validators(release_path))
+
+    if arguments.gc:
+        lock.exclusive()
+        report = collect_garbage(arguments.destination)
+        if state is not None:
+            state.forget_pool_files(report.unreferenced)
+        print(f'Removed {len(report.unreferenced)} unreferenced pool files, {report.reclaimed_bytes} bytes reclaimed')
+
+    return 0
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main(sys.argv[1:]))
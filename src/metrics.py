@@ -0,0 +1,191 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from tools import write_atomically
+
+METRIC_PREFIX = 'mirror_'
+# Upper bounds in seconds, wide enough for both stanza validation and multi-GB downloads
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+# Called with phase name, returned context manager wraps the phase, e.g. profiler or tracing span
+PhaseHook = Callable[[str], ContextManager[Any]]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Count of observations per bucket, last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        counts: List[int] = []
+        total = 0
+        for it in self.counts:
+            total += it
+            counts.append(total)
+
+        return counts
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if len(pairs) == 0:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metrics:
+    # Counters, gauges and histograms keyed by name and labels. Thread safe
+    enabled = True
+
+    def __init__(self, phase_hooks: Optional[List[PhaseHook]] = None):
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.phase_hooks: List[PhaseHook] = phase_hooks or []
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            histograms = self.histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        with ExitStack() as stack:
+            for hook in self.phase_hooks:
+                stack.enter_context(hook(name))
+            with self.timer('phase_seconds', phase=name):
+                yield
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'counters': {name: [{'labels': dict(key), 'value': value} for key, value in values.items()]
+                             for name, values in self.counters.items()},
+                'gauges': {name: [{'labels': dict(key), 'value': value} for key, value in values.items()]
+                           for name, values in self.gauges.items()},
+                'histograms': {name: [{'labels': dict(key), 'count': it.count, 'sum': it.sum,
+                                       'buckets': dict(zip([*map(str, it.buckets), '+Inf'], it.cumulative_counts()))}
+                                      for key, it in values.items()]
+                               for name, values in self.histograms.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        # Text exposition format, e.g. for node_exporter textfile collector
+        lines: List[str] = []
+        with self._lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name, values in sorted(metrics.items()):
+                    lines.append(f'# TYPE {METRIC_PREFIX}{name} {kind}')
+                    for key, value in sorted(values.items()):
+                        lines.append(f'{METRIC_PREFIX}{name}{_format_labels(key)} {value}')
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {METRIC_PREFIX}{name} histogram')
+                for key, histogram in sorted(histograms.items()):
+                    bounds = [*map(str, histogram.buckets), '+Inf']
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append(f'{METRIC_PREFIX}{name}_bucket{_format_labels(key, (("le", bound),))} {count}')
+                    lines.append(f'{METRIC_PREFIX}{name}_sum{_format_labels(key)} {histogram.sum}')
+                    lines.append(f'{METRIC_PREFIX}{name}_count{_format_labels(key)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        # '.prom' files get Prometheus format, anything else JSON. Replaced atomically, so a collector never
+        # reads half-written file
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.to_json(), indent=2)
+        write_atomically(path, content.encode())
+
+
+class NullMetrics(Metrics):
+    # Default registry. Every call is a no-op, hot paths check `enabled` before doing extra work
+    enabled = False
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        pass
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        pass
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        pass
+
+    def timer(self, name: str, **labels: Any) -> ContextManager[None]:
+        return nullcontext()
+
+    def phase(self, name: str) -> ContextManager[None]:
+        return nullcontext()
+
+
+def profile_hook(directory: str) -> PhaseHook:
+    # cProfile of every phase is written to '<directory>/<phase>.prof'. Only the thread running the phase
+    # is profiled, not download workers
+    os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def hook(name: str) -> Iterator[None]:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(directory, f'{name}.prof'))
+
+    return hook
+
+
+_metrics: Metrics = NullMetrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Optional[Metrics]) -> Metrics:
+    # None disables metrics. Returns registry in use
+    global _metrics
+    _metrics = metrics if metrics is not None else NullMetrics()
+    return _metrics
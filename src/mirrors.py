@@ -0,0 +1,227 @@
+import http.client
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from downloader import DownloadError, DownloadResult, DownloadTask, Downloader, HttpValidator
+from metrics import get_metrics
+from release import Release, parse_release
+
+# Weight of the latest download in throughput estimate of a mirror
+THROUGHPUT_SMOOTHING = 0.3
+# Mirror failing this many files in a row is only used when no other mirror is left
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+class MirrorProbe(BaseModel):
+    url: str
+    release: Optional[Release] = None
+    content: bytes = b''
+    seconds: float = 0.0
+    error: Optional[str] = None
+    # Validator of Release response and whether Release was not modified since previous content
+    validator: Optional[HttpValidator] = None
+    not_modified: bool = False
+
+
+def probe_mirror(downloader: Downloader, release_path: str, validator: Optional[HttpValidator] = None,
+                 previous: Optional[bytes] = None) -> MirrorProbe:
+    # Validator is only sent along with previous content, which stands in for Release on 304
+    start = time.perf_counter()
+    try:
+        content, received = downloader.fetch_conditional(release_path, validator if previous is not None else None)
+        not_modified = content is None
+        if content is None:
+            content = previous
+        release = parse_release(content.decode())
+    except (DownloadError, OSError, http.client.HTTPException, AssertionError, ValueError) as e:
+        return MirrorProbe(url=downloader.base_url, error=f'{downloader.base_url}: {e!r}')
+
+    return MirrorProbe(url=downloader.base_url, release=release, content=content,
+                       seconds=time.perf_counter() - start, validator=received, not_modified=not_modified)
+
+
+def _index_hashes(release: Release) -> FrozenSet[Tuple[str, Optional[str]]]:
+    return frozenset((it.filepath, it.hashes.get('SHA256')) for it in release.files.values())
+
+
+def fresh_mirrors(probes: List[MirrorProbe]) -> List[int]:
+    # Positions of mirrors serving the newest Release. Mirrors with the same date but different index hashes
+    # are in the middle of an update, the first mirror listed wins then
+    reference: Optional[MirrorProbe] = None
+    for it in probes:
+        if it.release is not None and (reference is None or it.release.date > reference.release.date):
+            reference = it
+    if reference is None:
+        return []
+
+    hashes = _index_hashes(reference.release)
+    return [position for position, it in enumerate(probes) if it.release is not None
+            and it.release.date == reference.release.date and _index_hashes(it.release) == hashes]
+
+
+class MirrorSet:
+    # Equivalent upstream mirrors. Files are spread over fresh mirrors in proportion to their measured
+    # throughput, a file failed on one mirror is tried on the others. Every file is checked against SHA256
+    # of the index, so files of one sync may come from different mirrors
+    def __init__(self, downloaders: List[Downloader], parallelism: int, rng: Optional[random.Random] = None):
+        assert len(downloaders) != 0, 'No mirrors given'
+        self.downloaders = downloaders
+        self.parallelism = parallelism
+        self.rng = rng or random.Random()
+        # Bytes per second, None until the mirror has been measured
+        self.throughputs: List[Optional[float]] = [None] * len(downloaders)
+        self.failures = [0] * len(downloaders)
+        self.fresh = list(range(len(downloaders)))
+        self.probes: List[MirrorProbe] = []
+        # Validators of files signing Release fetched since the last probe, by URL
+        self.signature_validators: Dict[str, HttpValidator] = {}
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        for it in self.downloaders:
+            it.close()
+
+    def __enter__(self) -> 'MirrorSet':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def probe(self, release_path: str, validators: Optional[Dict[str, HttpValidator]] = None,
+              previous: Optional[bytes] = None) -> bytes:
+        # Fetches Release from every mirror, keeps mirrors serving the newest one and returns its content.
+        # validators are by Release URL, mirrors answering 304 serve previous content
+        validators = validators or {}
+        with ThreadPoolExecutor(max_workers=len(self.downloaders)) as executor:
+            probes = list(executor.map(
+                lambda it: probe_mirror(it, release_path, validators.get(it.url(release_path)), previous),
+                self.downloaders))
+        self.probes = probes
+        self.signature_validators = {}
+        self.fresh = fresh_mirrors(probes)
+        if len(self.fresh) == 0:
+            raise DownloadError('; '.join(it.error for it in probes if it.error is not None), retryable=False)
+
+        for position in self.fresh:
+            # 304 transfers no Release, its content would make mirror look as fast as it answers
+            if not probes[position].not_modified:
+                self._record_success(position, len(probes[position].content), probes[position].seconds)
+
+        return probes[self.fresh[0]].content
+
+    def skipped(self) -> List[str]:
+        # Reasons mirrors of the last probe are not used, one per skipped mirror
+        reasons: List[str] = []
+        for position, it in enumerate(self.probes):
+            if it.error is not None:
+                reasons.append(it.error)
+            elif position not in self.fresh:
+                reasons.append(f'{it.url}: stale Release of {it.release.date}')
+
+        return reasons
+
+    def not_modified(self) -> bool:
+        # Every fresh mirror answered 304 to the last probe
+        return len(self.probes) != 0 and all(self.probes[it].not_modified for it in self.fresh)
+
+    def release_validators(self, release_path: str) -> Dict[str, HttpValidator]:
+        # Validators of the last probe and of signatures fetched since, by URL
+        validators = {downloader.url(release_path): it.validator
+                      for downloader, it in zip(self.downloaders, self.probes) if it.validator is not None}
+        validators.update(self.signature_validators)
+
+        return validators
+
+    def fetch_signature(self, path: str, validators: Optional[Dict[str, HttpValidator]] = None,
+                        previous: Optional[bytes] = None) -> Optional[bytes]:
+        # InRelease or Release.gpg from the mirror returned Release was taken from, so it signs the same content.
+        # Mirror answering 304 serves previous content, None when the mirror does not have the file
+        assert len(self.fresh) != 0, 'Mirrors have not been probed'
+        downloader = self.downloaders[self.fresh[0]]
+        url = downloader.url(path)
+        validator = (validators or {}).get(url) if previous is not None else None
+        try:
+            content, received = downloader.fetch_conditional(path, validator)
+        except DownloadError as e:
+            if e.status != 404:
+                raise
+            return None
+        self.signature_validators[url] = received
+
+        return previous if content is None else content
+
+    def _record_success(self, position: int, transferred_bytes: int, seconds: float) -> None:
+        throughput = transferred_bytes / max(seconds, 1e-6)
+        with self._lock:
+            self.failures[position] = 0
+            previous = self.throughputs[position]
+            self.throughputs[position] = throughput if previous is None \
+                else previous + THROUGHPUT_SMOOTHING * (throughput - previous)
+            current = self.throughputs[position]
+        get_metrics().set_gauge('upstream_throughput_bytes_per_second', current,
+                                host=self.downloaders[position].host)
+
+    def _record_failure(self, position: int) -> None:
+        with self._lock:
+            self.failures[position] += 1
+
+    def choose(self, exclude: Iterable[int] = ()) -> Optional[int]:
+        # Weighted random choice among fresh mirrors not in exclude. Unmeasured mirrors get the best
+        # throughput seen, so they are tried soon
+        excluded = set(exclude)
+        with self._lock:
+            candidates = [it for it in self.fresh if it not in excluded]
+            if len(candidates) == 0:
+                return None
+            healthy = [it for it in candidates if self.failures[it] < MAX_CONSECUTIVE_FAILURES]
+            candidates = healthy or candidates
+            measured = [self.throughputs[it] for it in candidates if self.throughputs[it] is not None]
+            default = max(measured, default=1.0)
+            weights = [self.throughputs[it] if self.throughputs[it] is not None else default for it in candidates]
+
+        return self.rng.choices(candidates, weights)[0]
+
+    def download(self, task: DownloadTask) -> DownloadResult:
+        tried: Set[int] = set()
+        attempts = 0
+        result: Optional[DownloadResult] = None
+        while True:
+            position = self.choose(tried)
+            if position is None:
+                break
+            if len(tried) != 0:
+                get_metrics().increment('failovers_total', host=self.downloaders[position].host)
+            tried.add(position)
+            start = time.perf_counter()
+            result = self.downloaders[position].download(task)
+            attempts += result.attempts
+            if result.success:
+                if result.attempts != 0:
+                    self._record_success(position, result.downloaded_bytes, time.perf_counter() - start)
+                break
+            self._record_failure(position)
+        assert result is not None
+
+        return result.model_copy(update={'attempts': attempts})
+
+    def download_all(self, tasks: Iterable[DownloadTask]) -> List[DownloadResult]:
+        # Results are in the same order as tasks
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            return list(executor.map(self.download, tasks))
+
+    def fetch_bytes(self, path: str) -> bytes:
+        # Fastest fresh mirror first, the others if it fails
+        with self._lock:
+            order = sorted(self.fresh, key=lambda it: -(self.throughputs[it] or 0.0))
+        for position in order[:-1]:
+            try:
+                return self.downloaders[position].fetch_bytes(path)
+            except (DownloadError, OSError, http.client.HTTPException):
+                self._record_failure(position)
+
+        return self.downloaders[order[-1]].fetch_bytes(path)
@@ -0,0 +1,125 @@
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, TypeVar, Union
+
+from compression import compression_extension, index_variants, iter_index_packages, select_index_variant
+from packages import STANZA_SEPARATOR, AnyPackage, iter_packages_buffer, parse_package, parse_package_file
+from release import Release
+
+K = TypeVar('K', bound=Hashable)
+
+# Chunks per worker. More chunks than workers evens out stanzas of different size
+CHUNKS_PER_WORKER = 4
+STANZA_SEPARATOR_TEXT = re.compile(STANZA_SEPARATOR.pattern.decode())
+
+
+def _worker_count(workers: Optional[int]) -> int:
+    if workers is None:
+        return os.cpu_count() or 1
+    assert workers > 0, f'Worker count should be positive: {workers}'
+
+    return workers
+
+
+def stanza_boundaries(content: Union[str, bytes, mmap.mmap], chunk_count: int) -> List[Tuple[int, int]]:
+    # Splits content into about chunk_count ranges, every range ends right after a stanza separator
+    separator = STANZA_SEPARATOR_TEXT if isinstance(content, str) else STANZA_SEPARATOR
+    length = len(content)
+    step = max(1, length // max(1, chunk_count))
+    ranges: List[Tuple[int, int]] = []
+
+    start = 0
+    while start < length:
+        match = separator.search(content, min(start + step, length))
+        end = length if match is None else match.end()
+        ranges.append((start, end))
+        start = end
+
+    return ranges
+
+
+def _parse_content_chunk(content: str, record_type: str) -> List[AnyPackage]:
+    return parse_package(content, record_type)
+
+
+def _parse_file_range(path: str, start: int, end: int, record_type: str,
+                      fields: Optional[List[str]]) -> List[AnyPackage]:
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        chunk = fp.read(end - start)
+
+    return list(iter_packages_buffer(chunk, fields, record_type))
+
+
+def _parse_index_file(path: str, record_type: str) -> List[AnyPackage]:
+    if len(compression_extension(path)) == 0:
+        return parse_package_file(path, record_type)
+    with open(path, 'rb') as fp:
+        return list(iter_index_packages(fp, path, record_type=record_type))
+
+
+def parse_package_parallel(content: str, workers: Optional[int] = None, record_type: str = 'pydantic',
+                           chunk_count: Optional[int] = None) -> List[AnyPackage]:
+    workers = _worker_count(workers)
+    chunk_count = chunk_count or workers * CHUNKS_PER_WORKER
+    chunks = [content[start:end] for start, end in stanza_boundaries(content, chunk_count)]
+    if workers == 1 or len(chunks) <= 1:
+        return parse_package(content, record_type)
+
+    packages: List[AnyPackage] = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() keeps chunk order, so result is the same as serial parse
+        for chunk_packages in executor.map(_parse_content_chunk, chunks, [record_type] * len(chunks)):
+            packages.extend(chunk_packages)
+
+    return packages
+
+
+def parse_package_file_parallel(path: str, workers: Optional[int] = None, record_type: str = 'pydantic',
+                                fields: Optional[Iterable[str]] = None,
+                                chunk_count: Optional[int] = None) -> List[AnyPackage]:
+    workers = _worker_count(workers)
+    fields = None if fields is None else list(fields)
+    if workers == 1 or os.path.getsize(path) == 0:
+        return parse_package_file(path, record_type, fields)
+
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        # Only stanza boundaries are looked up here, workers read their own ranges
+        ranges = stanza_boundaries(buffer, chunk_count or workers * CHUNKS_PER_WORKER)
+
+    packages: List[AnyPackage] = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_packages in executor.map(_parse_file_range, [path] * len(ranges), *zip(*ranges),
+                                           [record_type] * len(ranges), [fields] * len(ranges)):
+            packages.extend(chunk_packages)
+
+    return packages
+
+
+def parse_indexes_parallel(index_paths: Dict[K, str], workers: Optional[int] = None,
+                           record_type: str = 'pydantic') -> Dict[K, List[AnyPackage]]:
+    # Every index (possibly compressed) is parsed whole in its own worker
+    workers = _worker_count(workers)
+    keys = list(index_paths)
+    with ProcessPoolExecutor(max_workers=min(workers, max(1, len(keys)))) as executor:
+        results = executor.map(_parse_index_file, [index_paths[it] for it in keys], [record_type] * len(keys))
+
+        return dict(zip(keys, results))
+
+
+def release_index_paths(release: Release, dist_root: str, components: Optional[Iterable[str]] = None,
+                        architectures: Optional[Iterable[str]] = None) -> Dict[Tuple[str, str, str], str]:
+    # (suite, component, architecture) -> local path of the smallest Packages variant listed in release
+    index_paths: Dict[Tuple[str, str, str], str] = {}
+    for component in components or release.components:
+        for architecture in architectures or release.architectures:
+            index_path = f'{component}/binary-{architecture}/Packages'
+            # Not every component is built for every architecture
+            if len(index_variants(release, index_path)) == 0:
+                continue
+            variant = select_index_variant(release, index_path)
+            index_paths[(release.suite, component, architecture)] = os.path.join(dist_root, variant.filepath)
+
+    return index_paths
@@ -0,0 +1,207 @@
+import hashlib
+import io
+import posixpath
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from compression import open_decompressed, strip_compression_extension
+from downloader import Downloader
+from packages import AnyPackage, iter_packages_buffer
+from release import FileHashInfo, Release
+
+# 'N,Mc', 'Na', 'Nd' and so on
+ED_COMMAND = re.compile(rb'^(\d+)(?:,(\d+))?([acd])$')
+
+
+class PDiffEntry(BaseModel):
+    hashsum: str
+    size: int
+    name: str
+
+
+class PDiffIndex(BaseModel):
+    current_sha256: str
+    current_size: int
+    # SHA256 of index before patch of the same name is applied
+    history: List[PDiffEntry]
+    # SHA256 of uncompressed patches
+    patches: List[PDiffEntry]
+    # SHA256 of compressed patches as they are downloaded
+    downloads: List[PDiffEntry]
+    # Merged patches bring any history state to current one at once
+    merged: bool = False
+
+
+def parse_pdiff_index(content: str) -> PDiffIndex:
+    current: Optional[Tuple[str, int]] = None
+    lists: Dict[str, List[PDiffEntry]] = {'SHA256-History': [], 'SHA256-Patches': [], 'SHA256-Download': []}
+    merged = False
+    current_list: Optional[List[PDiffEntry]] = None
+
+    for line in content.splitlines():
+        if len(line.strip()) == 0:
+            continue
+        if line.startswith(' '):
+            assert current_list is not None, f'Entry outside of hash list: {line}'
+            hashsum, size, name = line.split()
+            current_list.append(PDiffEntry(hashsum=hashsum, size=int(size), name=name))
+            continue
+        header_key, _, value = line.partition(':')
+        value = value.strip()
+        current_list = lists.get(header_key)
+        if header_key == 'SHA256-Current':
+            hashsum, size = value.split()
+            current = hashsum, int(size)
+        elif header_key == 'X-Patch-Precedence':
+            merged = value == 'merged'
+    assert current is not None, 'SHA256-Current not found in diff index'
+
+    return PDiffIndex(current_sha256=current[0], current_size=current[1], history=lists['SHA256-History'],
+                      patches=lists['SHA256-Patches'], downloads=lists['SHA256-Download'], merged=merged)
+
+
+def patch_chain(index: PDiffIndex, local_sha256: str) -> Optional[List[str]]:
+    # Names of patches bringing local index to current one. Empty when local index is current,
+    # None when local index is too old or unknown and has to be downloaded whole
+    if local_sha256 == index.current_sha256:
+        return []
+    for position, entry in enumerate(index.history):
+        if entry.hashsum == local_sha256:
+            if index.merged:
+                return [entry.name]
+            return [it.name for it in index.history[position:]]
+
+    return None
+
+
+def apply_ed_patch(lines: List[bytes], patch: Iterable[bytes]) -> None:
+    # Applies `diff --ed` script to lines in place. Lines keep their line endings.
+    # Commands of such scripts go from the end of file to its start, so line numbers stay valid
+    patch_lines = iter(patch)
+    for command_line in patch_lines:
+        command = ED_COMMAND.match(command_line.rstrip(b'\n'))
+        assert command is not None, f'Unsupported ed command: {command_line!r}'
+        first = int(command.group(1))
+        last = int(command.group(2)) if command.group(2) is not None else first
+        action = command.group(3)
+
+        text: List[bytes] = []
+        if action != b'd':
+            for text_line in patch_lines:
+                if text_line.rstrip(b'\n') == b'.':
+                    break
+                text.append(text_line)
+
+        if action == b'a':
+            lines[first:first] = text
+        elif action == b'c':
+            lines[first - 1:last] = text
+        else:
+            del lines[first - 1:last]
+
+
+def apply_patches(content: bytes, patches: Iterable[bytes]) -> bytes:
+    lines = content.splitlines(keepends=True)
+    for patch in patches:
+        apply_ed_patch(lines, patch.splitlines(keepends=True))
+
+    return b''.join(lines)
+
+
+def patched_content(content: bytes, index: PDiffIndex,
+                    fetch_patch: Callable[[PDiffEntry], bytes]) -> Optional[bytes]:
+    # fetch_patch returns uncompressed patch. Returns None when patches can not bring content to current state
+    chain = patch_chain(index, hashlib.sha256(content).hexdigest())
+    if chain is None:
+        return None
+    patches_by_name = {it.name: it for it in index.patches}
+
+    patches: List[bytes] = []
+    for name in chain:
+        entry = patches_by_name.get(name)
+        if entry is None:
+            return None
+        patch = fetch_patch(entry)
+        if hashlib.sha256(patch).hexdigest() != entry.hashsum:
+            return None
+        patches.append(patch)
+    content = apply_patches(content, patches)
+    if hashlib.sha256(content).hexdigest() != index.current_sha256:
+        return None
+
+    return content
+
+
+def patch_downloads(index: PDiffIndex) -> Dict[str, PDiffEntry]:
+    # Patch name -> its SHA256-Download entry, whatever compression upstream used, e.g. T-1 -> T-1.gz or T-1.xz
+    downloads: Dict[str, PDiffEntry] = {}
+    for it in index.downloads:
+        downloads.setdefault(strip_compression_extension(it.name), it)
+
+    return downloads
+
+
+def _release_entry(release: Release, filepath: str) -> Optional[FileHashInfo]:
+    file = release.get_file(filepath)
+
+    return file.hash_info('SHA256') if file is not None else None
+
+
+def fetch_patched_index(downloader: Downloader, dists_path: str, release: Release, index_path: str,
+                        local_content: bytes) -> Optional[bytes]:
+    # index_path is uncompressed index, e.g. 'main/binary-amd64/Packages'. Returns new content of the index
+    # verified against Release, or None when the whole index has to be downloaded instead
+    expected = _release_entry(release, index_path)
+    diff_index_path = f'{index_path}.diff/Index'
+    diff_index_entry = _release_entry(release, diff_index_path)
+    if expected is None or diff_index_entry is None:
+        return None
+    if hashlib.sha256(local_content).hexdigest() == expected.hashsum:
+        return local_content
+
+    diff_index_content = downloader.fetch_bytes(posixpath.join(dists_path, diff_index_path))
+    if hashlib.sha256(diff_index_content).hexdigest() != diff_index_entry.hashsum:
+        return None
+    index = parse_pdiff_index(diff_index_content.decode())
+    if index.current_sha256 != expected.hashsum:
+        # Diff index and Release are from different syncs of upstream
+        return None
+    downloads_by_name = patch_downloads(index)
+
+    def fetch_patch(entry: PDiffEntry) -> bytes:
+        download = downloads_by_name.get(entry.name)
+        assert download is not None, f'No download for patch {entry.name}'
+        compressed = downloader.fetch_bytes(posixpath.join(dists_path, f'{index_path}.diff', download.name))
+        assert hashlib.sha256(compressed).hexdigest() == download.hashsum, f'{download.name} SHA256 mismatch'
+        with open_decompressed(io.BytesIO(compressed), download.name) as fp:
+            return fp.read()
+
+    try:
+        return patched_content(local_content, index, fetch_patch)
+    except AssertionError:
+        return None
+
+
+def update_packages(old_content: bytes, old_packages: List[AnyPackage], new_content: bytes,
+                    record_type: str = 'pydantic') -> Tuple[List[AnyPackage], int]:
+    # Packages of new_content, reusing records of stanzas that did not change. old_packages should be parsed
+    # from old_content. Returns packages and number of stanzas that were parsed
+    old_stanzas = [it for it in old_content.split(b'\n\n') if len(it.strip(b'\n')) != 0]
+    assert len(old_stanzas) == len(old_packages), 'Old packages are not parsed from old content'
+    packages_by_stanza = {stanza.strip(b'\n'): package for stanza, package in zip(old_stanzas, old_packages)}
+
+    packages: List[AnyPackage] = []
+    parsed = 0
+    for stanza in new_content.split(b'\n\n'):
+        stanza = stanza.strip(b'\n')
+        if len(stanza) == 0:
+            continue
+        package = packages_by_stanza.get(stanza)
+        if package is None:
+            package, = iter_packages_buffer(stanza, record_type=record_type)
+            parsed += 1
+        packages.append(package)
+
+    return packages, parsed
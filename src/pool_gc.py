@@ -0,0 +1,284 @@
+import argparse
+import fcntl
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from by_hash import BY_HASH_NAME, DEFAULT_STORE_DIRECTORY, RELEASES_DIRECTORY, prune_store, store_path
+from compression import open_decompressed, strip_compression_extension
+from downloader import JOURNAL_SUFFIX, PARTIAL_SUFFIX
+from metrics import get_metrics
+from publish import SNAPSHOTS_DIRECTORY
+from release import Release, ReleaseFile, parse_release
+from state import MirrorState
+
+POOL_DIRECTORY = 'pool'
+# Only file names are needed, so index lines are matched with a regular expression instead of being parsed.
+# Lines may end with CRLF
+FILENAME_HEADER = re.compile(rb'Filename:[ \t]*(\S+)[ \t]*\r?$')
+# Directories of mirror that may hold suites: served ones and retained snapshots
+SUITE_DIRECTORIES = ('dists', SNAPSHOTS_DIRECTORY)
+DEFAULT_WORKERS = 16
+LOCK_NAME = '.lock'
+
+
+class GcReport(BaseModel):
+    referenced: int
+    scanned: int
+    # Paths relative to mirror root
+    unreferenced: List[str]
+    # By-hash store files no suite or snapshot links, paths relative to mirror root
+    unreferenced_store: List[str] = []
+    reclaimed_bytes: int
+    dry_run: bool
+
+
+class MirrorLock:
+    # Syncs hold the lock of a mirror shared and garbage collection holds it exclusively, so collection never
+    # sees pool files and partial downloads of a sync whose indexes are not published yet
+    def __init__(self, mirror_root: str):
+        os.makedirs(mirror_root, exist_ok=True)
+        self.fp = open(os.path.join(mirror_root, LOCK_NAME), 'a')
+
+    def shared(self) -> None:
+        fcntl.flock(self.fp, fcntl.LOCK_SH)
+
+    def exclusive(self) -> None:
+        # Upgrades a shared lock as well, waits for other syncs to finish
+        fcntl.flock(self.fp, fcntl.LOCK_EX)
+
+    def close(self) -> None:
+        # Releases the lock
+        self.fp.close()
+
+    def __enter__(self) -> 'MirrorLock':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _worker_count(workers: Optional[int]) -> int:
+    return workers or min(DEFAULT_WORKERS, (os.cpu_count() or 1) * 4)
+
+
+def suite_roots(mirror_root: str) -> List[str]:
+    # Directories holding a Release: every suite of dists/ and every retained snapshot. Served suites are
+    # symlinks to snapshots, so roots are deduplicated by real path
+    roots: Dict[str, str] = {}
+    for directory in SUITE_DIRECTORIES:
+        for path, directories, files in os.walk(os.path.join(mirror_root, directory), followlinks=True):
+            if 'Release' in files:
+                roots.setdefault(os.path.realpath(path), path)
+                # Indexes and by-hash directories of a suite hold no other suites
+                directories.clear()
+
+    return sorted(roots.values())
+
+
+def _read_release(path: str) -> Release:
+    with open(path, 'r') as fp:
+        return parse_release(fp.read())
+
+
+def _release_indexes(release: Release, locate: Callable[[ReleaseFile], Optional[str]]) -> List[Tuple[str, str]]:
+    # (path, index path in Release) of one existing file of every Packages index listed in release, whatever its
+    # compression. Index path tells compression of files stored by hash
+    paths: Dict[str, Tuple[str, str]] = {}
+    for it in release.files.values():
+        if it.index_type != 'Packages':
+            continue
+        path = locate(it)
+        index = strip_compression_extension(it.filepath)
+        if index not in paths and path is not None and os.path.isfile(path):
+            paths[index] = (path, it.filepath)
+
+    return list(paths.values())
+
+
+def index_paths(suite_root: str) -> List[Tuple[str, str]]:
+    release = _read_release(os.path.join(suite_root, 'Release'))
+
+    return _release_indexes(release, lambda it: os.path.join(suite_root, it.filepath))
+
+
+def retained_release_indexes(mirror_root: str) -> List[Tuple[str, str]]:
+    # Indexes of Releases retain_by_hash keeps for clients still holding one of them. Those clients fetch indexes
+    # by hash, so packages they list are referenced as well. Indexes are read from the by-hash store
+    store_root = os.path.join(mirror_root, DEFAULT_STORE_DIRECTORY)
+
+    def locate(file: ReleaseFile) -> Optional[str]:
+        sha256 = file.hashes.get(BY_HASH_NAME)
+        return store_path(store_root, sha256) if sha256 is not None else None
+
+    indexes: List[Tuple[str, str]] = []
+    for path, directories, files in os.walk(os.path.join(store_root, RELEASES_DIRECTORY)):
+        for name in files:
+            # Temporary files of interrupted writes have a suffix
+            if '.' in name:
+                continue
+            indexes.extend(_release_indexes(_read_release(os.path.join(path, name)), locate))
+
+    return indexes
+
+
+def index_filenames(path: str, filepath: Optional[str] = None) -> Set[str]:
+    # filepath tells compression of path, path itself by default. Index is streamed line by line, indexes are
+    # read in parallel and some are hundreds of megabytes decompressed
+    filenames: Set[str] = set()
+    with open(path, 'rb') as fp, open_decompressed(fp, filepath or path) as decompressed:
+        for line in decompressed:
+            match = FILENAME_HEADER.match(line)
+            if match is not None:
+                filenames.add(match.group(1).decode())
+
+    return filenames
+
+
+def referenced_filenames(mirror_root: str, workers: Optional[int] = None) -> Tuple[Set[str], int]:
+    # File names referenced by indexes of every suite, snapshot and Release retained for by-hash. Returns them
+    # and number of indexes read. Snapshots and by-hash directories hardlink indexes, so every inode is read once
+    indexes: Dict[Tuple[int, int], Tuple[str, str]] = {}
+    for path, filepath in [*(it for root in suite_roots(mirror_root) for it in index_paths(root)),
+                           *retained_release_indexes(mirror_root)]:
+        stat = os.stat(path)
+        indexes.setdefault((stat.st_dev, stat.st_ino), (path, filepath))
+
+    filenames: Set[str] = set()
+    with ThreadPoolExecutor(max_workers=_worker_count(workers)) as executor:
+        for it in executor.map(lambda it: index_filenames(*it), indexes.values()):
+            filenames.update(it)
+
+    return filenames, len(indexes)
+
+
+def _scan_directory(path: str) -> Tuple[List[str], List[str]]:
+    # Files and subdirectories. Types come from directory entries, no stat() is needed on Linux
+    files: List[str] = []
+    directories: List[str] = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            else:
+                files.append(entry.path)
+
+    return files, directories
+
+
+def scan_tree(root: str, workers: Optional[int] = None) -> Iterator[str]:
+    # Paths of every file under root. Directories are listed in parallel, a pool is mostly a deep tree
+    # of small directories where a single thread waits on the file system
+    if not os.path.isdir(root):
+        return
+    with ThreadPoolExecutor(max_workers=_worker_count(workers)) as executor:
+        pending: Set[Future] = {executor.submit(_scan_directory, root)}
+        while len(pending) != 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                for it in directories:
+                    pending.add(executor.submit(_scan_directory, it))
+                yield from files
+
+
+def _referenced(filename: str, referenced: Set[str]) -> bool:
+    # Partial downloads of referenced files are kept, so an interrupted download may still be resumed
+    for suffix in (JOURNAL_SUFFIX, PARTIAL_SUFFIX):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)] in referenced
+    return filename in referenced
+
+
+def _remove(path: str) -> int:
+    # Returns size of removed file, 0 when it is gone already
+    try:
+        size = os.lstat(path).st_size
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+
+    return size
+
+
+def _remove_empty_directories(pool_root: str, paths: List[str]) -> None:
+    directories = {os.path.dirname(it) for it in paths}
+    # Deepest first, so parents are tried after their children
+    for directory in sorted(directories, key=len, reverse=True):
+        while directory != pool_root and directory.startswith(pool_root):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+def collect_garbage(mirror_root: str, dry_run: bool = False, workers: Optional[int] = None) -> GcReport:
+    # Removes pool files no index of any suite, snapshot or Release retained for by-hash references, and by-hash
+    # store files nothing links. With dry_run only reports them. Callers hold MirrorLock of the mirror exclusively
+    mirror_root = os.path.abspath(mirror_root)
+    metrics = get_metrics()
+    with metrics.phase('gc_references'):
+        referenced, index_count = referenced_filenames(mirror_root, workers)
+    # Pool of a mirror whose indexes are missing would be removed whole
+    assert index_count != 0, f'No indexes found in {mirror_root}, refusing to collect garbage'
+
+    pool_root = os.path.join(mirror_root, POOL_DIRECTORY)
+    prefix = len(mirror_root) + 1
+    unreferenced: List[str] = []
+    scanned = 0
+    with metrics.phase('gc_scan'):
+        for path in scan_tree(pool_root, workers):
+            scanned += 1
+            if not _referenced(path[prefix:], referenced):
+                unreferenced.append(path)
+
+    with metrics.phase('gc_remove'), ThreadPoolExecutor(max_workers=_worker_count(workers)) as executor:
+        if dry_run:
+            reclaimed_bytes = sum(executor.map(lambda it: os.lstat(it).st_size, unreferenced))
+        else:
+            reclaimed_bytes = sum(executor.map(_remove, unreferenced))
+            _remove_empty_directories(pool_root, unreferenced)
+        unreferenced_store = prune_store(mirror_root, dry_run)
+    metrics.increment('gc_reclaimed_bytes_total', reclaimed_bytes)
+    metrics.increment('gc_removed_files_total', 0 if dry_run else len(unreferenced))
+
+    return GcReport(referenced=len(referenced), scanned=scanned,
+                    unreferenced=sorted(it[prefix:] for it in unreferenced),
+                    unreferenced_store=sorted(it[prefix:] for it in unreferenced_store),
+                    reclaimed_bytes=reclaimed_bytes, dry_run=dry_run)
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Remove pool files no suite or snapshot of the mirror references')
+    parser.add_argument('destination', help='Local mirror root')
+    parser.add_argument('--dry-run', action='store_true', help='Only list files that would be removed')
+    parser.add_argument('--workers', type=int, help='Threads reading indexes and listing pool directories')
+    parser.add_argument('--state', help='SQLite state file of the mirror, removed files are forgotten there')
+
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> int:
+    arguments = parse_arguments(argv)
+    with MirrorLock(arguments.destination) as lock:
+        lock.exclusive()
+        report = collect_garbage(arguments.destination, arguments.dry_run, arguments.workers)
+    for it in [*report.unreferenced, *report.unreferenced_store]:
+        print(it)
+    if arguments.state is not None and not report.dry_run:
+        with MirrorState(arguments.state) as state:
+            state.forget_pool_files(report.unreferenced)
+    print(f'{report.scanned} pool files, {report.referenced} referenced, {len(report.unreferenced)} '
+          f'{"unreferenced" if report.dry_run else "removed"}, {report.reclaimed_bytes} bytes '
+          f'{"reclaimable" if report.dry_run else "reclaimed"}', file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
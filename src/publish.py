@@ -0,0 +1,159 @@
+import os
+import posixpath
+import shutil
+import time
+from typing import List, Optional
+
+from by_hash import BY_HASH_NAME, by_hash_path
+from release import Release, parse_release
+from tools import safe_join
+
+# Snapshots of dists/<suite> live in '<mirror root>/.snapshots/<suite>/<snapshot>'
+SNAPSHOTS_DIRECTORY = '.snapshots'
+STAGING_SUFFIX = '.staging'
+DEFAULT_RETAINED_SNAPSHOTS = 3
+# Name of directory synced before snapshots were used, sorts before every other snapshot
+INITIAL_SNAPSHOT = '00000000T000000Z-initial'
+
+
+def _snapshot_name() -> str:
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+
+
+def _link_file(source: str, destination: str) -> bool:
+    # Hardlinks source unless destination exists already. Returns whether a link was made
+    if os.path.lexists(destination):
+        return False
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.link(source, destination)
+
+    return True
+
+
+def _temporary_symlink(target: str, link: str) -> str:
+    # Symlink to target next to link, renamed over it afterwards
+    temporary = f'{link}.{os.getpid()}.link'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.symlink(target, temporary)
+
+    return temporary
+
+
+def replace_symlink(target: str, link: str) -> None:
+    # rename() of a symlink over another one is atomic, clients see either old or new target
+    os.replace(_temporary_symlink(target, link), link)
+
+
+class SnapshotPublisher:
+    # dists/<suite> of the mirror is a symlink to a snapshot directory. A sync stages the next snapshot next to
+    # it, unchanged files are hardlinked from the current snapshot and the symlink is flipped once everything
+    # is in place. Pool is outside of snapshots and shared by all of them, so publishing only links files
+    def __init__(self, mirror_root: str, dists_path: str, retain: int = DEFAULT_RETAINED_SNAPSHOTS):
+        assert retain > 0, f'At least one snapshot has to be retained: {retain}'
+        self.mirror_root = mirror_root
+        self.dists_path = dists_path
+        self.retain = retain
+        self.live_path = safe_join(mirror_root, dists_path)
+        self.snapshots_root = safe_join(mirror_root, posixpath.join(SNAPSHOTS_DIRECTORY, dists_path))
+        self.staging_path: Optional[str] = None
+
+    def current(self) -> Optional[str]:
+        # Directory currently served under dists/<suite>, a plain directory of mirrors synced before snapshots
+        if os.path.islink(self.live_path):
+            return os.path.realpath(self.live_path)
+        if os.path.isdir(self.live_path):
+            return self.live_path
+        return None
+
+    def stage(self) -> str:
+        # Empty directory of the next snapshot, indexes and Release are written there
+        os.makedirs(self.snapshots_root, exist_ok=True)
+        name = _snapshot_name()
+        position = 1
+        while os.path.lexists(os.path.join(self.snapshots_root, name)) or \
+                os.path.lexists(os.path.join(self.snapshots_root, name + STAGING_SUFFIX)):
+            position += 1
+            name = f'{_snapshot_name()}-{position}'
+        self.staging_path = os.path.join(self.snapshots_root, name + STAGING_SUFFIX)
+        os.makedirs(self.staging_path)
+
+        return self.staging_path
+
+    def link_unchanged(self, release: Release) -> int:
+        # Hardlinks files of the current snapshot that release lists with the same SHA256, and by-hash files of
+        # the current Release so clients still holding it find its indexes. Returns number of linked files
+        assert self.staging_path is not None, 'No snapshot staged'
+        current = self.current()
+        previous_release_path = os.path.join(current, 'Release') if current is not None else None
+        if previous_release_path is None or not os.path.isfile(previous_release_path):
+            return 0
+        with open(previous_release_path, 'r') as fp:
+            previous = parse_release(fp.read())
+
+        linked = 0
+        for filepath, it in previous.files.items():
+            sha256 = it.hashes.get(BY_HASH_NAME)
+            if sha256 is None:
+                continue
+            new = release.get_file(filepath)
+            source = safe_join(current, filepath)
+            if new is not None and new.hashes.get(BY_HASH_NAME) == sha256 and os.path.isfile(source):
+                linked += _link_file(source, safe_join(self.staging_path, filepath))
+            by_hash_source = safe_join(current, by_hash_path(filepath, sha256))
+            if os.path.isfile(by_hash_source):
+                linked += _link_file(by_hash_source, safe_join(self.staging_path, by_hash_path(filepath, sha256)))
+
+        return linked
+
+    def publish(self) -> str:
+        # Makes staged snapshot the served one. Returns its path
+        assert self.staging_path is not None, 'No snapshot staged'
+        snapshot_path = self.staging_path[:-len(STAGING_SUFFIX)]
+        os.rename(self.staging_path, snapshot_path)
+        self.staging_path = None
+        os.makedirs(os.path.dirname(self.live_path), exist_ok=True)
+        target = os.path.relpath(snapshot_path, os.path.dirname(self.live_path))
+        if os.path.isdir(self.live_path) and not os.path.islink(self.live_path):
+            # Directory of a mirror synced before snapshots becomes the oldest snapshot. rename() can not replace
+            # a directory with a symlink, so the symlink is made first and dists/<suite> is only missing between
+            # two renames
+            temporary = _temporary_symlink(target, self.live_path)
+            os.rename(self.live_path, os.path.join(self.snapshots_root, INITIAL_SNAPSHOT))
+            os.replace(temporary, self.live_path)
+        else:
+            replace_symlink(target, self.live_path)
+
+        return snapshot_path
+
+    def discard(self) -> None:
+        # Removes staged snapshot of a failed sync
+        if self.staging_path is not None:
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+            self.staging_path = None
+
+    def snapshots(self) -> List[str]:
+        # Published snapshots, oldest first
+        if not os.path.isdir(self.snapshots_root):
+            return []
+        with os.scandir(self.snapshots_root) as it:
+            return sorted(entry.path for entry in it if entry.is_dir(follow_symlinks=False)
+                          and not entry.name.endswith(STAGING_SUFFIX))
+
+    def collect(self) -> List[str]:
+        # Removes snapshots beyond retain newest ones and staging directories left by crashed syncs. Served
+        # snapshot is never removed. Returns removed paths
+        current = self.current()
+        removed: List[str] = []
+        for path in self.snapshots()[:-self.retain]:
+            if current is not None and os.path.samefile(path, current):
+                continue
+            shutil.rmtree(path)
+            removed.append(path)
+        with os.scandir(self.snapshots_root) as it:
+            for entry in it:
+                if entry.name.endswith(STAGING_SUFFIX) and entry.path != self.staging_path:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed.append(entry.path)
+
+        return removed
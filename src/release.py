@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple, Any
+from functools import cached_property
+from typing import List, Dict, Optional, Tuple, Any, Iterable
 
 from pydantic import BaseModel, conlist, field_validator
 
+from metrics import get_metrics
+
 
 class FileHashInfo(BaseModel):
     hashsum: str
@@ -11,6 +14,50 @@ class FileHashInfo(BaseModel):
     filepath: str
 
 
+class ReleaseFile(BaseModel):
+    filepath: str
+    filesize: int
+    # Digests of every hash list by hash name, e.g. {'MD5Sum': ..., 'SHA256': ...}
+    hashes: Dict[str, str] = {}
+    # 'main', None for files in suite root
+    component: Optional[str] = None
+    # 'amd64', 'all' or 'source', None for files of no architecture, e.g. translations
+    architecture: Optional[str] = None
+    # File name without compression extension and architecture: 'Packages', 'Contents', 'Translation', ...
+    index_type: str
+
+    def hash_info(self, hash_name: str) -> Optional[FileHashInfo]:
+        hashsum = self.hashes.get(hash_name)
+        if hashsum is None:
+            return None
+
+        return FileHashInfo(hashsum=hashsum, filesize=self.filesize, filepath=self.filepath)
+
+
+def classify_release_file(filepath: str) -> Tuple[Optional[str], Optional[str], str]:
+    # 'main/binary-amd64/Packages.xz' -> ('main', 'amd64', 'Packages'),
+    # 'main/Contents-arm64.gz' -> ('main', 'arm64', 'Contents'), 'main/i18n/Translation-en' -> ('main', None,
+    # 'Translation'), 'main/source/Sources.xz' -> ('main', 'source', 'Sources')
+    parts = filepath.split('/')
+    component = parts[0] if len(parts) > 1 else None
+    architecture: Optional[str] = None
+    for part in parts[1:-1]:
+        if part.startswith('binary-'):
+            architecture = part[len('binary-'):]
+        elif part == 'source':
+            architecture = 'source'
+
+    # Neither index names nor architectures hold a dot, so compression and other extensions like '.yml.gz' are
+    # cut at the first one
+    name = parts[-1].partition('.')[0]
+    index_type, _, suffix = name.partition('-')
+    if index_type == 'Contents' and len(suffix) != 0:
+        # 'Contents-udeb-amd64' is Contents of udebs of amd64
+        architecture = suffix.rpartition('-')[2]
+
+    return component, architecture, index_type
+
+
 class Release(BaseModel):
     origin: str
     label: str
@@ -34,6 +81,44 @@ class Release(BaseModel):
 
         return files_by_hash
 
+    @cached_property
+    def _file_index(self) -> Tuple[Dict[str, ReleaseFile], Dict[Tuple[Optional[str], Optional[str], str],
+                                                                  List[ReleaseFile]]]:
+        # Every hash list merged by path and grouped by kind. Built on first lookup rather than on parsing, most
+        # Releases are only compared by date and hashes. files_by_hash should not be modified afterwards
+        files: Dict[str, ReleaseFile] = {}
+        files_by_kind: Dict[Tuple[Optional[str], Optional[str], str], List[ReleaseFile]] = {}
+        for hash_name, infos in self.files_by_hash.items():
+            for it in infos:
+                file = files.get(it.filepath)
+                if file is None:
+                    component, architecture, index_type = classify_release_file(it.filepath)
+                    # Values come from a validated Release, validating them again would double the cost
+                    file = files[it.filepath] = ReleaseFile.model_construct(
+                        filepath=it.filepath, filesize=it.filesize, hashes={}, component=component,
+                        architecture=architecture, index_type=index_type)
+                    files_by_kind.setdefault((component, architecture, index_type), []).append(file)
+                file.hashes[hash_name] = it.hashsum
+
+        return files, files_by_kind
+
+    @property
+    def files(self) -> Dict[str, ReleaseFile]:
+        # Path -> file, e.g. 'main/binary-amd64/Packages.xz'
+        return self._file_index[0]
+
+    def get_file(self, filepath: str) -> Optional[ReleaseFile]:
+        return self._file_index[0].get(filepath)
+
+    def find_files(self, component: Optional[str] = None, architecture: Optional[str] = None,
+                   index_type: Optional[str] = None) -> List[ReleaseFile]:
+        # None matches anything. Files are grouped by kind, so only groups are scanned, not every file
+        return [file for (it_component, it_architecture, it_index_type), files in self._file_index[1].items()
+                if (component is None or component == it_component)
+                and (architecture is None or architecture == it_architecture)
+                and (index_type is None or index_type == it_index_type)
+                for file in files]
+
 
 class AbstractParserState(ABC):
     @abstractmethod
@@ -59,17 +144,14 @@ class ReleaseParserHashsumState(AbstractParserState):
         assert self.current_hash is not None, 'No current hash found'
         assert line.startswith(' '), f'Line not starting with space and is not a hash name: {line}'
 
-        if self.files_by_hash.get(self.current_hash) is None:
-            self.files_by_hash[self.current_hash] = []
+        files = self.files_by_hash.get(self.current_hash)
+        if files is None:
+            files = self.files_by_hash[self.current_hash] = []
 
-        split_line: Tuple[str] = *filter(lambda x: len(x) != 0, line.split(' ')),
-        hashsum: str
-        filesize: str
-        filepath: str
-        hashsum, filesize, filepath = split_line[0], split_line[1], split_line[2]
+        # Sizes are right aligned with a variable number of spaces
+        hashsum, filesize, filepath = line.split()
 
-        self.files_by_hash[self.current_hash].append(
-            FileHashInfo(hashsum=hashsum, filesize=int(filesize), filepath=filepath))
+        files.append(FileHashInfo(hashsum=hashsum, filesize=int(filesize), filepath=filepath))
 
     def should_switch_to_next_state(self, line: str) -> bool:
         # Is the last state.
@@ -132,11 +214,11 @@ class ReleaseParserHeaderState(AbstractParserState):
         return line.find(':') == len(line) - 1
 
 
-def parse_release(release_content: str) -> Release:
+def parse_release_lines(lines: Iterable[str]) -> Release:
     header_state = ReleaseParserHeaderState()
     hash_state = ReleaseParserHashsumState()
     current_state: AbstractParserState = header_state
-    for line in release_content.splitlines():
+    for line in lines:
         if current_state.should_switch_to_next_state(line):
             current_state = hash_state
 
@@ -157,3 +239,8 @@ def parse_release(release_content: str) -> Release:
         acquire_by_hash=header_state.acquire_by_hash,
         files_by_hash=hash_state.files_by_hash
     )
+
+
+def parse_release(release_content: str) -> Release:
+    with get_metrics().timer('parse_seconds', index='Release'):
+        return parse_release_lines(release_content.splitlines())
@@ -0,0 +1,207 @@
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+# '10M', '512K', '1.5G' or plain bytes per second
+RATE = re.compile(r'^(\d+(?:\.\d+)?)([KMG]?)$', re.IGNORECASE)
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+# Rates are looked up in schedules at most this often
+SCHEDULE_CHECK_INTERVAL = 1.0
+# Throughput has to grow by this much for concurrency to keep growing
+PLATEAU_THRESHOLD = 0.05
+
+
+def parse_rate(value: str) -> float:
+    match = RATE.match(value.strip())
+    assert match is not None, f'Invalid rate: {value}'
+
+    return float(match.group(1)) * RATE_UNITS[match.group(2).lower()]
+
+
+class RateWindow(BaseModel):
+    # Minutes since midnight, window may wrap past midnight, e.g. 18:00-08:00
+    start: int
+    end: int
+    # Bytes per second, None is unlimited
+    rate: Optional[float]
+
+    def contains(self, minute: int) -> bool:
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+def _minutes(value: str) -> int:
+    hours, _, minutes = value.partition(':')
+    result = int(hours) * 60 + int(minutes or 0)
+    assert 0 <= result <= 24 * 60, f'Invalid time of day: {value}'
+
+    return result
+
+
+class RateSchedule:
+    # First window containing current time of day gives the rate, no window means unlimited
+    def __init__(self, windows: List[RateWindow]):
+        self.windows = windows
+
+    @classmethod
+    def parse(cls, specs: List[str]) -> 'RateSchedule':
+        # '08:00-18:00=2M' limits business hours, plain '2M' is the whole day, '0' or 'unlimited' lift the limit
+        windows: List[RateWindow] = []
+        for spec in specs:
+            period, _, rate = spec.rpartition('=')
+            start, end = (0, 24 * 60) if len(period) == 0 else map(_minutes, period.split('-'))
+            windows.append(RateWindow(start=start, end=end,
+                                      rate=None if rate in ('0', 'unlimited') else parse_rate(rate)))
+
+        return cls(windows)
+
+    def rate_at(self, moment: datetime) -> Optional[float]:
+        minute = moment.hour * 60 + moment.minute
+        for it in self.windows:
+            if it.contains(minute):
+                return it.rate
+
+        return None
+
+
+class TokenBucket:
+    # Callers take tokens first and sleep off the debt afterwards, so one large chunk never blocks forever
+    def __init__(self, rate: Optional[float], burst: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._updated = clock()
+        self.rate: Optional[float] = None
+        self.burst = 0.0
+        self.tokens = 0.0
+        self._fixed_burst = burst
+        self.set_rate(rate)
+
+    def set_rate(self, rate: Optional[float]) -> None:
+        with self._lock:
+            limited = self.rate is None and rate is not None
+            self.rate = rate
+            # One second worth of traffic by default
+            self.burst = self._fixed_burst if self._fixed_burst is not None else (rate or 0.0)
+            # Bucket starts full when a limit comes into force
+            if limited:
+                self.tokens = self.burst
+                self._updated = self.clock()
+            else:
+                self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, amount: float) -> float:
+        # Returns time slept
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+
+        return wait
+
+
+class Shaper:
+    # Global and per-host token buckets whose rates follow schedules. One shaper may be shared by downloaders
+    # of several upstreams
+    def __init__(self, schedule: Optional[RateSchedule] = None,
+                 host_schedules: Optional[Dict[str, RateSchedule]] = None,
+                 now: Callable[[], datetime] = datetime.now, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.schedule = schedule or RateSchedule([])
+        self.host_schedules = host_schedules or {}
+        self.now = now
+        self.clock = clock
+        self.global_bucket = TokenBucket(None, clock=clock, sleep=sleep)
+        self.host_buckets = {host: TokenBucket(None, clock=clock, sleep=sleep) for host in self.host_schedules}
+        self._checked: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _update_rates(self) -> None:
+        with self._lock:
+            now = self.clock()
+            if self._checked is not None and now - self._checked < SCHEDULE_CHECK_INTERVAL:
+                return
+            self._checked = now
+        moment = self.now()
+        self.global_bucket.set_rate(self.schedule.rate_at(moment))
+        for host, schedule in self.host_schedules.items():
+            self.host_buckets[host].set_rate(schedule.rate_at(moment))
+
+    def throttle(self, host: str, amount: int) -> float:
+        # Called after amount bytes were received from host, sleeps as long as needed to keep the rates
+        self._update_rates()
+        waited = 0.0
+        bucket = self.host_buckets.get(host)
+        if bucket is not None:
+            waited += bucket.consume(amount)
+        return waited + self.global_bucket.consume(amount)
+
+
+def parse_host_rate_limits(specs: List[str]) -> Dict[str, RateSchedule]:
+    # 'deb.debian.org,08:00-18:00=2M' -> schedule of deb.debian.org, a host may be given several times
+    windows: Dict[str, List[str]] = {}
+    for spec in specs:
+        host, _, window = spec.partition(',')
+        assert len(window) != 0, f'Invalid host rate limit: {spec}'
+        windows.setdefault(host, []).append(window)
+
+    return {host: RateSchedule.parse(it) for host, it in windows.items()}
+
+
+class AdaptiveConcurrency:
+    # AIMD limit of parallel downloads. After every `limit` completed downloads throughput of that window is
+    # compared with the best one seen: the limit grows by one while throughput grows, stays on plateau and
+    # is halved on congestion (429, 503, connection errors)
+    def __init__(self, maximum: int, minimum: int = 1, initial: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        assert 0 < minimum <= maximum, f'Invalid concurrency bounds: {minimum}..{maximum}'
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = initial if initial is not None else minimum
+        self.clock = clock
+        self.active = 0
+        self.best_throughput = 0.0
+        self._window: Tuple[float, int, int] = (clock(), 0, 0)
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def release(self, transferred_bytes: int) -> None:
+        with self._condition:
+            self.active -= 1
+            started, completed, window_bytes = self._window
+            completed += 1
+            window_bytes += transferred_bytes
+            if completed >= self.limit:
+                elapsed = max(self.clock() - started, 1e-6)
+                throughput = window_bytes / elapsed
+                if throughput > self.best_throughput * (1 + PLATEAU_THRESHOLD):
+                    self.best_throughput = throughput
+                    self.limit = min(self.maximum, self.limit + 1)
+                self._window = (self.clock(), 0, 0)
+            else:
+                self._window = (started, completed, window_bytes)
+            self._condition.notify_all()
+
+    def congestion(self) -> None:
+        with self._condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            # Throughput seen with more connections is no target after backing off
+            self.best_throughput = 0.0
+            self._window = (self.clock(), 0, 0)
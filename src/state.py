@@ -0,0 +1,270 @@
+import os
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from downloader import HttpValidator
+from packages import AnyPackage, CompactPackage, Package
+from release import Release
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS releases (
+    id INTEGER PRIMARY KEY,
+    dists_path TEXT NOT NULL UNIQUE,
+    date TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS release_files (
+    release_id INTEGER NOT NULL REFERENCES releases(id) ON DELETE CASCADE,
+    hash_name TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    filesize INTEGER NOT NULL,
+    hashsum TEXT NOT NULL,
+    PRIMARY KEY (release_id, hash_name, filepath)
+);
+CREATE TABLE IF NOT EXISTS indexes (
+    id INTEGER PRIMARY KEY,
+    dists_path TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    sha256 TEXT,
+    config TEXT NOT NULL DEFAULT '',
+    UNIQUE (dists_path, filepath)
+);
+CREATE TABLE IF NOT EXISTS packages (
+    index_id INTEGER NOT NULL REFERENCES indexes(id) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,
+    architecture TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_index_id ON packages(index_id);
+CREATE INDEX IF NOT EXISTS packages_filename ON packages(filename);
+CREATE TABLE IF NOT EXISTS pool_files (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS http_validators (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT
+);
+CREATE TABLE IF NOT EXISTS completed_releases (
+    dists_path TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    config TEXT NOT NULL DEFAULT ''
+);
+'''
+
+
+def _as_package(package: AnyPackage) -> Package:
+    return package.to_package() if isinstance(package, CompactPackage) else package
+
+
+class MirrorState:
+    # Persistent mirror state: parsed releases, packages of every index and verification state of pool files.
+    # Pool file rows are written when files are downloaded or verified, so later runs query them instead of
+    # stat-ing the whole pool
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(SCHEMA)
+        # Completed releases of older state files have no config, they never match one and are synced again
+        # Indexes of older state files are recorded again for the same reason
+        for table in ('completed_releases', 'indexes'):
+            columns = {it[1] for it in self.connection.execute(f'PRAGMA table_info({table})')}
+            if 'config' not in columns:
+                self.connection.execute(f"ALTER TABLE {table} ADD COLUMN config TEXT NOT NULL DEFAULT ''")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> 'MirrorState':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def record_release(self, dists_path: str, release: Release) -> None:
+        with self.connection:
+            self.connection.execute('DELETE FROM releases WHERE dists_path = ?', (dists_path,))
+            release_id = self.connection.execute(
+                'INSERT INTO releases (dists_path, date, record) VALUES (?, ?, ?)',
+                (dists_path, release.date.isoformat(), release.model_dump_json())).lastrowid
+            self.connection.executemany(
+                'INSERT INTO release_files (release_id, hash_name, filepath, filesize, hashsum) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((release_id, hash_name, it.filepath, it.filesize, it.hashsum)
+                 for hash_name, files in release.files_by_hash.items() for it in files))
+
+    def get_release(self, dists_path: str) -> Optional[Release]:
+        row = self.connection.execute('SELECT record FROM releases WHERE dists_path = ?', (dists_path,)).fetchone()
+        if row is None:
+            return None
+
+        return Release.model_validate_json(row[0])
+
+    def record_completed_release(self, dists_path: str, release: Release, config: str) -> None:
+        # Release of the last sync of dists_path that fetched every file, with fingerprint of its configuration
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO completed_releases (dists_path, record, config) VALUES (?, ?, ?)',
+                (dists_path, release.model_dump_json(), config))
+
+    def completed_release(self, dists_path: str, config: str) -> Optional[Release]:
+        # None when the last complete sync mirrored other architectures, components or packages
+        row = self.connection.execute('SELECT record FROM completed_releases WHERE dists_path = ? AND config = ?',
+                                      (dists_path, config)).fetchone()
+
+        return None if row is None else Release.model_validate_json(row[0])
+
+    def record_http_validators(self, validators: Dict[str, HttpValidator]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO http_validators (url, etag, last_modified) VALUES (?, ?, ?)',
+                ((url, it.etag, it.last_modified) for url, it in validators.items()))
+
+    def http_validators(self, urls: Iterable[str]) -> Dict[str, HttpValidator]:
+        validators: Dict[str, HttpValidator] = {}
+        for url in urls:
+            row = self.connection.execute('SELECT etag, last_modified FROM http_validators WHERE url = ?',
+                                          (url,)).fetchone()
+            if row is not None:
+                validators[url] = HttpValidator(etag=row[0], last_modified=row[1])
+
+        return validators
+
+    def record_index(self, dists_path: str, filepath: str, sha256: Optional[str],
+                     packages: Iterable[AnyPackage], config: str = '') -> None:
+        # config is fingerprint of options selecting packages of the index, e.g. number of kept versions
+        with self.connection:
+            self.connection.execute('DELETE FROM indexes WHERE dists_path = ? AND filepath = ?',
+                                    (dists_path, filepath))
+            index_id = self.connection.execute(
+                'INSERT INTO indexes (dists_path, filepath, sha256, config) VALUES (?, ?, ?, ?)',
+                (dists_path, filepath, sha256, config)).lastrowid
+            self.connection.executemany(
+                'INSERT INTO packages (index_id, package, version, architecture, filename, size, sha256, record) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((index_id, it.package, it.version, it.architecture, it.filename, it.size, it.hashes.get('SHA256'),
+                  _as_package(it).model_dump_json()) for it in packages))
+
+    def index_sha256(self, dists_path: str, filepath: str, config: str = '') -> Optional[str]:
+        # SHA256 of index packages were recorded from. Equal to Release one means index has not changed.
+        # None when packages were selected with another config
+        row = self.connection.execute('SELECT sha256 FROM indexes WHERE dists_path = ? AND filepath = ? '
+                                      'AND config = ?', (dists_path, filepath, config)).fetchone()
+
+        return None if row is None else row[0]
+
+    def load_packages(self, dists_path: str, filepath: str) -> List[Package]:
+        rows = self.connection.execute(
+            'SELECT packages.record FROM packages JOIN indexes ON indexes.id = packages.index_id '
+            'WHERE indexes.dists_path = ? AND indexes.filepath = ? ORDER BY packages.rowid', (dists_path, filepath))
+
+        return [Package.model_validate_json(it[0]) for it in rows]
+
+    def record_pool_files(self, rows: Iterable[Tuple[str, int, int, Optional[str]]]) -> None:
+        # (filename, size, mtime_ns, verified SHA256 or None)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO pool_files (filename, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)', rows)
+
+    def record_pool_file(self, filename: str, size: int, mtime_ns: int, sha256: Optional[str] = None) -> None:
+        self.record_pool_files([(filename, size, mtime_ns, sha256)])
+
+    def record_pool_files_from_disk(self, mirror_root: str, filenames: Iterable[str],
+                                    verified_sha256s: Optional[Dict[str, Optional[str]]] = None) -> None:
+        rows = []
+        for filename in filenames:
+            stat = os.stat(os.path.join(mirror_root, filename))
+            rows.append((filename, stat.st_size, stat.st_mtime_ns, (verified_sha256s or {}).get(filename)))
+        self.record_pool_files(rows)
+
+    def forget_pool_files(self, filenames: Iterable[str]) -> None:
+        with self.connection:
+            self.connection.executemany('DELETE FROM pool_files WHERE filename = ?', ((it,) for it in filenames))
+
+    def forget_pool_file(self, filename: str) -> None:
+        self.forget_pool_files([filename])
+
+    def retain_indexes(self, dists_path: str, filepaths: Iterable[str]) -> None:
+        # Forgets indexes of dists_path that are not mirrored anymore, e.g. when Packages.gz became Packages.xz
+        filepaths = list(filepaths)
+        with self.connection:
+            self.connection.execute(
+                f'DELETE FROM indexes WHERE dists_path = ? AND filepath NOT IN ({", ".join("?" * len(filepaths))})',
+                (dists_path, *filepaths))
+
+    def missing_files(self, dists_path: Optional[str] = None) -> Dict[str, Tuple[int, Dict[str, str]]]:
+        # Referenced files that were never recorded, have other size or were verified with other hash.
+        # Returns filename -> (expected size, expected hashes)
+        query = 'SELECT packages.filename, packages.size, packages.sha256 FROM packages ' \
+                'JOIN indexes ON indexes.id = packages.index_id ' \
+                'LEFT JOIN pool_files ON pool_files.filename = packages.filename ' \
+                'WHERE (pool_files.filename IS NULL OR pool_files.size != packages.size ' \
+                'OR (pool_files.sha256 IS NOT NULL AND packages.sha256 IS NOT NULL ' \
+                'AND pool_files.sha256 != packages.sha256))'
+        if dists_path is None:
+            rows = self.connection.execute(query)
+        else:
+            rows = self.connection.execute(query + ' AND indexes.dists_path = ?', (dists_path,))
+
+        return {filename: (size, {} if sha256 is None else {'SHA256': sha256}) for filename, size, sha256 in rows}
+
+    def package_files(self) -> Iterator[Tuple[str, int, Optional[str]]]:
+        # (filename, size, SHA256) of packages of every recorded index, for deduplication across suites
+        return iter(self.connection.execute('SELECT filename, size, sha256 FROM packages'))
+
+    def verified_sha256s(self, filenames: Iterable[str]) -> Dict[str, str]:
+        # Filename -> SHA256 recorded pool files were verified to have
+        verified: Dict[str, str] = {}
+        filenames = list(filenames)
+        # SQLite limits number of query parameters
+        for start in range(0, len(filenames), 500):
+            chunk = filenames[start:start + 500]
+            verified.update(self.connection.execute(
+                f'SELECT filename, sha256 FROM pool_files WHERE sha256 IS NOT NULL '
+                f'AND filename IN ({", ".join("?" * len(chunk))})', chunk))
+
+        return verified
+
+    def recorded_files(self, dists_path: str) -> Dict[str, Tuple[int, Dict[str, str]]]:
+        # Recorded pool files referenced by indexes of dists_path. Returns filename -> (expected size, expected
+        # hashes)
+        rows = self.connection.execute(
+            'SELECT DISTINCT packages.filename, packages.size, packages.sha256 FROM packages '
+            'JOIN indexes ON indexes.id = packages.index_id '
+            'JOIN pool_files ON pool_files.filename = packages.filename WHERE indexes.dists_path = ?', (dists_path,))
+
+        return {filename: (size, {} if sha256 is None else {'SHA256': sha256}) for filename, size, sha256 in rows}
+
+    def stale_filenames(self, mirror_root: str, filenames: Optional[Iterable[str]] = None) -> Set[str]:
+        # Recorded files whose size or mtime on disk differ from recorded ones. Only given files are checked
+        # when filenames are passed, so callers can avoid stat-ing the whole pool
+        if filenames is None:
+            rows = self.connection.execute('SELECT filename, size, mtime_ns FROM pool_files').fetchall()
+        else:
+            rows = []
+            filenames = list(filenames)
+            # SQLite limits number of query parameters
+            for start in range(0, len(filenames), 500):
+                chunk = filenames[start:start + 500]
+                rows.extend(self.connection.execute(
+                    f'SELECT filename, size, mtime_ns FROM pool_files '
+                    f'WHERE filename IN ({", ".join("?" * len(chunk))})', chunk))
+        stale: Set[str] = set()
+        for filename, size, mtime_ns in rows:
+            try:
+                stat = os.stat(os.path.join(mirror_root, filename))
+            except FileNotFoundError:
+                stale.add(filename)
+                continue
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                stale.add(filename)
+
+        return stale
@@ -0,0 +1,75 @@
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from packages import AnyPackage
+from tools import safe_join
+from verify import hash_file, package_entries, verify_files
+
+# (package, version, architecture, filename, SHA256)
+PackageKey = Tuple[str, str, str, str, Optional[str]]
+
+
+class SyncPlan(BaseModel):
+    added: List[Any]
+    removed: List[Any]
+    unchanged: List[Any]
+
+
+def package_key(package: AnyPackage) -> PackageKey:
+    return package.package, package.version, package.architecture, package.filename, package.hashes.get('SHA256')
+
+
+def _packages_by_key(packages: Iterable[AnyPackage]) -> Dict[PackageKey, AnyPackage]:
+    packages_by_key: Dict[PackageKey, AnyPackage] = {}
+    for it in packages:
+        # Same file may be listed by several indexes
+        packages_by_key.setdefault(package_key(it), it)
+
+    return packages_by_key
+
+
+def plan_sync(previous: Iterable[AnyPackage], current: Iterable[AnyPackage]) -> SyncPlan:
+    previous_by_key = _packages_by_key(previous)
+    current_by_key = _packages_by_key(current)
+
+    return SyncPlan(
+        added=[it for key, it in current_by_key.items() if key not in previous_by_key],
+        removed=[it for key, it in previous_by_key.items() if key not in current_by_key],
+        unchanged=[it for key, it in current_by_key.items() if key in previous_by_key],
+    )
+
+
+def pool_file_state(mirror_root: str, package: AnyPackage, verify_hash: bool = False) -> str:
+    # 'present', 'missing' or 'mismatch'. Size is checked first, hash only on request
+    path = safe_join(mirror_root, package.filename)
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return 'missing'
+    if size != package.size:
+        return 'mismatch'
+    expected_sha256 = package.hashes.get('SHA256')
+    if verify_hash and expected_sha256 is not None and hash_file(path, ['SHA256'])['SHA256'] != expected_sha256:
+        return 'mismatch'
+
+    return 'present'
+
+
+def files_to_download(packages: Iterable[AnyPackage], mirror_root: str, verify_hashes: bool = False,
+                      workers: Optional[int] = None) -> List[AnyPackage]:
+    packages_by_filename: Dict[str, AnyPackage] = {}
+    for it in packages:
+        packages_by_filename.setdefault(it.filename, it)
+    if verify_hashes:
+        # Hashing is spread over a thread pool, sizes are still checked before hashing
+        results = verify_files(mirror_root, package_entries(packages_by_filename.values()), workers)
+        return [packages_by_filename[it.path] for it in results if it.status != 'ok']
+
+    return [it for it in packages_by_filename.values() if pool_file_state(mirror_root, it) != 'present']
+
+
+def plan_downloads(plan: SyncPlan, mirror_root: str, verify_hashes: bool = False) -> List[AnyPackage]:
+    # Unchanged packages are checked as well, pool may have lost them since previous sync
+    return files_to_download([*plan.added, *plan.unchanged], mirror_root, verify_hashes)
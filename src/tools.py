@@ -1,8 +1,13 @@
-from typing import Any, Optional, Sized, Type, TypeVar
+import codecs
+import os
+import threading
+from typing import Any, IO, Iterable, Iterator, Optional, Sized, Type, TypeVar, Union
 
 T = TypeVar('T')
 SizedT = TypeVar('SizedT', bound=Sized)
 
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
 
 def require_type(item: T, item_type: Type[Any], message: Optional[str] = None) -> T:
     if message is not None:
@@ -29,3 +34,55 @@ def require_not_empty(item: SizedT, message: Optional[str] = None) -> SizedT:
         assert len(item) != 0
 
     return item
+
+
+def iter_lines(fp: IO[Union[str, bytes]], chunk_size: int = DEFAULT_CHUNK_SIZE,
+               encoding: str = 'utf-8') -> Iterator[str]:
+    # Reads file object chunk by chunk so only one chunk and one partial line are held in memory.
+    # Binary file objects are decoded incrementally: multibyte characters may be split between chunks
+    decoder = None
+    tail = ''
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(encoding)()
+            chunk = decoder.decode(chunk)
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line[:-1] if line.endswith('\r') else line
+    if decoder is not None:
+        tail += decoder.decode(b'', final=True)
+    if len(tail) != 0:
+        yield tail[:-1] if tail.endswith('\r') else tail
+
+
+def write_atomically(path: str, content: Union[bytes, Iterable[bytes]]) -> None:
+    # Content, or chunks of it, is written to a temporary file next to path and renamed, so readers never see
+    # a half-written file. Temporary name is unique per thread, concurrent writers of one path do not share it
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temporary, 'wb') as fp:
+            if isinstance(content, bytes):
+                fp.write(content)
+            else:
+                fp.writelines(content)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def safe_join(root: str, path: str) -> str:
+    # Paths come from upstream indexes and should never point outside of the mirror
+    root = os.path.normpath(root)
+    joined = os.path.normpath(os.path.join(root, path))
+    # Not an assert, the check has to survive python -O
+    if not joined.startswith(os.path.join(root, '')):
+        raise ValueError(f'Path escapes mirror root: {path}')
+
+    return joined
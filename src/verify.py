@@ -0,0 +1,126 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+from metrics import get_metrics
+from packages import AnyPackage
+from release import Release
+from tools import safe_join
+
+VERIFY_BUFFER_SIZE = 1024 * 1024
+# Hash names used by Release ('MD5Sum') and Packages ('MD5sum') files -> hashlib names
+HASH_ALGORITHMS: Dict[str, str] = {
+    'md5sum': 'md5',
+    'sha1': 'sha1',
+    'sha256': 'sha256',
+    'sha512': 'sha512',
+}
+
+
+class MultiHasher:
+    # Computes every supported digest in one pass over the data. Unsupported hash names are ignored
+    def __init__(self, hash_names: Iterable[str]):
+        self.hashers = {name: hashlib.new(HASH_ALGORITHMS[name.lower()])
+                        for name in hash_names if name.lower() in HASH_ALGORITHMS}
+
+    def update(self, data: bytes) -> None:
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {name: hasher.hexdigest() for name, hasher in self.hashers.items()}
+
+    def mismatches(self, expected: Dict[str, str]) -> List[str]:
+        # Names of hashes that differ from expected ones
+        return [name for name, digest in self.hexdigests().items()
+                if name in expected and expected[name].lower() != digest]
+
+
+def hash_file(path: str, hash_names: Iterable[str], buffer_size: int = VERIFY_BUFFER_SIZE) -> Dict[str, str]:
+    hasher = MultiHasher(hash_names)
+    # One buffer is reused for the whole file. hashlib releases GIL for large updates, so threads scale
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    start = time.perf_counter()
+    with open(path, 'rb', buffering=0) as fp:
+        while True:
+            read = fp.readinto(buffer)
+            if not read:
+                break
+            hasher.update(view[:read])
+            size += read
+    # Includes reading, which is what verification of a file costs
+    metrics = get_metrics()
+    metrics.increment('hash_seconds_total', time.perf_counter() - start, source='file')
+    metrics.increment('hashed_bytes_total', size, source='file')
+
+    return hasher.hexdigests()
+
+
+class VerifyEntry(BaseModel):
+    # Path relative to verification root
+    path: str
+    size: Optional[int] = None
+    hashes: Dict[str, str] = {}
+
+
+class VerifyResult(BaseModel):
+    path: str
+    # 'ok', 'mismatch' or 'missing'
+    status: str
+    error: Optional[str] = None
+
+
+def verify_file(root: str, entry: VerifyEntry, buffer_size: int = VERIFY_BUFFER_SIZE) -> VerifyResult:
+    path = safe_join(root, entry.path)
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return VerifyResult(path=entry.path, status='missing')
+    # Size is the cheap check, files of wrong size are not hashed at all
+    if entry.size is not None and size != entry.size:
+        return VerifyResult(path=entry.path, status='mismatch', error=f'size {size} != {entry.size}')
+
+    digests = hash_file(path, entry.hashes, buffer_size)
+    mismatched = [name for name, digest in digests.items() if entry.hashes[name].lower() != digest]
+    if len(mismatched) != 0:
+        return VerifyResult(path=entry.path, status='mismatch', error=f'{", ".join(mismatched)} mismatch')
+
+    return VerifyResult(path=entry.path, status='ok')
+
+
+def verify_files(root: str, entries: Iterable[VerifyEntry], workers: Optional[int] = None,
+                 buffer_size: int = VERIFY_BUFFER_SIZE) -> List[VerifyResult]:
+    # Results are in the same order as entries
+    entries = list(entries)
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 2)) as executor:
+        return list(executor.map(lambda it: verify_file(root, it, buffer_size), entries))
+
+
+def package_entries(packages: Iterable[AnyPackage]) -> List[VerifyEntry]:
+    entries: Dict[str, VerifyEntry] = {}
+    for it in packages:
+        # Arch all packages are listed in index of every architecture
+        if it.filename not in entries:
+            entries[it.filename] = VerifyEntry(path=it.filename, size=it.size, hashes=it.hashes)
+
+    return list(entries.values())
+
+
+def release_entries(release: Release, dists_path: str = '') -> List[VerifyEntry]:
+    # Every file of Release with digests of all its hash lists. Paths are prefixed with dists_path
+    return [VerifyEntry(path=os.path.join(dists_path, it.filepath), size=it.filesize, hashes=dict(it.hashes))
+            for it in release.files.values()]
+
+
+def summarize(results: Iterable[VerifyResult]) -> Dict[str, int]:
+    summary = {'ok': 0, 'mismatch': 0, 'missing': 0}
+    for it in results:
+        summary[it.status] += 1
+
+    return summary
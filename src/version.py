@@ -0,0 +1,56 @@
+import re
+from functools import lru_cache
+from typing import Tuple
+
+# Non-digit run followed by digit run, as dpkg splits upstream version and revision
+_VERSION_PART = re.compile(r'([^0-9]*)([0-9]*)')
+# Compares as an empty non-digit run followed by 0, what dpkg assumes past the end of shorter version
+_END = (0, 0)
+VERSION_KEY_CACHE_SIZE = 1 << 16
+
+VersionKey = Tuple[int, Tuple[int, ...], Tuple[int, ...]]
+
+
+def _character_order(character: str) -> int:
+    # '~' sorts before anything, even the end of string, letters sort before other characters
+    if character == '~':
+        return -1
+    if character.isalpha():
+        return ord(character)
+    return ord(character) + 256
+
+
+def _part_key(part: str) -> Tuple[int, ...]:
+    # Missing revision equals '0', as in dpkg
+    part = part or '0'
+    key = []
+    for letters, digits in _VERSION_PART.findall(part):
+        if len(letters) == 0 and len(digits) == 0:
+            continue
+        key.extend(_character_order(it) for it in letters)
+        # Terminates non-digit run, so shorter run sorts before longer unless followed by '~'
+        key.append(0)
+        key.append(int(digits) if len(digits) != 0 else 0)
+    key.extend(_END)
+
+    return tuple(key)
+
+
+@lru_cache(maxsize=VERSION_KEY_CACHE_SIZE)
+def version_key(version: str) -> VersionKey:
+    # Sort key ordering versions like `dpkg --compare-versions`. Packages share few distinct versions,
+    # so keys are cached and comparison is a tuple comparison
+    epoch, colon, rest = version.partition(':')
+    if len(colon) == 0:
+        epoch, rest = '0', version
+    upstream, dash, revision = rest.rpartition('-')
+    if len(dash) == 0:
+        upstream, revision = rest, ''
+    assert epoch.isdigit(), f'Invalid epoch in version {version}'
+
+    return int(epoch), _part_key(upstream), _part_key(revision)
+
+
+def compare_versions(first: str, second: str) -> int:
+    first_key, second_key = version_key(first), version_key(second)
+    return (first_key > second_key) - (first_key < second_key)
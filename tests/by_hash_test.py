@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+from by_hash import by_hash_path, fetch_indexes, prune_store, publish_named, retain_by_hash, store_path
+from downloader import Downloader
+from mirror_server import MirrorRequestHandler, MirrorServerTestCase
+from release import FileHashInfo
+
+
+def release_content(date: str, *files: FileHashInfo) -> bytes:
+    with open('test_data/Release', 'r') as fp:
+        header = fp.read().split('MD5Sum:')[0]
+    header = header.replace('Sat, 10 Feb 2024', date)
+
+    return (header + 'SHA256:\n' + ''.join(f' {it.hashsum} {it.filesize} {it.filepath}\n' for it in files)).encode()
+
+
+class ByHashTests(MirrorServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = b'Package: foo\n'
+        self.info = FileHashInfo(hashsum=hashlib.sha256(self.content).hexdigest(), filesize=len(self.content),
+                                 filepath='main/binary-amd64/Packages')
+
+    def test_by_hash_path(self):
+        self.assertEqual('main/binary-amd64/by-hash/SHA256/abc',
+                         by_hash_path('main/binary-amd64/Packages.xz', 'abc'))
+
+    def test_fetched_by_hash_and_published(self):
+        self.write_upstream(f'dists/stable/{by_hash_path(self.info.filepath, self.info.hashsum)}', self.content)
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            first, = fetch_indexes(downloader, 'dists/stable', [self.info], self.mirror, acquire_by_hash=True)
+            # Another suite with identical index is served from store
+            second, = fetch_indexes(downloader, 'dists/testing', [self.info], self.mirror, acquire_by_hash=True)
+        for suite in ('stable', 'testing'):
+            # Named paths are switched only when Release is about to be written
+            self.assertFalse(os.path.exists(os.path.join(self.mirror, 'dists', suite, self.info.filepath)))
+            publish_named(self.mirror, f'dists/{suite}', [self.info])
+
+        self.assertTrue(first.success and second.success)
+        self.assertEqual(0, second.attempts)
+        self.assertListEqual([f'/debian/dists/stable/main/binary-amd64/by-hash/SHA256/{self.info.hashsum}'],
+                             MirrorRequestHandler.requested_paths)
+        for suite in ('stable', 'testing'):
+            named = os.path.join(self.mirror, 'dists', suite, self.info.filepath)
+            by_hash = os.path.join(self.mirror, 'dists', suite, by_hash_path(self.info.filepath, self.info.hashsum))
+            with open(named, 'rb') as fp:
+                self.assertEqual(self.content, fp.read())
+            self.assertTrue(os.path.samefile(named, by_hash))
+
+    def test_named_file_fallback(self):
+        self.write_upstream(f'dists/stable/{self.info.filepath}', self.content)
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            result, = fetch_indexes(downloader, 'dists/stable', [self.info], self.mirror, acquire_by_hash=True)
+
+        self.assertTrue(result.success)
+        self.assertTrue(os.path.isfile(os.path.join(self.mirror, 'dists/stable',
+                                                    by_hash_path(self.info.filepath, self.info.hashsum))))
+
+    def test_damaged_store_file_fetched_again(self):
+        self.write_upstream(f'dists/stable/{by_hash_path(self.info.filepath, self.info.hashsum)}', self.content)
+        store_file = store_path(os.path.join(self.mirror, '.by-hash'), self.info.hashsum)
+        os.makedirs(os.path.dirname(store_file))
+        with open(store_file, 'wb') as fp:
+            fp.write(b'x' * len(self.content))
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            result, = fetch_indexes(downloader, 'dists/stable', [self.info], self.mirror, acquire_by_hash=True)
+
+        self.assertEqual(1, result.attempts)
+        with open(store_file, 'rb') as fp:
+            self.assertEqual(self.content, fp.read())
+
+    def test_by_hash_files_of_old_releases_pruned(self):
+        infos = []
+        for version in range(4):
+            content = f'Package: foo\nVersion: {version}\n'.encode()
+            info = self.info.model_copy(update={'hashsum': hashlib.sha256(content).hexdigest(),
+                                                'filesize': len(content)})
+            self.write_upstream(f'dists/stable/{by_hash_path(info.filepath, info.hashsum)}', content)
+            infos.append(info)
+
+        removed = []
+        for version, info in enumerate(infos):
+            with Downloader(self.base_url, backoff=0) as downloader:
+                fetch_indexes(downloader, 'dists/stable', [info], self.mirror, acquire_by_hash=True)
+            publish_named(self.mirror, 'dists/stable', [info])
+            removed = retain_by_hash(self.mirror, 'dists/stable', release_content(f'Sat, 1{version} Feb 2024', info),
+                                     keep=2)
+
+        by_hash = os.path.join(self.mirror, 'dists/stable', os.path.dirname(by_hash_path(self.info.filepath, '')))
+        self.assertSetEqual({it.hashsum for it in infos[2:]}, set(os.listdir(by_hash)))
+        self.assertListEqual([os.path.join(by_hash, infos[1].hashsum)], removed)
+
+    def test_store_files_nothing_links_pruned(self):
+        store = os.path.join(self.mirror, '.by-hash')
+        infos = []
+        for version in range(2):
+            content = f'Package: foo\nVersion: {version}\n'.encode()
+            info = self.info.model_copy(update={'hashsum': hashlib.sha256(content).hexdigest(),
+                                                'filesize': len(content)})
+            self.write_upstream(f'dists/stable/{by_hash_path(info.filepath, info.hashsum)}', content)
+            infos.append(info)
+        with Downloader(self.base_url, backoff=0) as downloader:
+            fetch_indexes(downloader, 'dists/stable', infos, self.mirror, acquire_by_hash=True)
+        # Only the first index is still linked by the suite
+        os.remove(os.path.join(self.mirror, 'dists/stable', by_hash_path(self.info.filepath, infos[1].hashsum)))
+        # Download of another suite in progress
+        for suffix in ('.partial', '.partial.journal'):
+            with open(store_path(store, 'abc') + suffix, 'wb') as fp:
+                fp.write(b'a')
+
+        self.assertListEqual([store_path(store, infos[1].hashsum)], prune_store(self.mirror, dry_run=True))
+        self.assertListEqual([store_path(store, infos[1].hashsum)], prune_store(self.mirror))
+        self.assertSetEqual({infos[0].hashsum, 'abc.partial', 'abc.partial.journal'},
+                            set(os.listdir(os.path.join(store, 'SHA256'))))
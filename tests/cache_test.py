@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from cache import CACHED_FIELDS, IndexCache, RecordFile, write_records
+from packages import parse_package
+
+SHA256 = 'ab' * 32
+
+
+def cached_fields(package):
+    return {it: getattr(package, it) for it in CACHED_FIELDS}
+
+
+class IndexCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            self.content = fp.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compact_packages_round_trip(self):
+        packages = parse_package(self.content, record_type='compact')
+        cache = IndexCache(self.directory)
+
+        self.assertIsNone(cache.load(SHA256))
+        cache.store(SHA256, packages)
+        loaded = cache.load(SHA256)
+
+        self.assertIsInstance(loaded, RecordFile)
+        self.assertListEqual([cached_fields(it) for it in packages], [cached_fields(it) for it in loaded])
+        self.assertListEqual(packages[0].depends, loaded[0].depends)
+        # Only fields the planner reads are stored
+        self.assertIsNotNone(packages[0].description)
+        self.assertIsNone(loaded[0].description)
+
+    def test_pydantic_packages_stored(self):
+        packages = parse_package(self.content)
+        cache = IndexCache(self.directory)
+
+        cache.store(SHA256, packages)
+
+        self.assertListEqual([cached_fields(it) for it in packages],
+                             [cached_fields(it.to_package()) for it in cache.load(SHA256)])
+
+    def test_record_file_random_access(self):
+        packages = parse_package(self.content, record_type='compact')
+        path = os.path.join(self.directory, 'records')
+        write_records(path, packages)
+
+        with RecordFile(path) as records:
+            self.assertEqual(len(packages), len(records))
+            self.assertEqual(cached_fields(packages[-1]), cached_fields(records[-1]))
+            self.assertListEqual([cached_fields(it) for it in packages[1:3]],
+                                 [cached_fields(it) for it in records[1:3]])
+            with self.assertRaises(IndexError):
+                records[len(packages)]
+
+    def test_broken_file_is_miss(self):
+        cache = IndexCache(self.directory)
+        cache.store(SHA256, parse_package(self.content, record_type='compact'))
+        with open(cache.path(SHA256), 'r+b') as fp:
+            fp.truncate(os.path.getsize(cache.path(SHA256)) - 1)
+
+        self.assertIsNone(cache.load(SHA256))
+
+    def test_incompatible_file_rejected(self):
+        path = os.path.join(self.directory, 'records')
+        with open(path, 'wb') as fp:
+            fp.write(b'NOTCACHE' + bytes(64))
+
+        with self.assertRaises(AssertionError):
+            RecordFile(path)
+
+    def test_least_recently_used_evicted(self):
+        packages = parse_package(self.content, record_type='compact')
+        cache = IndexCache(self.directory)
+        for it in ('aa', 'bb', 'cc'):
+            cache.store(it * 32, packages)
+            os.utime(cache.path(it * 32), ns=(0, len(os.listdir(self.directory)) * 10 ** 9))
+        size = os.path.getsize(cache.path('aa' * 32))
+        # Loading marks aa as recently used
+        cache.load('aa' * 32)
+
+        cache.max_bytes = size * 2
+        removed = cache.evict()
+
+        self.assertListEqual([cache.path('bb' * 32)], removed)
+        self.assertCountEqual([os.path.basename(cache.path(it * 32)) for it in ('aa', 'cc')],
+                              os.listdir(self.directory))
@@ -0,0 +1,90 @@
+from unittest import TestCase
+
+from closure import Relation, dependency_closure, parse_relation
+from fixtures import make_package
+
+
+class ClosureTests(TestCase):
+    def test_relation_parsed(self):
+        self.assertEqual(Relation('python3', 'any', '>=', '3.11~'), parse_relation('python3:any (>= 3.11~)'))
+        self.assertEqual(Relation('foo'), parse_relation(' foo [amd64] <!nocheck>'))
+        self.assertEqual(Relation('foo', operator='<<', version='2'), parse_relation('foo (<< 2) '))
+
+    def test_transitive_closure(self):
+        packages = [
+            make_package('app', depends=['liba (>= 1.0)', 'libb']),
+            make_package('liba', depends=['libc6']),
+            make_package('libb', depends=['libc6 (>= 2.0)']),
+            make_package('libc6', '2.36'),
+            make_package('unrelated'),
+        ]
+
+        self.assertListEqual(packages[:4], dependency_closure(packages, ['app']))
+
+    def test_first_satisfiable_alternative_followed(self):
+        packages = [
+            make_package('app', depends=['missing | default-mta | postfix']),
+            make_package('default-mta', '1.0', depends=['exim4 (>= 2)']),
+            make_package('exim4', '1.0'),
+            make_package('exim4', '4.96'),
+            make_package('postfix'),
+        ]
+
+        self.assertListEqual([packages[0], packages[1], packages[3]], dependency_closure(packages, ['app']))
+        self.assertListEqual([packages[0], packages[1], packages[3], packages[4]],
+                             dependency_closure(packages, ['app'], all_alternatives=True))
+
+    def test_virtual_package_providers(self):
+        packages = [
+            make_package('app', depends=['mail-transport-agent', 'awk (>= 1)']),
+            make_package('postfix', provides=['mail-transport-agent']),
+            make_package('gawk', provides=['awk']),
+            make_package('mawk', provides=['awk (= 1.3)']),
+        ]
+
+        self.assertListEqual([packages[0], packages[1], packages[3]], dependency_closure(packages, ['app']))
+
+    def test_arch_qualifier(self):
+        packages = [
+            make_package('app', depends=['libfoo:i386']),
+            make_package('libfoo', architecture='amd64'),
+            make_package('libfoo', architecture='i386'),
+        ]
+
+        self.assertListEqual([packages[0], packages[2]], dependency_closure(packages, ['app']))
+
+    def test_dependencies_of_own_architecture(self):
+        packages = [
+            make_package('app', architecture='amd64', depends=['libfoo', 'tool:any', 'data']),
+            make_package('libfoo', architecture='amd64'),
+            make_package('libfoo', architecture='i386'),
+            make_package('tool', architecture='i386'),
+            make_package('data', architecture='all', depends=['libbar']),
+            make_package('libbar', architecture='amd64'),
+            make_package('libbar', architecture='i386'),
+        ]
+
+        # Arch all data resolves its relations for amd64 app which pulled it in
+        self.assertListEqual([packages[0], packages[1], packages[3], packages[4], packages[5]],
+                             dependency_closure(packages, ['app']))
+
+    def test_seed_of_every_architecture(self):
+        packages = [
+            make_package('app', architecture='amd64', depends=['libfoo']),
+            make_package('app', architecture='i386', depends=['libfoo']),
+            make_package('libfoo', architecture='amd64'),
+            make_package('libfoo', architecture='i386'),
+        ]
+
+        self.assertListEqual(packages, dependency_closure(packages, ['app']))
+        self.assertListEqual([packages[1], packages[3]], dependency_closure(packages, ['app:i386']))
+
+    def test_large_graph(self):
+        count = 60000
+        packages = [make_package(f'p{it}', depends=[f'p{it + 1} (>= 1.0) | p{it + 2}', f'v{it % 100}'],
+                                 provides=[f'v{it % 100}']) for it in range(count)]
+
+        closure = dependency_closure(packages, ['p0'])
+
+        self.assertEqual(count, len(closure))
+        self.assertListEqual(packages, closure)
@@ -0,0 +1,37 @@
+import bz2
+import gzip
+import io
+import lzma
+from unittest import TestCase
+
+from compression import iter_index_packages, select_index_variant, strip_compression_extension
+from packages import parse_package
+from release import parse_release
+
+
+class CompressionTests(TestCase):
+    def setUp(self):
+        with open('test_data/PackagesAbridged', 'rb') as fp:
+            self.content = fp.read()
+        self.expected = parse_package(self.content.decode())
+
+    def test_compressed_indexes_parsed(self):
+        compressed = {
+            'main/binary-amd64/Packages.xz': lzma.compress(self.content),
+            'main/binary-amd64/Packages.gz': gzip.compress(self.content),
+            'main/binary-amd64/Packages.bz2': bz2.compress(self.content),
+            'main/binary-amd64/Packages': self.content,
+        }
+
+        for filepath, data in compressed.items():
+            packages = list(iter_index_packages(io.BytesIO(data), filepath, chunk_size=16))
+            self.assertListEqual(self.expected, packages, filepath)
+
+    def test_smallest_variant_selected(self):
+        with open('test_data/Release', 'r') as fp:
+            release = parse_release(fp.read())
+
+        variant = select_index_variant(release, 'contrib/Contents-all')
+
+        self.assertEqual('contrib/Contents-all.gz', variant.filepath)
+        self.assertEqual('contrib/Contents-all', strip_compression_extension(variant.filepath))
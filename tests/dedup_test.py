@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from dedup import DedupIndex, clone_file, link_duplicates, unique_packages, unique_tasks
+from downloader import package_tasks
+from fixtures import make_package
+
+
+class DedupTests(TestCase):
+    def setUp(self):
+        self.mirror = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror)
+
+    def test_arch_all_listed_once(self):
+        amd64 = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        arm64 = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        other = make_package(filename='pool/main/bar_1.0_amd64.deb', architecture='amd64', content=b'other')
+
+        self.assertListEqual([amd64, other], unique_packages([amd64, other, arm64]))
+
+    def test_same_content_under_different_names(self):
+        first = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        second = make_package(filename='pool/updates/foo_1.0_all.deb', architecture='all')
+        index = DedupIndex()
+
+        self.assertListEqual([first], unique_packages([first, second], index))
+        self.assertListEqual([[first.filename, second.filename]], list(index.duplicates().values()))
+
+    def test_duplicates_linked(self):
+        first = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        second = make_package(filename='pool/updates/foo_1.0_all.deb', architecture='all')
+        missing = make_package(filename='pool/main/bar_1.0_all.deb', architecture='all', content=b'bar')
+        missing_copy = make_package(filename='pool/updates/bar_1.0_all.deb', architecture='all', content=b'bar')
+        index = DedupIndex()
+        index.add_packages([first, second, missing, missing_copy])
+        os.makedirs(os.path.join(self.mirror, 'pool/main'))
+        with open(os.path.join(self.mirror, first.filename), 'wb') as fp:
+            fp.write(b'content')
+
+        report = link_duplicates(index, self.mirror)
+        again = link_duplicates(index, self.mirror)
+
+        self.assertListEqual([second.filename], report.linked)
+        self.assertEqual(first.size, report.saved_bytes)
+        self.assertEqual(1, report.unavailable)
+        self.assertListEqual([], again.linked)
+        self.assertTrue(os.path.samefile(os.path.join(self.mirror, first.filename),
+                                         os.path.join(self.mirror, second.filename)))
+
+    def write(self, filename: str, content: bytes) -> None:
+        path = os.path.join(self.mirror, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+
+    def test_stale_file_of_same_size_not_linked(self):
+        first = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        second = make_package(filename='pool/updates/foo_1.0_all.deb', architecture='all')
+        index = DedupIndex()
+        index.add_packages([first, second])
+        # Left by an earlier version whose download of the new one failed
+        self.write(first.filename, b'CONTENT')
+
+        report = link_duplicates(index, self.mirror)
+
+        self.assertListEqual([], report.linked)
+        self.assertEqual(1, report.unavailable)
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, second.filename)))
+
+    def test_verified_copy_not_downloaded_again(self):
+        stored = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        new = make_package(filename='pool/updates/foo_1.0_all.deb', architecture='all')
+        other = make_package('bar', content=b'bar')
+        self.write(stored.filename, b'content')
+        index = DedupIndex()
+        index.add_packages([stored, new, other])
+        index.verified[stored.filename] = stored.hashes['SHA256']
+
+        tasks = unique_tasks(package_tasks([new, other], self.mirror), index, self.mirror)
+        report = link_duplicates(index, self.mirror)
+
+        self.assertListEqual([other.filename], [it.path for it in tasks])
+        self.assertListEqual([new.filename], report.linked)
+
+    def test_unverified_copy_hashed_before_download_dropped(self):
+        stored = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        new = make_package(filename='pool/updates/foo_1.0_all.deb', architecture='all')
+        stale = make_package('bar', filename='pool/main/bar_1.0_all.deb', content=b'bar')
+        stale_copy = make_package('bar', filename='pool/updates/bar_1.0_all.deb', content=b'bar')
+        # Mirror without state, nothing is known to be verified
+        self.write(stored.filename, b'content')
+        self.write(stale.filename, b'BAR')
+        index = DedupIndex()
+        index.add_packages([stored, new, stale, stale_copy])
+
+        tasks = unique_tasks(package_tasks([new, stale_copy], self.mirror), index, self.mirror)
+
+        self.assertListEqual([stale_copy.filename], [it.path for it in tasks])
+        self.assertDictEqual({stored.filename: stored.hashes['SHA256']}, index.verified)
+
+    def test_copies_save_nothing(self):
+        first = make_package(filename='pool/main/foo_1.0_all.deb', architecture='all')
+        second = make_package(filename='pool/updates/foo_1.0_all.deb', architecture='all')
+        index = DedupIndex()
+        index.add_packages([first, second])
+        self.write(first.filename, b'content')
+
+        def copy(source: str, destination: str) -> str:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(source, destination)
+            return 'copy'
+
+        with mock.patch('dedup.clone_file', copy):
+            report = link_duplicates(index, self.mirror)
+
+        self.assertListEqual([second.filename], report.linked)
+        self.assertEqual(0, report.saved_bytes)
+
+    def test_clone_replaces_destination(self):
+        source, destination = os.path.join(self.mirror, 'source'), os.path.join(self.mirror, 'a/destination')
+        with open(source, 'wb') as fp:
+            fp.write(b'new')
+        os.makedirs(os.path.dirname(destination))
+        with open(destination, 'wb') as fp:
+            fp.write(b'old')
+
+        self.assertIn(clone_file(source, destination), ('hardlink', 'reflink', 'copy'))
+
+        with open(destination, 'rb') as fp:
+            self.assertEqual(b'new', fp.read())
+        self.assertListEqual(['destination'], os.listdir(os.path.dirname(destination)))
@@ -0,0 +1,181 @@
+import hashlib
+import os
+from typing import Optional
+
+from downloader import DownloadError, DownloadTask, Downloader, HttpValidator, JOURNAL_SUFFIX, PARTIAL_SUFFIX, \
+    PartialJournal, package_tasks
+from metrics import Metrics, set_metrics
+from mirror_server import MirrorRequestHandler, MirrorServerTestCase
+from packages import Package
+
+
+class DownloaderTests(MirrorServerTestCase):
+    def test_packages_downloaded(self):
+        packages = []
+        for index in range(20):
+            filename = f'pool/main/f/foo{index}/foo{index}_1.0_amd64.deb'
+            self.write_upstream(filename, b'x' * index)
+            packages.append(Package(package=f'foo{index}', version='1.0', architecture='amd64', filename=filename,
+                                    size=index, hashes={}))
+
+        with Downloader(self.base_url, parallelism=4, backoff=0) as downloader:
+            results = downloader.download_all(package_tasks(packages, self.mirror))
+
+        self.assertTrue(all(it.success for it in results))
+        for index, package in enumerate(packages):
+            with open(os.path.join(self.mirror, package.filename), 'rb') as fp:
+                self.assertEqual(b'x' * index, fp.read())
+        # Keep-alive connections are reused between files
+        self.assertLessEqual(len(MirrorRequestHandler.client_ports), 4)
+
+    def test_retry_after_server_error(self):
+        self.write_upstream('pool/foo.deb', b'content')
+        MirrorRequestHandler.failures['/debian/pool/foo.deb'] = 2
+
+        with Downloader(self.base_url, retries=2, backoff=0) as downloader:
+            result = downloader.download(DownloadTask(path='pool/foo.deb',
+                                                      destination=os.path.join(self.mirror, 'pool/foo.deb')))
+
+        self.assertTrue(result.success)
+        self.assertEqual(3, result.attempts)
+
+    def test_missing_file_not_retried(self):
+        with Downloader(self.base_url, retries=3, backoff=0) as downloader:
+            result = downloader.download(DownloadTask(path='pool/missing.deb',
+                                                      destination=os.path.join(self.mirror, 'pool/missing.deb')))
+            with self.assertRaises(DownloadError):
+                downloader.fetch_bytes('dists/stable/Release')
+
+        self.assertFalse(result.success)
+        self.assertEqual(1, result.attempts)
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, 'pool/missing.deb')))
+
+    def test_size_mismatch_fails(self):
+        self.write_upstream('pool/foo.deb', b'content')
+
+        with Downloader(self.base_url, retries=1, backoff=0) as downloader:
+            result = downloader.download(DownloadTask(path='pool/foo.deb', size=3,
+                                                      destination=os.path.join(self.mirror, 'pool/foo.deb')))
+
+        self.assertFalse(result.success)
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, 'pool/foo.deb')))
+
+    def test_hashes_verified_while_downloading(self):
+        self.write_upstream('pool/foo.deb', b'content')
+        sha256 = hashlib.sha256(b'content').hexdigest()
+
+        with Downloader(self.base_url, retries=1, backoff=0) as downloader:
+            good = downloader.download(DownloadTask(path='pool/foo.deb', hashes={'SHA256': sha256},
+                                                    destination=os.path.join(self.mirror, 'pool/foo.deb')))
+            bad = downloader.download(DownloadTask(path='pool/foo.deb', hashes={'SHA256': 'ff' * 32},
+                                                   destination=os.path.join(self.mirror, 'pool/bar.deb')))
+
+        self.assertTrue(good.success)
+        self.assertEqual(sha256, good.hashes['SHA256'])
+        self.assertFalse(bad.success)
+        self.assertIn('SHA256 mismatch', bad.error)
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, 'pool/bar.deb')))
+
+    def test_path_outside_of_mirror_rejected(self):
+        package = Package(package='foo', version='1.0', architecture='amd64', filename='../../etc/passwd', size=1,
+                          hashes={})
+
+        with self.assertRaises(ValueError):
+            package_tasks([package], self.mirror)
+
+    def write_partial(self, task: DownloadTask, content: bytes, validator: Optional[str] = None) -> None:
+        os.makedirs(os.path.dirname(task.destination), exist_ok=True)
+        with open(task.destination + PARTIAL_SUFFIX, 'wb') as fp:
+            fp.write(content)
+        with open(task.destination + JOURNAL_SUFFIX, 'w') as fp:
+            fp.write(PartialJournal(path=task.path, size=task.size, hashes=task.hashes,
+                                    validator=validator).model_dump_json())
+
+    def make_task(self, content: bytes) -> DownloadTask:
+        return DownloadTask(path='pool/foo.deb', destination=os.path.join(self.mirror, 'pool/foo.deb'),
+                            size=len(content), hashes={'SHA256': hashlib.sha256(content).hexdigest()})
+
+    def test_interrupted_download_resumed(self):
+        content = bytes(range(256)) * 100
+        self.write_upstream('pool/foo.deb', content)
+        task = self.make_task(content)
+        self.write_partial(task, content[:10000])
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            result = downloader.download(task)
+
+        self.assertTrue(result.success)
+        self.assertEqual(10000, result.resumed_bytes)
+        self.assertEqual(len(content) - 10000, result.downloaded_bytes)
+        self.assertListEqual(['bytes=10000-'], MirrorRequestHandler.ranges)
+        with open(task.destination, 'rb') as fp:
+            self.assertEqual(content, fp.read())
+        self.assertListEqual(['foo.deb'], os.listdir(os.path.dirname(task.destination)))
+
+    def test_changed_upstream_file_downloaded_whole(self):
+        content = b'new content'
+        self.write_upstream('pool/foo.deb', content)
+        task = self.make_task(content)
+        self.write_partial(task, b'old', validator='Thu, 01 Jan 1970 00:00:00 GMT')
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            result = downloader.download(task)
+
+        self.assertTrue(result.success)
+        self.assertEqual(0, result.resumed_bytes)
+        self.assertEqual(len(content), result.downloaded_bytes)
+
+    def test_corrupted_partial_file_discarded(self):
+        content = b'content'
+        self.write_upstream('pool/foo.deb', content)
+        task = self.make_task(content)
+        self.write_partial(task, b'xxx')
+
+        with Downloader(self.base_url, retries=1, backoff=0) as downloader:
+            result = downloader.download(task)
+
+        self.assertTrue(result.success)
+        self.assertEqual(2, result.attempts)
+        self.assertListEqual(['bytes=3-', None], MirrorRequestHandler.ranges)
+
+    def test_complete_files_not_transferred(self):
+        content = b'content'
+        task = self.make_task(content)
+        # Download finished before crash, only rename is left
+        self.write_partial(task, content)
+        other = DownloadTask(path='pool/bar.deb', destination=os.path.join(self.mirror, 'pool/bar.deb'),
+                             size=len(content), hashes=task.hashes)
+        # Only size is known, file is not hashed
+        unhashed = DownloadTask(path='pool/baz.deb', destination=os.path.join(self.mirror, 'pool/baz.deb'),
+                                size=len(content))
+        for it in (other, unhashed):
+            with open(it.destination, 'wb') as fp:
+                fp.write(content)
+        metrics = set_metrics(Metrics())
+        self.addCleanup(set_metrics, None)
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            results = downloader.download_all([task, other, unhashed])
+
+        self.assertTrue(all(it.success for it in results))
+        self.assertEqual(0, results[1].attempts)
+        self.assertEqual(0, results[2].attempts)
+        self.assertDictEqual({(('source', 'file'),): len(content)}, metrics.counters['hashed_bytes_total'])
+        self.assertListEqual([], MirrorRequestHandler.requested_paths)
+        self.assertTrue(os.path.isfile(task.destination))
+
+    def test_conditional_fetch(self):
+        self.write_upstream('dists/stable/Release', b'release')
+
+        with Downloader(self.base_url, backoff=0) as downloader:
+            content, validator = downloader.fetch_conditional('dists/stable/Release')
+            not_modified, same = downloader.fetch_conditional('dists/stable/Release', validator)
+            os.utime(os.path.join(self.upstream, 'debian/dists/stable/Release'), (2 * 10 ** 9, 2 * 10 ** 9))
+            changed, _ = downloader.fetch_conditional('dists/stable/Release', HttpValidator(
+                last_modified='Sat, 10 Feb 2024 11:07:25 GMT'))
+
+        self.assertEqual(b'release', content)
+        self.assertIsNotNone(validator.last_modified)
+        self.assertIsNone(not_modified)
+        self.assertEqual(validator, same)
+        self.assertEqual(b'release', changed)
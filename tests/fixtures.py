@@ -0,0 +1,12 @@
+import hashlib
+from typing import Any, Optional
+
+from packages import Package
+
+
+def make_package(name: str = 'foo', version: str = '1.0', architecture: str = 'amd64', content: bytes = b'content',
+                 filename: Optional[str] = None, **fields: Any) -> Package:
+    # Package of a pool file holding content, pool/main/<name>_<version>_<architecture>.deb unless filename is given
+    return Package(package=name, version=version, architecture=architecture,
+                   filename=filename or f'pool/main/{name}_{version}_{architecture}.deb', size=len(content),
+                   hashes={'SHA256': hashlib.sha256(content).hexdigest()}, **fields)
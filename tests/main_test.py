@@ -0,0 +1,154 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Sequence
+
+from cache import IndexCache
+from downloader import DownloadTask
+from main import main, read_index
+from metrics import Metrics, set_metrics
+from mirror_server import MirrorRequestHandler, MirrorServerTestCase
+from state import MirrorState
+
+
+class MainTests(MirrorServerTestCase):
+    # Requested by a run skipped for unchanged Release
+    release_paths = ['/debian/dists/stable/Release', '/debian/dists/stable/InRelease',
+                     '/debian/dists/stable/Release.gpg']
+
+    def setUp(self):
+        super().setUp()
+        with open('test_data/Release', 'r') as fp:
+            header = fp.read().split('MD5Sum:')[0]
+        indexes: Dict[str, bytes] = {}
+        for architecture in ('amd64', 'i386'):
+            stanzas = []
+            for version in ('1.0', '0.9'):
+                content = f'app {version} {architecture}'.encode()
+                filename = f'pool/main/a/app/app_{version}_{architecture}.deb'
+                self.write_upstream(filename, content)
+                stanzas.append(f'Package: app\nVersion: {version}\nArchitecture: {architecture}\n'
+                               f'Section: utils\nFilename: {filename}\nSize: {len(content)}\n'
+                               f'SHA256: {hashlib.sha256(content).hexdigest()}\n')
+            indexes[f'main/binary-{architecture}/Packages'] = '\n'.join(stanzas).encode()
+        for path, content in indexes.items():
+            self.write_upstream(f'dists/stable/{path}', content)
+        files = ''.join(f' {hashlib.sha256(content).hexdigest()} {len(content)} {path}\n'
+                        for path, content in indexes.items())
+        self.write_upstream('dists/stable/Release', f'{header}SHA256:\n{files}'.encode())
+        self.write_upstream('dists/stable/InRelease', b'signed Release')
+        self.write_upstream('dists/stable/Release.gpg', b'signature')
+        state = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+        state.close()
+        self.state = state.name
+
+    def tearDown(self):
+        super().tearDown()
+        os.remove(self.state)
+
+    def run_main(self, *architectures: str, options: Sequence[str] = (), code: int = 0) -> List[str]:
+        # Paths requested from upstream
+        MirrorRequestHandler.requested_paths = []
+        arguments = [self.base_url, self.mirror, '--suite', 'stable', '--component', 'main', '--state', self.state,
+                     *options]
+        for it in architectures:
+            arguments += ['--architecture', it]
+
+        self.assertEqual(code, main(arguments))
+        return MirrorRequestHandler.requested_paths
+
+    def test_unchanged_release_skipped_for_same_config_only(self):
+        self.run_main('amd64')
+
+        self.assertListEqual(self.release_paths, self.run_main('amd64'))
+        self.assertIn('/debian/pool/main/a/app/app_1.0_i386.deb', self.run_main('amd64', 'i386'))
+        self.assertTrue(os.path.isfile(os.path.join(self.mirror, 'pool/main/a/app/app_1.0_i386.deb')))
+        self.assertListEqual(self.release_paths, self.run_main('i386', 'amd64'))
+
+    def test_changed_keep_versions_plans_indexes_again(self):
+        self.run_main('amd64', options=['--keep-versions', '1'])
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, 'pool/main/a/app/app_0.9_amd64.deb')))
+
+        self.assertIn('/debian/pool/main/a/app/app_0.9_amd64.deb', self.run_main('amd64'))
+        self.assertTrue(os.path.isfile(os.path.join(self.mirror, 'pool/main/a/app/app_0.9_amd64.deb')))
+        self.assertListEqual(self.release_paths, self.run_main('amd64'))
+
+    def test_index_cache_not_recorded_in_state(self):
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        self.run_main('amd64', options=['--index-cache', cache])
+        # Index is recorded again while its cached records exist
+        self.run_main('amd64', options=['--index-cache', cache, '--keep-versions', '1'])
+
+        with MirrorState(self.state) as state:
+            packages = state.load_packages('dists/stable', 'main/binary-amd64/Packages')
+        self.assertListEqual(['utils'], [it.section for it in packages])
+
+    def test_cached_index_looked_up_by_known_hash(self):
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        path = os.path.join(self.upstream, 'debian/dists/stable/main/binary-amd64/Packages')
+        with open(path, 'rb') as fp:
+            sha256 = hashlib.sha256(fp.read()).hexdigest()
+        task = DownloadTask(path='dists/stable/main/binary-amd64/Packages', destination=path,
+                            hashes={'SHA256': sha256})
+        read_index(task, cache=IndexCache(cache))
+        metrics = set_metrics(Metrics())
+        self.addCleanup(set_metrics, None)
+
+        self.assertEqual(2, len(read_index(task, cache=IndexCache(cache))))
+        # Neither hashed nor parsed again
+        self.assertNotIn('hashed_bytes_total', metrics.counters)
+        self.assertNotIn('stanzas_parsed_total', metrics.counters)
+
+    def test_removed_and_damaged_pool_files_fetched_again(self):
+        self.run_main('amd64')
+        removed = os.path.join(self.mirror, 'pool/main/a/app/app_1.0_amd64.deb')
+        damaged = os.path.join(self.mirror, 'pool/main/a/app/app_0.9_amd64.deb')
+        os.remove(removed)
+        stat = os.stat(damaged)
+        with open(damaged, 'r+b') as fp:
+            fp.write(b'X')
+        # Keeps size and mtime, only hashing tells the file is damaged
+        os.utime(damaged, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        requested = self.run_main('amd64', options=['--keep-versions', '2', '--verify-pool'])
+        self.assertIn('/debian/pool/main/a/app/app_1.0_amd64.deb', requested)
+        self.assertIn('/debian/pool/main/a/app/app_0.9_amd64.deb', requested)
+        with open(damaged, 'rb') as fp:
+            self.assertEqual(b'app 0.9 amd64', fp.read())
+
+    def test_signatures_published_and_revalidated(self):
+        self.run_main('amd64')
+        with open(os.path.join(self.mirror, 'dists/stable/InRelease'), 'rb') as fp:
+            self.assertEqual(b'signed Release', fp.read())
+
+        # Signature changed upstream while Release did not
+        self.write_upstream('dists/stable/InRelease', b'signed Release again')
+        # Last-Modified has a resolution of seconds
+        path = os.path.join(self.upstream, 'debian/dists/stable/InRelease')
+        os.utime(path, (os.stat(path).st_mtime + 10, os.stat(path).st_mtime + 10))
+        os.remove(os.path.join(self.upstream, 'debian/dists/stable/Release.gpg'))
+        self.run_main('amd64')
+        with open(os.path.join(self.mirror, 'dists/stable/InRelease'), 'rb') as fp:
+            self.assertEqual(b'signed Release again', fp.read())
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, 'dists/stable/Release.gpg')))
+
+    def test_signatures_staged_in_snapshot(self):
+        self.run_main('amd64', options=['--snapshots', '2'])
+
+        live = os.path.join(self.mirror, 'dists/stable')
+        self.assertTrue(os.path.islink(live))
+        self.assertCountEqual(['Release', 'InRelease', 'Release.gpg'],
+                              [it for it in os.listdir(live) if it.startswith(('Release', 'InRelease'))])
+
+    def test_failed_sync_not_published(self):
+        self.run_main('amd64', options=['--snapshots', '2', '--keep-versions', '1'])
+        live = os.path.join(self.mirror, 'dists/stable')
+        snapshot = os.readlink(live)
+        os.remove(os.path.join(self.upstream, 'debian/pool/main/a/app/app_0.9_amd64.deb'))
+
+        self.run_main('amd64', options=['--snapshots', '2', '--retries', '0'], code=1)
+        self.assertEqual(snapshot, os.readlink(live))
+        self.assertListEqual([os.path.basename(snapshot)], os.listdir(os.path.dirname(os.path.realpath(live))))
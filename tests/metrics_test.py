@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from unittest import TestCase
+
+from metrics import Metrics, NullMetrics, get_metrics, profile_hook, set_metrics
+from packages import parse_package
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        set_metrics(None)
+        shutil.rmtree(self.directory)
+
+    def test_prometheus_format(self):
+        metrics = Metrics()
+        metrics.increment('downloaded_bytes_total', 10, host='a')
+        metrics.increment('downloaded_bytes_total', 5, host='a')
+        metrics.set_gauge('download_queue_depth', 3)
+        metrics.observe('http_request_seconds', 0.003, host='a')
+        metrics.observe('http_request_seconds', 1000, host='a')
+
+        lines = metrics.to_prometheus().splitlines()
+
+        self.assertIn('# TYPE mirror_downloaded_bytes_total counter', lines)
+        self.assertIn('mirror_downloaded_bytes_total{host="a"} 15', lines)
+        self.assertIn('mirror_download_queue_depth 3', lines)
+        self.assertIn('mirror_http_request_seconds_bucket{host="a",le="0.001"} 0', lines)
+        self.assertIn('mirror_http_request_seconds_bucket{host="a",le="0.005"} 1', lines)
+        self.assertIn('mirror_http_request_seconds_bucket{host="a",le="+Inf"} 2', lines)
+        self.assertIn('mirror_http_request_seconds_count{host="a"} 2', lines)
+
+    def test_json_written(self):
+        metrics = Metrics()
+        metrics.increment('stanzas_parsed_total', 2, record_type='compact')
+        path = os.path.join(self.directory, 'metrics.json')
+
+        metrics.write(path)
+
+        with open(path, 'r') as fp:
+            content = json.load(fp)
+        self.assertListEqual([{'labels': {'record_type': 'compact'}, 'value': 2}],
+                             content['counters']['stanzas_parsed_total'])
+        self.assertListEqual(['metrics.json'], os.listdir(self.directory))
+
+    def test_phase_hooks_and_profile(self):
+        calls = []
+
+        @contextmanager
+        def hook(name):
+            calls.append(f'{name} start')
+            yield
+            calls.append(f'{name} end')
+
+        metrics = Metrics([hook, profile_hook(self.directory)])
+        with metrics.phase('plan'):
+            pass
+
+        self.assertListEqual(['plan start', 'plan end'], calls)
+        self.assertEqual(1, metrics.histograms['phase_seconds'][(('phase', 'plan'),)].count)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'plan.prof')))
+
+    def test_parsing_instrumented(self):
+        content = 'Package: foo\nVersion: 1\nArchitecture: all\nFilename: foo.deb\nSize: 1\n\n' * 3
+        metrics = set_metrics(Metrics())
+
+        parse_package(content, record_type='compact')
+        parse_package(content.encode(), record_type='pydantic')
+
+        self.assertDictEqual({(('record_type', 'compact'),): 3, (('record_type', 'pydantic'),): 3},
+                             metrics.counters['stanzas_parsed_total'])
+        self.assertIn((('record_type', 'pydantic'),), metrics.counters['record_construction_seconds_total'])
+
+    def test_disabled_by_default(self):
+        self.assertIsInstance(get_metrics(), NullMetrics)
+        with get_metrics().phase('plan'), get_metrics().timer('parse_seconds'):
+            get_metrics().increment('stanzas_parsed_total')
+
+        self.assertDictEqual({}, get_metrics().counters)
@@ -0,0 +1,90 @@
+import functools
+import os
+import shutil
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+
+class MirrorRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Path -> number of 503 responses left before the file is served
+    failures = {}
+    client_ports = set()
+    requested_paths = []
+    # Range headers of requests, None for requests without one
+    ranges = []
+
+    def do_GET(self):
+        self.client_ports.add(self.client_address[1])
+        self.requested_paths.append(self.path)
+        self.ranges.append(self.headers.get('Range'))
+        if self.failures.get(self.path, 0) > 0:
+            self.failures[self.path] -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('Range') is not None:
+            self.send_range()
+            return
+        super().do_GET()
+
+    def send_range(self):
+        # Only 'bytes=N-' ranges are supported, which is what resumed downloads send
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        last_modified = self.date_time_string(int(os.stat(path).st_mtime))
+        if self.headers.get('If-Range', last_modified) != last_modified:
+            start = 0
+        else:
+            start = int(self.headers['Range'].removeprefix('bytes=').rstrip('-'))
+        if start >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(206 if start != 0 else 200)
+        if start != 0:
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        self.send_header('Content-Length', str(len(content) - start))
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class MirrorServerTestCase(TestCase):
+    # Serves temporary upstream directory over HTTP. Files are served under /debian
+    def setUp(self):
+        self.upstream = tempfile.mkdtemp()
+        self.mirror = tempfile.mkdtemp()
+        MirrorRequestHandler.failures = {}
+        MirrorRequestHandler.client_ports = set()
+        MirrorRequestHandler.requested_paths = []
+        MirrorRequestHandler.ranges = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          functools.partial(MirrorRequestHandler, directory=self.upstream))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/debian'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.upstream)
+        shutil.rmtree(self.mirror)
+
+    def write_upstream(self, path: str, content: bytes) -> None:
+        path = os.path.join(self.upstream, 'debian', path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(content)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import random
+
+from downloader import DownloadTask, Downloader
+from mirror_server import MirrorRequestHandler, MirrorServerTestCase
+from mirrors import MirrorProbe, MirrorSet, fresh_mirrors
+from release import parse_release
+
+
+class MirrorSetTests(MirrorServerTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('test_data/Release', 'r') as fp:
+            self.release = fp.read()
+        self.second_url = self.base_url.replace('/debian', '/second')
+
+    def write_second(self, path: str, content: bytes) -> None:
+        path = os.path.join(self.upstream, 'second', path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+
+    def make_set(self, **kwargs) -> MirrorSet:
+        downloaders = [Downloader(it, backoff=0, **kwargs) for it in (self.base_url, self.second_url)]
+        return MirrorSet(downloaders, parallelism=4, rng=random.Random(0))
+
+    def test_stale_mirror_skipped(self):
+        stale = self.release.replace('Sat, 10 Feb 2024', 'Sat, 03 Feb 2024')
+        self.write_upstream('dists/stable/Release', stale.encode())
+        self.write_second('dists/stable/Release', self.release.encode())
+
+        with self.make_set() as mirrors:
+            content = mirrors.probe('dists/stable/Release')
+
+        self.assertEqual(self.release.encode(), content)
+        self.assertListEqual([1], mirrors.fresh)
+        self.assertListEqual([f'{self.base_url}: stale Release of {parse_release(stale).date}'],
+                             mirrors.skipped())
+
+    def test_unmodified_release_revalidated(self):
+        self.write_upstream('dists/stable/Release', self.release.encode())
+        self.write_second('dists/stable/Release', self.release.encode())
+
+        with self.make_set() as mirrors:
+            mirrors.probe('dists/stable/Release')
+            validators = mirrors.release_validators('dists/stable/Release')
+            self.assertFalse(mirrors.not_modified())
+            previous = self.release.replace('Released 10 February', 'Published 10 February').encode()
+            throughputs = list(mirrors.throughputs)
+            content = mirrors.probe('dists/stable/Release', validators, previous)
+
+        self.assertTrue(mirrors.not_modified())
+        self.assertEqual(previous, content)
+        self.assertEqual(2, len(validators))
+        # Nothing was transferred, so throughput is not measured
+        self.assertListEqual(throughputs, mirrors.throughputs)
+
+    def test_fresh_mirrors_compare_hashes(self):
+        release = parse_release(self.release)
+        sha256 = release.files_by_hash['SHA256'][0].hashsum
+        changed = parse_release(self.release.replace(sha256, '0' * 64))
+        probes = [MirrorProbe(url='a', release=release), MirrorProbe(url='b', error='down'),
+                  MirrorProbe(url='c', release=changed), MirrorProbe(url='d', release=release)]
+
+        self.assertListEqual([0, 3], fresh_mirrors(probes))
+        self.assertListEqual([], fresh_mirrors([MirrorProbe(url='b', error='down')]))
+
+    def test_failed_file_retried_on_other_mirror(self):
+        content = b'package content'
+        self.write_second('pool/foo.deb', content)
+        destination = os.path.join(self.mirror, 'pool/foo.deb')
+        task = DownloadTask(path='pool/foo.deb', destination=destination, size=len(content),
+                            hashes={'SHA256': hashlib.sha256(content).hexdigest()})
+
+        with self.make_set(retries=0) as mirrors:
+            mirrors.throughputs = [1000.0, 1.0]
+            result = mirrors.download(task)
+
+        self.assertTrue(result.success)
+        self.assertListEqual(['/debian/pool/foo.deb', '/second/pool/foo.deb'], MirrorRequestHandler.requested_paths)
+        with open(destination, 'rb') as fp:
+            self.assertEqual(content, fp.read())
+
+    def test_downloads_spread_by_throughput(self):
+        tasks = []
+        for position in range(40):
+            content = f'package {position}'.encode()
+            self.write_upstream(f'pool/{position}.deb', content)
+            self.write_second(f'pool/{position}.deb', content)
+            tasks.append(DownloadTask(path=f'pool/{position}.deb',
+                                      destination=os.path.join(self.mirror, f'pool/{position}.deb')))
+
+        with self.make_set() as mirrors:
+            mirrors.throughputs = [9000.0, 1000.0]
+            mirrors._record_success = lambda *args: None
+            results = mirrors.download_all(tasks)
+
+        self.assertTrue(all(it.success for it in results))
+        second = sum(it.startswith('/second/') for it in MirrorRequestHandler.requested_paths)
+        self.assertGreater(second, 0)
+        self.assertLess(second, 20)
+
+    def test_all_mirrors_failing(self):
+        task = DownloadTask(path='pool/missing.deb', destination=os.path.join(self.mirror, 'pool/missing.deb'))
+
+        with self.make_set(retries=0) as mirrors:
+            result = mirrors.download(task)
+
+        self.assertFalse(result.success)
+        self.assertEqual(2, result.attempts)
+        self.assertListEqual(['/debian/pool/missing.deb', '/second/pool/missing.deb'],
+                             sorted(MirrorRequestHandler.requested_paths))
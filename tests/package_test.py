@@ -1,6 +1,9 @@
+import io
 from unittest import TestCase
 
-from packages import parse_package, Package, package_difference_diff
+from fixtures import make_package
+from packages import parse_package, Package, package_difference_diff, iter_packages, CompactPackage, \
+    parse_package_file, latest_versions
 
 
 class PackageTests(TestCase):
@@ -37,6 +40,19 @@ class PackageTests(TestCase):
 
         self.assertListEqual([new_package], new_packages)
 
+    def test_package_difference_several_versions(self):
+        first_packages = [make_package('foo', '1.0'), make_package('foo', '1:1.1'), make_package('foo', '1.2')]
+        second_packages = [make_package('foo', '1.0'), make_package('foo', '1:1.1-0')]
+
+        self.assertListEqual([first_packages[2]], package_difference_diff(first_packages, second_packages))
+
+    def test_latest_versions_kept(self):
+        packages = [make_package('foo', '1.0'), make_package('foo', '1.10'), make_package('foo', '1.9~rc1'),
+                    make_package('foo', '1.0', 'arm64'), make_package('bar', '2.0')]
+
+        self.assertListEqual([packages[1], packages[3], packages[4]], latest_versions(packages))
+        self.assertListEqual([packages[1], packages[2], packages[3], packages[4]], latest_versions(packages, 2))
+
     def test_package_parsed_full(self):
         with open('test_data/Packages', 'r') as fp:
             content = fp.read()
@@ -103,3 +119,97 @@ class PackageTests(TestCase):
         )
 
         self.assertCountEqual([package1, package2], package_list)
+
+    def test_iter_packages_binary_and_text(self):
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            expected = parse_package(fp.read())
+
+        with open('test_data/PackagesAbridged', 'rb') as fp:
+            # Tiny chunks split lines and multibyte characters between reads
+            binary_packages = list(iter_packages(fp, chunk_size=7))
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            text_packages = list(iter_packages(fp, chunk_size=13))
+
+        self.assertListEqual(expected, binary_packages)
+        self.assertListEqual(expected, text_packages)
+
+    def test_iter_packages_is_lazy(self):
+        with open('test_data/PackagesAbridged', 'rb') as fp:
+            content = fp.read()
+        fp = io.BytesIO(content)
+        packages = iter_packages(fp, chunk_size=64)
+
+        self.assertEqual('0ad', next(packages).package)
+        # First package is yielded before the whole file has been read
+        self.assertLess(fp.tell(), len(content))
+        self.assertEqual('0ad-data', next(packages).package)
+
+    def test_compact_package_parsed(self):
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            content = fp.read()
+
+        expected = parse_package(content)
+        compact = parse_package(content, record_type='compact')
+
+        self.assertTrue(all(isinstance(it, CompactPackage) for it in compact))
+        # Relationship fields stay raw until accessed
+        self.assertIsInstance(compact[0]._depends, str)
+        self.assertEqual(expected[0].depends, compact[0].depends)
+        self.assertIsInstance(compact[0]._depends, list)
+        self.assertListEqual(expected, [it.to_package() for it in compact])
+
+    def test_unknown_record_type(self):
+        with self.assertRaises(ValueError):
+            parse_package('', record_type='dataclass')
+
+    def test_optional_headers_parsed(self):
+        content = 'Package: libc-bin\n' \
+                  'Version: 2.36-9\n' \
+                  'Architecture: amd64\n' \
+                  'Essential: yes\n' \
+                  'Built-Using: gcc-12 (= 12.2.0-14), linux (= 6.1.27-1)\n' \
+                  'Enhances: glibc-doc\n' \
+                  'Build-Ids: 1a2b 3c4d\n' \
+                  'Original-Maintainer: GNU Libc Maintainers <debian-glibc@lists.debian.org>\n' \
+                  'Filename: pool/main/g/glibc/libc-bin_2.36-9_amd64.deb\n' \
+                  'Size: 608488\n' \
+                  'SHA256: 00ff\n'
+
+        package, = parse_package(content)
+
+        self.assertTrue(package.essential)
+        self.assertListEqual(['gcc-12 (= 12.2.0-14)', 'linux (= 6.1.27-1)'], package.built_using)
+        self.assertListEqual(['glibc-doc'], package.enhances)
+        self.assertIsNone(package.conflicts)
+        self.assertListEqual(['1a2b', '3c4d'], package.build_ids)
+        self.assertDictEqual({'SHA256': '00ff'}, package.hashes)
+        self.assertListEqual(
+            [('Original-Maintainer', 'GNU Libc Maintainers <debian-glibc@lists.debian.org>')],
+            package.unknown_headers)
+        self.assertEqual(package, parse_package(content, record_type='compact')[0].to_package())
+
+    def test_invalid_essential_value(self):
+        with self.assertRaises(ValueError):
+            parse_package('Package: foo\nEssential: maybe\n')
+
+    def test_package_file_parsed(self):
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            expected = parse_package(fp.read())
+
+        self.assertListEqual(expected, parse_package_file('test_data/PackagesAbridged'))
+        self.assertListEqual(expected, [it.to_package() for it in
+                                        parse_package_file('test_data/PackagesAbridged', record_type='compact')])
+
+    def test_package_file_requested_fields(self):
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            expected = parse_package(fp.read())
+
+        package_list = parse_package_file('test_data/PackagesAbridged', fields=['filename', 'size', 'hashes'])
+
+        self.assertListEqual([(it.package, it.version, it.filename, it.size, it.hashes) for it in expected],
+                             [(it.package, it.version, it.filename, it.size, it.hashes) for it in package_list])
+        self.assertTrue(all(it.description is None and it.tag is None for it in package_list))
+
+    def test_package_unknown_requested_field(self):
+        with self.assertRaises(ValueError):
+            parse_package(b'Package: foo\n', fields=['colour'])
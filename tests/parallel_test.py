@@ -0,0 +1,82 @@
+import io
+import lzma
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from packages import iter_packages, parse_package, parse_package_file
+from parallel import parse_indexes_parallel, parse_package_file_parallel, parse_package_parallel, \
+    stanza_boundaries
+
+
+class ParallelTests(TestCase):
+    def setUp(self):
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            abridged = fp.read().strip('\n')
+        stanzas = abridged.split('\n\n')
+        self.content = '\n\n'.join(
+            stanza.replace('Package: 0ad', f'Package: 0ad{index}') for index in range(50) for stanza in stanzas)
+        self.expected = parse_package(self.content)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stanza_boundaries(self):
+        ranges = stanza_boundaries(self.content, 7)
+
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(len(self.content), ranges[-1][1])
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual('\n\n', self.content[end - 2:end])
+
+    def test_parallel_parse_same_as_serial(self):
+        self.assertListEqual(self.expected, parse_package_parallel(self.content, workers=2, chunk_count=9))
+
+        compact = parse_package_parallel(self.content, workers=2, record_type='compact', chunk_count=9)
+        self.assertListEqual(self.expected, [it.to_package() for it in compact])
+
+    def test_parallel_file_parse_same_as_serial(self):
+        path = os.path.join(self.directory, 'Packages')
+        with open(path, 'w') as fp:
+            fp.write(self.content)
+
+        self.assertListEqual(self.expected, parse_package_file_parallel(path, workers=2, chunk_count=9))
+
+    def test_indexes_parsed_in_parallel(self):
+        xz_path = os.path.join(self.directory, 'Packages.xz')
+        with open(xz_path, 'wb') as fp:
+            fp.write(lzma.compress(self.content.encode()))
+        plain_path = os.path.join(self.directory, 'Packages')
+        with open(plain_path, 'w') as fp:
+            fp.write(self.content)
+
+        result = parse_indexes_parallel({('stable', 'main', 'amd64'): xz_path, ('stable', 'main', 'arm64'): plain_path},
+                                        workers=2)
+
+        self.assertListEqual(self.expected, result[('stable', 'main', 'amd64')])
+        self.assertListEqual(self.expected, result[('stable', 'main', 'arm64')])
+
+    def test_crlf_and_empty_values_parsed_alike(self):
+        # Every stanza has a header with empty value, continued in the first one
+        content = '\n\n'.join(it.replace('\nVersion:', '\nX-Empty:\n continued\nVersion:', 1) if index == 0
+                               else it.replace('\nVersion:', '\nX-Empty:\nVersion:', 1)
+                               for index, it in enumerate(self.content.split('\n\n')))
+        expected = parse_package(content)
+        self.assertListEqual([('X-Empty', ' continued')], expected[0].unknown_headers[:1])
+        self.assertIn(('X-Empty', ''), expected[1].unknown_headers)
+
+        crlf = content.replace('\n', '\r\n')
+        path = os.path.join(self.directory, 'Packages')
+        with open(path, 'w', newline='') as fp:
+            fp.write(crlf)
+        for it in (content, crlf):
+            self.assertListEqual(expected, parse_package(it))
+            self.assertListEqual(expected, parse_package(it.encode()))
+            self.assertListEqual(expected, list(iter_packages(io.BytesIO(it.encode()))))
+            self.assertListEqual(expected, parse_package_parallel(it, workers=2, chunk_count=9))
+        self.assertListEqual(expected, parse_package_file(path))
+        self.assertListEqual(expected, parse_package_file_parallel(path, workers=2, chunk_count=9))
+
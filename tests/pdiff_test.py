@@ -0,0 +1,111 @@
+import hashlib
+import lzma
+from typing import Dict
+from unittest import TestCase
+
+from packages import parse_package
+from pdiff import apply_ed_patch, fetch_patched_index, parse_pdiff_index, patch_chain, patched_content, \
+    update_packages
+from release import parse_release
+
+
+def sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class FakeDownloader:
+    def __init__(self, files: Dict[str, bytes]):
+        self.files = files
+
+    def fetch_bytes(self, path: str) -> bytes:
+        return self.files[path]
+
+
+class PDiffTests(TestCase):
+    def setUp(self):
+        with open('test_data/PackagesAbridged', 'rb') as fp:
+            self.content = fp.read()
+
+    def test_ed_commands(self):
+        lines = [b'1\n', b'2\n', b'3\n', b'4\n', b'5\n']
+        patch = [b'5a\n', b'6\n', b'.\n', b'3,4c\n', b'three\n', b'.\n', b'1d\n']
+
+        apply_ed_patch(lines, patch)
+
+        self.assertListEqual([b'2\n', b'three\n', b'5\n', b'6\n'], lines)
+
+    def test_pdiff_index_parsed(self):
+        index = parse_pdiff_index('SHA256-Current: cc 300\n'
+                                  'SHA256-History:\n'
+                                  ' aa 100 T-1\n'
+                                  ' bb 200 T-2\n'
+                                  'SHA256-Patches:\n'
+                                  ' pa 10 T-1\n'
+                                  ' pb 20 T-2\n'
+                                  'SHA256-Download:\n'
+                                  ' da 5 T-1.gz\n'
+                                  ' db 6 T-2.gz\n')
+
+        self.assertEqual('cc', index.current_sha256)
+        self.assertListEqual(['T-1', 'T-2'], patch_chain(index, 'aa'))
+        self.assertListEqual(['T-2'], patch_chain(index, 'bb'))
+        self.assertListEqual([], patch_chain(index, 'cc'))
+        self.assertIsNone(patch_chain(index, 'unknown'))
+        self.assertListEqual(['T-1'], patch_chain(index.model_copy(update={'merged': True}), 'aa'))
+
+    def test_index_patched_forward(self):
+        middle = self.content.replace(b'Version: 0.0.26-1\n', b'Version: 0.0.26-2\n')
+        new = middle.replace(b'Priority: optional\nFilename: pool/main/0/0ad/',
+                             b'Priority: extra\nFilename: pool/main/0/0ad/')
+        lines = self.content.splitlines(keepends=True)
+        middle_line = middle.splitlines(keepends=True).index(b'Version: 0.0.26-2\n') + 1
+        new_line = new.splitlines(keepends=True).index(b'Priority: extra\n') + 1
+        patches = {
+            'T-1': f'{middle_line}c\n'.encode() + b'Version: 0.0.26-2\n.\n',
+            'T-2': f'{new_line}c\n'.encode() + b'Priority: extra\n.\n',
+        }
+        self.assertEqual(b'Version: 0.0.26-1\n', lines[middle_line - 1])
+        index = parse_pdiff_index(f'SHA256-Current: {sha256(new)} {len(new)}\n'
+                                  f'SHA256-History:\n'
+                                  f' {sha256(self.content)} {len(self.content)} T-1\n'
+                                  f' {sha256(middle)} {len(middle)} T-2\n'
+                                  f'SHA256-Patches:\n'
+                                  f' {sha256(patches["T-1"])} 1 T-1\n'
+                                  f' {sha256(patches["T-2"])} 1 T-2\n')
+
+        self.assertEqual(new, patched_content(self.content, index, lambda it: patches[it.name]))
+        self.assertIsNone(patched_content(self.content, index, lambda it: b'1d\n'))
+
+    def test_only_changed_stanzas_parsed(self):
+        old_packages = parse_package(self.content)
+        new_content = self.content.replace(b'Version: 0.0.26-1\n', b'Version: 0.0.26-2\n')
+
+        packages, parsed = update_packages(self.content, old_packages, new_content)
+
+        self.assertEqual(1, parsed)
+        self.assertIs(old_packages[0], packages[0])
+        self.assertEqual('0.0.26-2', packages[1].version)
+        self.assertListEqual(parse_package(new_content), packages)
+
+    def test_xz_patches_fetched(self):
+        new = self.content.replace(b'Version: 0.0.26-1\n', b'Version: 0.0.26-2\n')
+        line = new.splitlines(keepends=True).index(b'Version: 0.0.26-2\n') + 1
+        patch = f'{line}c\n'.encode() + b'Version: 0.0.26-2\n.\n'
+        compressed = lzma.compress(patch)
+        diff_index = (f'SHA256-Current: {sha256(new)} {len(new)}\n'
+                      f'SHA256-History:\n'
+                      f' {sha256(self.content)} {len(self.content)} T-1\n'
+                      f'SHA256-Patches:\n'
+                      f' {sha256(patch)} {len(patch)} T-1\n'
+                      f'SHA256-Download:\n'
+                      f' {sha256(compressed)} {len(compressed)} T-1.xz\n').encode()
+        with open('test_data/Release', 'r') as fp:
+            header = fp.read().split('MD5Sum:')[0]
+        release = parse_release(f'{header}SHA256:\n'
+                                f' {sha256(new)} {len(new)} main/binary-amd64/Packages\n'
+                                f' {sha256(diff_index)} {len(diff_index)} main/binary-amd64/Packages.diff/Index\n')
+        downloader = FakeDownloader({'dists/stable/main/binary-amd64/Packages.diff/Index': diff_index,
+                                     'dists/stable/main/binary-amd64/Packages.diff/T-1.xz': compressed})
+
+        self.assertEqual(new, fetch_patched_index(downloader, 'dists/stable', release, 'main/binary-amd64/Packages',
+                                                  self.content))
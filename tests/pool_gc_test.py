@@ -0,0 +1,148 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, List
+from unittest import TestCase
+
+from pool_gc import MirrorLock, collect_garbage, scan_tree
+from publish import SnapshotPublisher
+
+
+def package_stanza(name: str) -> str:
+    return f'Package: {name}\nVersion: 1.0\nArchitecture: amd64\nFilename: pool/main/{name[0]}/{name}/{name}_1.0.deb\n'
+
+
+class PoolGcTests(TestCase):
+    def setUp(self):
+        self.mirror = tempfile.mkdtemp()
+        with open('test_data/Release', 'r') as fp:
+            self.release_header = fp.read().split('MD5Sum:')[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror)
+
+    def write(self, path: str, content: bytes) -> str:
+        path = os.path.join(self.mirror, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        return path
+
+    def write_pool(self, *names: str) -> None:
+        for it in names:
+            self.write(f'pool/main/{it[0]}/{it}/{it}_1.0.deb', it.encode() * 10)
+
+    def write_suite(self, root: str, indexes: Dict[str, List[str]], newline: str = '\n') -> None:
+        # indexes maps index path to names of packages it lists, .gz ones are compressed
+        lines = []
+        for filepath, names in indexes.items():
+            content = '\n'.join(package_stanza(it) for it in names).replace('\n', newline).encode()
+            if filepath.endswith('.gz'):
+                content = gzip.compress(content)
+            self.write(os.path.join(root, filepath), content)
+            lines.append(f' {hashlib.sha256(content).hexdigest()} {len(content)} {filepath}\n')
+        self.write(os.path.join(root, 'Release'), (self.release_header + 'SHA256:\n' + ''.join(lines)).encode())
+
+    def publish_suite(self, publisher: SnapshotPublisher, indexes: Dict[str, List[str]]) -> str:
+        staging = publisher.stage()
+        self.write_suite(os.path.relpath(staging, self.mirror), indexes)
+        return publisher.publish()
+
+    def pool_files(self) -> List[str]:
+        return sorted(os.path.relpath(it, self.mirror) for it in scan_tree(os.path.join(self.mirror, 'pool')))
+
+    def test_unreferenced_files_removed(self):
+        self.write_pool('apt', 'bash', 'curl')
+        self.write_suite('dists/stable', {'main/binary-amd64/Packages.gz': ['apt', 'bash']})
+
+        report = collect_garbage(self.mirror)
+
+        self.assertListEqual(['pool/main/c/curl/curl_1.0.deb'], report.unreferenced)
+        self.assertEqual(len(b'curl' * 10), report.reclaimed_bytes)
+        self.assertEqual(3, report.scanned)
+        self.assertListEqual(['pool/main/a/apt/apt_1.0.deb', 'pool/main/b/bash/bash_1.0.deb'], self.pool_files())
+        # Directories left empty are removed as well
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, 'pool/main/c')))
+
+    def test_crlf_indexes_referenced(self):
+        self.write_pool('apt', 'bash', 'curl')
+        self.write_suite('dists/stable', {'main/binary-amd64/Packages.gz': ['apt'],
+                                          'main/binary-i386/Packages': ['bash']}, newline='\r\n')
+
+        report = collect_garbage(self.mirror)
+
+        self.assertListEqual(['pool/main/c/curl/curl_1.0.deb'], report.unreferenced)
+
+    def test_dry_run_keeps_files(self):
+        self.write_pool('apt', 'curl')
+        self.write_suite('dists/stable', {'main/binary-amd64/Packages': ['apt']})
+
+        report = collect_garbage(self.mirror, dry_run=True)
+
+        self.assertListEqual(['pool/main/c/curl/curl_1.0.deb'], report.unreferenced)
+        self.assertEqual(len(b'curl' * 10), report.reclaimed_bytes)
+        self.assertEqual(2, len(self.pool_files()))
+
+    def test_retained_snapshots_and_suites_referenced(self):
+        self.write_pool('apt', 'bash', 'curl', 'dash', 'emacs')
+        publisher = SnapshotPublisher(self.mirror, 'dists/stable')
+        self.publish_suite(publisher, {'main/binary-amd64/Packages.gz': ['apt', 'bash']})
+        self.publish_suite(publisher, {'main/binary-amd64/Packages.gz': ['apt', 'curl']})
+        self.write_suite('dists/testing', {'main/binary-arm64/Packages': ['dash']})
+
+        report = collect_garbage(self.mirror)
+
+        self.assertListEqual(['pool/main/e/emacs/emacs_1.0.deb'], report.unreferenced)
+        self.assertEqual(4, report.referenced)
+
+    def test_releases_retained_for_by_hash_referenced(self):
+        self.write_pool('apt', 'bash', 'curl')
+        self.write_suite('dists/stable', {'main/binary-amd64/Packages': ['apt']})
+        # Previous Release of the suite, its index is only kept in by-hash store
+        content = gzip.compress('\n'.join(package_stanza(it) for it in ('apt', 'bash')).encode())
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.write(f'.by-hash/SHA256/{sha256}', content)
+        release = (self.release_header + f'SHA256:\n {sha256} {len(content)} main/binary-amd64/Packages.gz\n').encode()
+        self.write(f'.by-hash/releases/dists/stable/{hashlib.sha256(release).hexdigest()}', release)
+
+        report = collect_garbage(self.mirror)
+
+        self.assertListEqual(['pool/main/c/curl/curl_1.0.deb'], report.unreferenced)
+
+    def test_collection_waits_for_syncs(self):
+        sync = MirrorLock(self.mirror)
+        sync.shared()
+        collected = threading.Event()
+
+        def collect():
+            with MirrorLock(self.mirror) as lock:
+                lock.exclusive()
+                collected.set()
+
+        thread = threading.Thread(target=collect)
+        thread.start()
+        self.assertFalse(collected.wait(0.2))
+        sync.close()
+        thread.join()
+        self.assertTrue(collected.is_set())
+
+    def test_partial_downloads_of_referenced_files_kept(self):
+        self.write_pool('apt')
+        self.write('pool/main/b/bash/bash_1.0.deb.partial', b'ba')
+        self.write('pool/main/b/bash/bash_1.0.deb.partial.journal', b'{}')
+        self.write('pool/main/c/curl/curl_1.0.deb.partial', b'cu')
+        self.write_suite('dists/stable', {'main/binary-amd64/Packages': ['apt', 'bash']})
+
+        report = collect_garbage(self.mirror)
+
+        self.assertListEqual(['pool/main/c/curl/curl_1.0.deb.partial'], report.unreferenced)
+
+    def test_mirror_without_indexes_refused(self):
+        self.write_pool('apt')
+
+        with self.assertRaises(AssertionError):
+            collect_garbage(self.mirror)
+        self.assertEqual(1, len(self.pool_files()))
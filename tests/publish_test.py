@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from by_hash import by_hash_path
+from publish import INITIAL_SNAPSHOT, SnapshotPublisher
+from release import parse_release
+
+SHA256_ALL = 'd6c9c82f4e61b4662f9ba16b9ebb379c57b4943f8b7813091d1f637325ddfb79'
+
+
+class SnapshotPublisherTests(TestCase):
+    def setUp(self):
+        self.mirror = tempfile.mkdtemp()
+        with open('test_data/Release', 'r') as fp:
+            self.release_content = fp.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror)
+
+    def write(self, root: str, path: str, content: str) -> str:
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def sync(self, publisher: SnapshotPublisher, release_content: str) -> str:
+        staging = publisher.stage()
+        self.write(staging, 'Release', release_content)
+        publisher.link_unchanged(parse_release(release_content))
+        return publisher.publish()
+
+    def test_snapshot_published_atomically(self):
+        publisher = SnapshotPublisher(self.mirror, 'dists/stable')
+        live = os.path.join(self.mirror, 'dists/stable')
+
+        staging = publisher.stage()
+        self.write(staging, 'Release', self.release_content)
+        self.assertFalse(os.path.lexists(live))
+        snapshot = publisher.publish()
+
+        self.assertTrue(os.path.islink(live))
+        self.assertEqual(os.path.realpath(snapshot), os.path.realpath(live))
+        self.assertFalse(os.path.isabs(os.readlink(live)))
+        with open(os.path.join(live, 'Release'), 'r') as fp:
+            self.assertEqual(self.release_content, fp.read())
+
+    def test_unchanged_files_linked(self):
+        publisher = SnapshotPublisher(self.mirror, 'dists/stable')
+        staging = publisher.stage()
+        self.write(staging, 'contrib/Contents-all', 'contents')
+        self.write(staging, by_hash_path('contrib/Contents-all', SHA256_ALL), 'contents')
+        self.write(staging, 'contrib/Contents-amd64', 'old contents')
+        self.write(staging, 'Release', self.release_content)
+        first = publisher.publish()
+        # Contents-amd64 changes in the next Release
+        changed = self.release_content.replace('301791ff5d830c6e9cda34c4de6d4207c1e07e910c176bd35978d315dbd251bc',
+                                               '0' * 64)
+
+        second = self.sync(publisher, changed)
+
+        for path in ('contrib/Contents-all', by_hash_path('contrib/Contents-all', SHA256_ALL)):
+            self.assertTrue(os.path.samefile(os.path.join(first, path), os.path.join(second, path)), path)
+        self.assertFalse(os.path.exists(os.path.join(second, 'contrib/Contents-amd64')))
+
+    def test_plain_directory_becomes_snapshot(self):
+        live = os.path.join(self.mirror, 'dists/stable')
+        self.write(live, 'contrib/Contents-all', 'contents')
+        self.write(live, 'Release', self.release_content)
+        publisher = SnapshotPublisher(self.mirror, 'dists/stable')
+
+        snapshot = self.sync(publisher, self.release_content)
+
+        self.assertTrue(os.path.islink(live))
+        self.assertTrue(os.path.samefile(os.path.join(snapshot, 'contrib/Contents-all'),
+                                         os.path.join(publisher.snapshots_root, INITIAL_SNAPSHOT,
+                                                      'contrib/Contents-all')))
+
+    def test_old_snapshots_collected(self):
+        publisher = SnapshotPublisher(self.mirror, 'dists/stable', retain=2)
+        snapshots = [self.sync(publisher, self.release_content) for _ in range(3)]
+        leftover = os.path.join(publisher.snapshots_root, 'crashed.staging')
+        os.makedirs(leftover)
+
+        removed = publisher.collect()
+
+        self.assertCountEqual([snapshots[0], leftover], removed)
+        self.assertListEqual(snapshots[1:], publisher.snapshots())
+        self.assertEqual(os.path.realpath(snapshots[2]), os.path.realpath(os.path.join(self.mirror, 'dists/stable')))
+
+    def test_failed_sync_discarded(self):
+        publisher = SnapshotPublisher(self.mirror, 'dists/stable')
+        staging = publisher.stage()
+
+        publisher.discard()
+
+        self.assertFalse(os.path.exists(staging))
+        self.assertListEqual([], publisher.snapshots())
@@ -1,7 +1,7 @@
 import datetime
 from typing import List
 from unittest import TestCase
-from release import parse_release, FileHashInfo
+from release import FileHashInfo, Release, classify_release_file, parse_release
 
 
 class ReleaseTests(TestCase):
@@ -50,3 +50,32 @@ class ReleaseTests(TestCase):
                          filepath='contrib/Contents-amd64'),
         ]
         self.assertCountEqual(expected_hashes, release.files_by_hash['SHA256'])
+
+    def test_files_indexed_by_path(self):
+        release = parse_release(self.content)
+
+        file = release.get_file('contrib/Contents-all.gz')
+
+        self.assertEqual(98581, file.filesize)
+        self.assertDictEqual({'MD5Sum': 'd0a0325a97c42fd5f66a8c3e29bcea64',
+                              'SHA256': 'c22d03bdd4c7619e1e39e73b4a7b9dfdf1cc1141ed9b10913fbcac58b3a943d0'},
+                             file.hashes)
+        self.assertIsNone(release.get_file('contrib/Contents-i386'))
+        self.assertEqual(3, len(Release.model_validate_json(release.model_dump_json()).files))
+        # Index is built on first lookup and is not part of the model
+        self.assertEqual(parse_release(self.content), release)
+
+    def test_files_queried_by_kind(self):
+        release = parse_release(self.content)
+
+        self.assertCountEqual(['contrib/Contents-all', 'contrib/Contents-all.gz'],
+                              [it.filepath for it in release.find_files('contrib', 'all', 'Contents')])
+        self.assertEqual(3, len(release.find_files(index_type='Contents')))
+        self.assertListEqual([], release.find_files('main'))
+
+    def test_release_files_classified(self):
+        self.assertTupleEqual(('main', 'amd64', 'Packages'), classify_release_file('main/binary-amd64/Packages.xz'))
+        self.assertTupleEqual(('main', 'arm64', 'Contents'), classify_release_file('main/Contents-udeb-arm64.gz'))
+        self.assertTupleEqual(('main', None, 'Translation'), classify_release_file('main/i18n/Translation-en.bz2'))
+        self.assertTupleEqual(('main', 'source', 'Sources'), classify_release_file('main/source/Sources.xz'))
+        self.assertTupleEqual(('main', None, 'Components'), classify_release_file('main/dep11/Components-amd64.yml.gz'))
@@ -0,0 +1,124 @@
+import os
+from datetime import datetime
+from typing import List
+from unittest import TestCase
+
+from downloader import DownloadTask, Downloader
+from mirror_server import MirrorRequestHandler, MirrorServerTestCase
+from shaping import AdaptiveConcurrency, RateSchedule, Shaper, TokenBucket, parse_host_rate_limits, parse_rate
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ShapingTests(TestCase):
+    def test_rate_parsed(self):
+        self.assertEqual(1536, parse_rate('1.5K'))
+        self.assertEqual(10 * 1024 ** 2, parse_rate('10m'))
+        self.assertEqual(100, parse_rate('100'))
+
+    def test_schedule_windows(self):
+        schedule = RateSchedule.parse(['08:00-18:00=2M', '18:00-08:00=unlimited'])
+        day_only = RateSchedule.parse(['09:30-17:00=1K'])
+
+        self.assertEqual(2 * 1024 ** 2, schedule.rate_at(datetime(2024, 1, 1, 12, 0)))
+        self.assertIsNone(schedule.rate_at(datetime(2024, 1, 1, 23, 0)))
+        self.assertIsNone(schedule.rate_at(datetime(2024, 1, 1, 3, 0)))
+        self.assertIsNone(day_only.rate_at(datetime(2024, 1, 1, 9, 0)))
+        self.assertEqual(1024, day_only.rate_at(datetime(2024, 1, 1, 9, 30)))
+
+    def test_token_bucket_limits_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1000, clock=clock, sleep=clock.sleep)
+
+        for _ in range(10):
+            bucket.consume(500)
+
+        # Burst of one second is free, the rest is paid at 1000 bytes per second
+        self.assertAlmostEqual(4.0, clock.now)
+
+    def test_unlimited_bucket_never_sleeps(self):
+        clock = FakeClock()
+        bucket = TokenBucket(None, clock=clock, sleep=clock.sleep)
+
+        bucket.consume(10 ** 9)
+
+        self.assertListEqual([], clock.sleeps)
+
+    def test_shaper_follows_schedule(self):
+        clock = FakeClock()
+        moment = [datetime(2024, 1, 1, 12, 0)]
+        shaper = Shaper(RateSchedule.parse(['08:00-18:00=1K']), parse_host_rate_limits(['slow.example,100']),
+                        now=lambda: moment[0], clock=clock, sleep=clock.sleep)
+
+        shaper.throttle('fast.example', 3072)
+        self.assertAlmostEqual(2.0, clock.now)
+        self.assertAlmostEqual(2.0, shaper.throttle('slow.example', 300))
+
+        moment[0] = datetime(2024, 1, 1, 20, 0)
+        clock.now += 10
+        slept = len(clock.sleeps)
+        shaper.throttle('fast.example', 10 ** 9)
+        self.assertEqual(slept, len(clock.sleeps))
+
+    def test_adaptive_concurrency(self):
+        clock = FakeClock()
+        concurrency = AdaptiveConcurrency(4, clock=clock)
+
+        for throughput in (100, 200, 400):
+            for _ in range(concurrency.limit):
+                concurrency.acquire()
+            clock.now += 1
+            for _ in range(concurrency.limit):
+                concurrency.release(throughput // concurrency.limit)
+        self.assertEqual(4, concurrency.limit)
+
+        # Plateau keeps the limit
+        for _ in range(4):
+            concurrency.acquire()
+        clock.now += 1
+        for _ in range(4):
+            concurrency.release(100)
+        self.assertEqual(4, concurrency.limit)
+
+        concurrency.congestion()
+        self.assertEqual(2, concurrency.limit)
+        concurrency.congestion()
+        concurrency.congestion()
+        self.assertEqual(1, concurrency.limit)
+
+
+class ShapedDownloaderTests(MirrorServerTestCase):
+    def test_congestion_backs_off(self):
+        self.write_upstream('pool/foo.deb', b'content')
+        MirrorRequestHandler.failures['/debian/pool/foo.deb'] = 1
+
+        with Downloader(self.base_url, parallelism=8, backoff=0, adaptive=True) as downloader:
+            downloader.concurrency.limit = 8
+            result, = downloader.download_all([DownloadTask(path='pool/foo.deb',
+                                                            destination=os.path.join(self.mirror, 'pool/foo.deb'))])
+
+        self.assertTrue(result.success)
+        self.assertEqual(4, downloader.concurrency.limit)
+
+    def test_downloads_throttled(self):
+        self.write_upstream('pool/foo.deb', b'x' * 3000)
+        clock = FakeClock()
+        shaper = Shaper(RateSchedule.parse(['1000']), clock=clock, sleep=clock.sleep)
+
+        with Downloader(self.base_url, backoff=0, shaper=shaper) as downloader:
+            result = downloader.download(DownloadTask(path='pool/foo.deb',
+                                                      destination=os.path.join(self.mirror, 'pool/foo.deb')))
+
+        self.assertTrue(result.success)
+        self.assertAlmostEqual(2.0, sum(clock.sleeps))
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from downloader import HttpValidator
+from packages import parse_package
+from release import parse_release
+from state import MirrorState
+
+
+class MirrorStateTests(TestCase):
+    def setUp(self):
+        self.state = MirrorState(':memory:')
+        with open('test_data/PackagesAbridged', 'r') as fp:
+            self.packages = parse_package(fp.read())
+        self.mirror = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.mirror)
+
+    def test_release_round_trip(self):
+        with open('test_data/Release', 'r') as fp:
+            release = parse_release(fp.read())
+
+        self.state.record_release('dists/stable', release)
+        self.state.record_release('dists/stable', release)
+
+        self.assertEqual(release, self.state.get_release('dists/stable'))
+        self.assertIsNone(self.state.get_release('dists/testing'))
+
+    def test_completed_release_and_validators(self):
+        with open('test_data/Release', 'r') as fp:
+            release = parse_release(fp.read())
+        validator = HttpValidator(etag='"abc"', last_modified='Sat, 10 Feb 2024 11:07:25 GMT')
+
+        self.state.record_completed_release('dists/stable', release, 'config')
+        self.state.record_http_validators({'http://a/dists/stable/Release': validator})
+
+        self.assertEqual(release, self.state.completed_release('dists/stable', 'config'))
+        self.assertIsNone(self.state.completed_release('dists/stable', 'other config'))
+        self.assertIsNone(self.state.completed_release('dists/testing', 'config'))
+        self.assertDictEqual({'http://a/dists/stable/Release': validator},
+                             self.state.http_validators(['http://a/dists/stable/Release', 'http://b/Release']))
+
+    def test_package_files_and_verified_hashes(self):
+        self.state.record_index('dists/stable', 'main/binary-amd64/Packages.xz', 'aa', self.packages[:1])
+        self.state.record_index('dists/testing', 'main/binary-amd64/Packages.xz', 'bb', self.packages[1:2])
+        self.state.record_pool_files([(self.packages[0].filename, 1, 1, 'cc'), (self.packages[1].filename, 1, 1, None)])
+
+        self.assertCountEqual([(it.filename, it.size, it.hashes.get('SHA256')) for it in self.packages[:2]],
+                              list(self.state.package_files()))
+        self.assertDictEqual({self.packages[0].filename: 'cc'},
+                             self.state.verified_sha256s([it.filename for it in self.packages[:2]]))
+
+    def test_index_packages_recorded(self):
+        self.state.record_index('dists/stable', 'main/binary-amd64/Packages.xz', 'aa', self.packages)
+
+        self.assertEqual('aa', self.state.index_sha256('dists/stable', 'main/binary-amd64/Packages.xz'))
+        self.assertListEqual(self.packages, self.state.load_packages('dists/stable', 'main/binary-amd64/Packages.xz'))
+
+        self.state.record_index('dists/stable', 'main/binary-amd64/Packages.xz', 'bb', self.packages[:1])
+        self.assertListEqual(self.packages[:1],
+                             self.state.load_packages('dists/stable', 'main/binary-amd64/Packages.xz'))
+
+    def test_index_recorded_with_other_config(self):
+        self.state.record_index('dists/stable', 'main/binary-amd64/Packages.xz', 'aa', self.packages[:1], 'latest')
+
+        self.assertEqual('aa', self.state.index_sha256('dists/stable', 'main/binary-amd64/Packages.xz', 'latest'))
+        self.assertIsNone(self.state.index_sha256('dists/stable', 'main/binary-amd64/Packages.xz', 'all'))
+
+    def test_missing_and_recorded_files(self):
+        first, second = self.packages
+        self.state.record_index('dists/stable', 'main/binary-amd64/Packages.xz', 'aa', self.packages)
+        self.state.record_pool_file(first.filename, first.size, 1, first.hashes['SHA256'])
+        self.state.record_pool_file(second.filename, second.size, 1, 'other hash')
+        self.state.record_pool_file('pool/main/o/old/old_1.0_amd64.deb', 10, 1)
+
+        self.assertDictEqual({second.filename: (second.size, {'SHA256': second.hashes['SHA256']})},
+                             self.state.missing_files())
+        self.assertDictEqual({}, self.state.missing_files('dists/testing'))
+        self.assertDictEqual({it.filename: (it.size, {'SHA256': it.hashes['SHA256']}) for it in self.packages},
+                             self.state.recorded_files('dists/stable'))
+
+        self.state.retain_indexes('dists/stable', [])
+        self.assertDictEqual({}, self.state.missing_files())
+
+    def test_stale_files(self):
+        filename = 'pool/main/f/foo.deb'
+        path = os.path.join(self.mirror, filename)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(b'content')
+        self.state.record_pool_files_from_disk(self.mirror, [filename])
+        self.state.record_pool_file('pool/main/g/gone.deb', 1, 1)
+
+        self.assertSetEqual({'pool/main/g/gone.deb'}, self.state.stale_filenames(self.mirror))
+
+        with open(path, 'ab') as fp:
+            fp.write(b'more')
+        self.assertSetEqual({filename}, self.state.stale_filenames(self.mirror, [filename]))
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fixtures import make_package
+from packages import Package
+from sync import files_to_download, plan_downloads, plan_sync, pool_file_state
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.mirror = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror)
+
+    def write_pool(self, package: Package, content: bytes) -> None:
+        path = os.path.join(self.mirror, package.filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+
+    def test_version_bump_and_rebuild_detected(self):
+        unchanged = make_package('foo')
+        bumped_old, bumped_new = make_package('bar', '1.0'), make_package('bar', '1.1')
+        rebuilt_old, rebuilt_new = make_package('baz', content=b'old'), make_package('baz', content=b'new')
+
+        plan = plan_sync([unchanged, bumped_old, rebuilt_old], [unchanged, bumped_new, rebuilt_new])
+
+        self.assertCountEqual([bumped_new, rebuilt_new], plan.added)
+        self.assertCountEqual([bumped_old, rebuilt_old], plan.removed)
+        self.assertListEqual([unchanged], plan.unchanged)
+
+    def test_only_missing_or_mismatched_scheduled(self):
+        present = make_package('present')
+        missing = make_package('missing')
+        truncated = make_package('truncated')
+        corrupted = make_package('corrupted')
+        self.write_pool(present, b'content')
+        self.write_pool(truncated, b'cont')
+        self.write_pool(corrupted, b'CONTENT')
+
+        self.assertEqual('present', pool_file_state(self.mirror, present))
+        self.assertEqual('mismatch', pool_file_state(self.mirror, truncated))
+        self.assertEqual('present', pool_file_state(self.mirror, corrupted))
+        self.assertEqual('mismatch', pool_file_state(self.mirror, corrupted, verify_hash=True))
+        self.assertCountEqual([missing, truncated, corrupted],
+                              files_to_download([present, missing, truncated, corrupted, missing], self.mirror,
+                                                verify_hashes=True))
+
+    def test_plan_downloads_checks_unchanged(self):
+        kept = make_package('kept')
+        new = make_package('new')
+
+        plan = plan_sync([kept], [kept, new])
+
+        # Unchanged package is scheduled again because its pool file is gone
+        self.assertCountEqual([kept, new], plan_downloads(plan, self.mirror))
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from release import parse_release
+from verify import VerifyEntry, hash_file, release_entries, summarize, verify_files
+
+
+class VerifyTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path: str, content: bytes) -> None:
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+
+    def test_all_digests_in_one_pass(self):
+        content = b'0123456789' * 1000
+        self.write('file', content)
+
+        digests = hash_file(os.path.join(self.root, 'file'), ['MD5sum', 'SHA256', 'Unknown'], buffer_size=333)
+
+        self.assertDictEqual({'MD5sum': hashlib.md5(content).hexdigest(),
+                              'SHA256': hashlib.sha256(content).hexdigest()}, digests)
+
+    def test_report(self):
+        self.write('pool/ok.deb', b'ok')
+        self.write('pool/short.deb', b'o')
+        self.write('pool/corrupt.deb', b'ko')
+        hashes = {'SHA256': hashlib.sha256(b'ok').hexdigest(), 'MD5sum': hashlib.md5(b'ok').hexdigest()}
+        entries = [VerifyEntry(path=f'pool/{name}.deb', size=2, hashes=hashes)
+                   for name in ('ok', 'short', 'corrupt', 'missing')]
+
+        results = verify_files(self.root, entries, workers=2)
+
+        self.assertListEqual(['ok', 'mismatch', 'mismatch', 'missing'], [it.status for it in results])
+        self.assertIn('size', results[1].error)
+        self.assertIn('SHA256', results[2].error)
+        self.assertDictEqual({'ok': 1, 'mismatch': 2, 'missing': 1}, summarize(results))
+
+    def test_release_entries_merge_hashes(self):
+        with open('test_data/Release', 'r') as fp:
+            release = parse_release(fp.read())
+
+        entries = {it.path: it for it in release_entries(release, 'dists/stable')}
+
+        self.assertEqual(3, len(entries))
+        entry = entries['dists/stable/contrib/Contents-all.gz']
+        self.assertEqual(98581, entry.size)
+        self.assertDictEqual({'MD5Sum': 'd0a0325a97c42fd5f66a8c3e29bcea64',
+                              'SHA256': 'c22d03bdd4c7619e1e39e73b4a7b9dfdf1cc1141ed9b10913fbcac58b3a943d0'},
+                             entry.hashes)
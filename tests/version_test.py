@@ -0,0 +1,25 @@
+from unittest import TestCase
+
+from version import compare_versions, version_key
+
+
+class VersionTests(TestCase):
+    def test_ordered_like_dpkg(self):
+        ordered = ['1.0~rc1', '1.0', '1.0-0.1', '1.0-1', '1.0-1+b1', '1.0a', '1.0.1', '1.2', '1.10', '2:0.1']
+
+        self.assertListEqual(ordered, sorted(reversed(ordered), key=version_key))
+
+    def test_tilde_sorts_before_end(self):
+        self.assertEqual(-1, compare_versions('1.0~', '1.0'))
+        self.assertEqual(-1, compare_versions('1.0~~', '1.0~'))
+        self.assertEqual(1, compare_versions('1.0', '1.0~beta'))
+
+    def test_equal_versions(self):
+        self.assertEqual(0, compare_versions('1.0', '0:1.0-0'))
+        self.assertEqual(0, compare_versions('1.01', '1.1'))
+
+    def test_epoch_wins(self):
+        self.assertEqual(1, compare_versions('1:0.1', '9.9'))
+
+    def test_revision_split_on_last_dash(self):
+        self.assertEqual(-1, compare_versions('1.0-beta-1', '1.0-beta-2'))